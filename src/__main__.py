@@ -16,7 +16,8 @@
 
 import sys
 import os
-from optparse import OptionParser, OptionGroup, SUPPRESS_HELP
+import errno
+from optparse import OptionParser, OptionGroup, SUPPRESS_HELP, Values
 import subprocess
 import shlex
 import logging
@@ -24,10 +25,26 @@ import gettext
 import traceback
 import tempfile
 import time
+import random
 import shutil
+import fnmatch
+import re
+import stat
+import struct
+import base64
+import hashlib
+import threading
+import multiprocessing
+import signal
+import select
+import Queue
+import mmap
+import json
+import collections
+import contextlib
+import fcntl
 from pwd import getpwnam
 import getpass
-import ovirtsdk4
 from ovirt_iso_uploader import config
 
 APP_NAME = "ovirt-iso-uploader"
@@ -43,15 +60,442 @@ UMOUNT = '/bin/umount'
 SSH = '/usr/bin/ssh'
 SCP = '/usr/bin/scp'
 CP = '/bin/cp'
+CAT = '/bin/cat'
 RM = '/bin/rm -fv'
 MV = '/bin/mv -fv'
 CHOWN = '/bin/chown'
 CHMOD = '/bin/chmod'
 TEST = '/usr/bin/test'
+DD = '/bin/dd'
+FALLOCATE = '/usr/bin/fallocate'
+TRUNCATE = '/usr/bin/truncate'
+STAT = '/usr/bin/stat'
 DEFAULT_CONFIGURATION_FILE = '/etc/ovirt-engine/isouploader.conf'
 PERMS_MASK = '640'
 PYTHON = '/usr/bin/python'
 
+# {On-the-wire compression for SSH transfers
+# name: (binary, compress args, decompress args, auto levels, default level)
+COMPRESSORS = {
+    'zstd': ('/usr/bin/zstd', '-q -c -T0 -%d', '-q -d -c', (1, 3, 6, 9), 3),
+    'lz4': ('/usr/bin/lz4', '-q -c -%d', '-q -d -c', (1, 3, 6, 9), 1),
+    'pigz': ('/usr/bin/pigz', '-c -%d', '-d -c', (1, 3, 6, 9), 1),
+}
+DEFAULT_COMPRESSOR = 'zstd'
+COMPRESS_SAMPLES = 4
+COMPRESS_SAMPLE_SIZE = 1024 * 1024
+# Compressed/raw size ratio above which compression is not worth it
+COMPRESS_MAX_RATIO = 0.9
+# }
+
+# {Remote helpers, run through PYTHON on the SSH server
+REMOTE_LIST_SCRIPT = '''
+import os
+import stat
+import sys
+for name in os.listdir(sys.argv[1]):
+    if name.startswith('.'):
+        continue
+    st = os.stat(os.path.join(sys.argv[1], name))
+    if stat.S_ISREG(st.st_mode):
+        sys.stdout.write('%d %f %s\\n' % (st.st_size, st.st_mtime, name))
+'''
+REMOTE_REMOVE_SCRIPT = '''
+import os
+import sys
+for name in sys.stdin.read().splitlines():
+    try:
+        os.remove(os.path.join(sys.argv[1], name))
+        sys.stdout.write('ok %s\\n' % name)
+    except OSError as e:
+        sys.stdout.write('error %s %s\\n' % (name, e.strerror))
+'''
+REMOTE_DIGEST_SCRIPT = '''
+import hashlib
+import os
+import sys
+for name in sys.stdin.read().splitlines():
+    digest = hashlib.sha256()
+    with open(os.path.join(sys.argv[1], name), 'rb') as f:
+        while True:
+            block = f.read(1048576)
+            if not block:
+                break
+            digest.update(block)
+    sys.stdout.write('%s %s\\n' % (digest.hexdigest(), name))
+'''
+REMOTE_BLOCK_HASH_SCRIPT = '''
+import hashlib
+import sys
+block_size = int(sys.argv[1])
+with open(sys.argv[2], 'rb') as f:
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        sys.stdout.write(hashlib.sha1(block).hexdigest() + '\\n')
+'''
+REMOTE_RECEIVE_SCRIPT = '''
+import hashlib
+import sys
+path, offset, mode = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+src = getattr(sys.stdin, 'buffer', sys.stdin)
+digest = hashlib.sha256()
+zero = b'\\0' * 1048576
+# Zeros are skipped rather than written where the file already has
+# them, so that the digest covers what ends up in the file
+with open(path, 'r+b' if mode == 'patch' else 'wb') as dst:
+    dst.seek(offset)
+    while True:
+        block = src.read(1048576)
+        if not block:
+            break
+        digest.update(block)
+        if block != zero[:len(block)]:
+            dst.write(block)
+        elif mode != 'patch':
+            dst.seek(len(block), 1)
+        else:
+            position = dst.tell()
+            if dst.read(len(block)) != block:
+                dst.seek(position)
+                dst.write(block)
+    if mode == 'create':
+        dst.truncate()
+sys.stdout.write(digest.hexdigest() + '\\n')
+'''
+REMOTE_PATCH_SCRIPT = '''
+import struct
+import sys
+size = int(sys.argv[1])
+src = getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+def read(n):
+    data = src.read(n)
+    while len(data) < n:
+        chunk = src.read(n - len(data))
+        if not chunk:
+            raise SystemExit('unexpected end of the delta stream')
+        data += chunk
+    return data
+
+with open(sys.argv[2], 'r+b') as dst:
+    while True:
+        header = src.read(16)
+        if not header:
+            break
+        if len(header) < 16:
+            header += read(16 - len(header))
+        offset, length = struct.unpack('!QQ', header)
+        dst.seek(offset)
+        while length:
+            chunk = read(min(length, 1048576))
+            dst.write(chunk)
+            length -= len(chunk)
+    dst.truncate(size)
+'''
+REMOTE_BULK_SCRIPT = '''
+import os
+import sys
+import tarfile
+dir, force, owner, mode = sys.argv[1], sys.argv[2] == '1', \\
+    int(sys.argv[3]), int(sys.argv[4], 8)
+src = getattr(sys.stdin, 'buffer', sys.stdin)
+received = []
+# The temp file being written, removed too if the stream breaks
+current = None
+
+
+def report(*fields):
+    sys.stdout.write(' '.join(str(field) for field in fields) + '\\n')
+
+try:
+    tar = tarfile.open(fileobj=src, mode='r|')
+    for member in tar:
+        name = member.name
+        if not member.isfile() or name.startswith('.') or '/' in name:
+            report('error', 22, name)
+            continue
+        path = os.path.join(dir, name)
+        if os.path.exists(path) and not force:
+            report('exists', name)
+            continue
+        st = os.statvfs(dir)
+        if st.f_bavail * st.f_frsize <= member.size:
+            report('nospace', st.f_bavail * st.f_frsize, name)
+            continue
+        temp = current = os.path.join(dir, '.' + name)
+        try:
+            data = tar.extractfile(member)
+            with open(temp, 'wb') as dst:
+                while True:
+                    block = data.read(1048576)
+                    if not block:
+                        break
+                    dst.write(block)
+            if owner >= 0:
+                os.chown(temp, owner, owner)
+            os.chmod(temp, mode)
+            received.append(name)
+        except (IOError, OSError) as e:
+            report('error', e.errno, name)
+            if os.path.exists(temp):
+                os.remove(temp)
+        current = None
+except BaseException:
+    if current is not None and os.path.exists(current):
+        os.remove(current)
+    for name in received:
+        os.remove(os.path.join(dir, '.' + name))
+    raise
+# Only complete batches land in the domain
+for name in received:
+    try:
+        os.rename(os.path.join(dir, '.' + name), os.path.join(dir, name))
+        report('ok', name)
+    except OSError as e:
+        report('error', e.errno, name)
+'''
+# }
+
+# {Bulk uploads
+BULK_CHUNK_SIZE = 1024 * 1024
+# }
+
+# {Delta uploads
+DELTA_BLOCK_SIZE = 1024 * 1024
+DELTA_HEADER = struct.Struct('!QQ')
+# }
+
+# {Pipelined copies
+PIPELINE_BUFFERS = 4
+PIPELINE_BUFFER_SIZE = 1024 * 1024
+# }
+
+# {Fan-out uploads
+FANOUT_CHUNK_SIZE = 1024 * 1024
+# Chunks queued per destination
+FANOUT_BUFFERS = 16
+# Seconds a destination may hold the others back before being detached
+FANOUT_STALL_TIMEOUT = 30
+# Seconds between checks of the destinations holding the others back
+FANOUT_POLL_INTERVAL = 0.1
+# }
+
+# {Sparse files
+# Holes are made at the block size of the destination filesystem, within
+# these bounds: NFS reports its transfer size as block size.
+SPARSE_MIN_BLOCK_SIZE = 512
+SPARSE_MAX_BLOCK_SIZE = 16 * 1024
+ZERO_RUN = re.compile(r'\x00+')
+# }
+
+# {Page cache
+POSIX_FADV_DONTNEED = 4
+# Files larger than this don't go through the page cache in 'auto' mode
+DROP_CACHE_THRESHOLD = 1024 * 1024 * 1024
+DROP_CACHE_WINDOW = 64 * 1024 * 1024
+DROP_CACHE_MODES = ('auto', 'yes', 'no')
+_fadvise = []
+
+
+def drop_page_cache(fd, offset=0, length=0):
+    """
+    Tells the kernel that the given range of fd (up to the end of the
+    file if length is 0) won't be read again, so that its clean pages
+    are dropped from the page cache.  Errors are only logged: this is an
+    optimization.
+    """
+    if not _fadvise:
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            func = libc.posix_fadvise64
+            func.argtypes = (
+                ctypes.c_int,
+                ctypes.c_int64,
+                ctypes.c_int64,
+                ctypes.c_int,
+            )
+        except (OSError, AttributeError) as e:
+            logging.debug('posix_fadvise is not available: %s', e)
+            func = None
+        _fadvise.append(func)
+    if _fadvise[0] is None:
+        return
+    err = _fadvise[0](fd, offset, length, POSIX_FADV_DONTNEED)
+    if err:
+        logging.debug(
+            'posix_fadvise(%s, %s, %s) failed: %s',
+            fd, offset, length, os.strerror(err)
+        )
+# }
+
+
+# {ISO validation
+ISO_EXTENSIONS = ('.iso',)
+ISO_SECTOR_SIZE = 2048
+# The volume descriptors (and the UDF volume recognition sequence) start
+# at this sector
+ISO_FIRST_DESCRIPTOR = 16
+ISO_MAX_DESCRIPTORS = 64
+ISO_DESCRIPTOR_IDS = (
+    'CD001', 'CD002', 'BEA01', 'NSR02', 'NSR03', 'TEA01', 'BOOT2', 'CDW02',
+)
+ISO_BOOT_SYSTEM = 'EL TORITO SPECIFICATION'
+UDF_ANCHOR_SECTOR = 256
+# UDF descriptor tag identifiers
+UDF_PRIMARY_VOLUME = 1
+UDF_ANCHOR = 2
+UDF_TERMINATING = 8
+# }
+
+# {Scheduling
+# given: command line order, smallest: most files first, best-fit:
+# largest files that still fit first, filling the domain best
+SCHEDULE_POLICIES = ('given', 'smallest', 'best-fit')
+# }
+
+# {Sync
+HASH_BLOCK_SIZE = 1024 * 1024
+# Checksum files looked for next to the uploaded files
+SHA256_SUFFIX = '.sha256'
+SHA256_SUMS_FILES = ('SHA256SUMS', 'sha256sum.txt')
+SYNC_COMPARE_MODES = ('mtime', 'hash')
+# }
+
+# {Striped SSH transfers
+STRIPE_MIN_SIZE = 64 * 1024 * 1024
+STRIPE_BLOCK_SIZE = 1024 * 1024
+DEFAULT_STRIPE_RETRIES = 3
+# }
+
+# {Image transfers
+# The ranges of a file sent concurrently, one per HTTP connection at a
+# time, and the size of the requests they are sent in
+DEFAULT_HTTP_CONNECTIONS = 4
+HTTP_RANGE_SIZE = 64 * 1024 * 1024
+HTTP_CHUNK_SIZE = 4 * 1024 * 1024
+# Shorter runs of zeros are sent as data rather than as a zero request
+HTTP_ZERO_MIN_SIZE = 64 * 1024
+# Storage types of data domains that can't hold sparse raw disks
+BLOCK_STORAGE_TYPES = ('iscsi', 'fcp')
+TRANSFER_POLL_INTERVAL = 1
+TRANSFER_TIMEOUT = 300
+# }
+
+# {Retries and stall detection
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 2
+RETRY_MAX_DELAY = 60
+# What a soft NFS mount returns when the server does not answer in time
+TRANSIENT_ERRNOS = (errno.EIO, errno.ETIMEDOUT, errno.EAGAIN)
+# The exit status of ssh when the connection fails
+SSH_CONNECTION_ERROR = 255
+# scp exits with 1 on any error, a failed connection shows in its stderr
+SCP_ERROR = 1
+SCP_CONNECTION_ERROR = re.compile(
+    r'lost connection|Connection (reset|closed|refused|timed out)|'
+    r'not responding'
+)
+# ssh gives up on a server that stops answering after
+# SSH_ALIVE_INTERVAL * SSH_ALIVE_COUNT seconds
+SSH_ALIVE_INTERVAL = 15
+SSH_ALIVE_COUNT = 4
+DEFAULT_STALL_TIMEOUT = 120
+STALL_POLL_INTERVAL = 1
+# With retries, NFS copies are synced every CHECKPOINT_INTERVAL bytes
+# so that a failed copy can be resumed from the last sync.
+CHECKPOINT_INTERVAL = 256 * 1024 * 1024
+# }
+
+# {Command execution
+# How many commands (or pipelines) may run at the same time
+DEFAULT_MAX_COMMANDS = 16
+# Commands that are not transfers fail after that many seconds
+DEFAULT_COMMAND_TIMEOUT = 600
+# How much of the stderr of a command is kept for logs and errors
+OUTPUT_TAIL_SIZE = 64 * 1024
+# }
+
+# {Metrics
+METRICS_PREFIX = 'ovirt_iso_uploader'
+# name -> (type, help) of the metrics exported
+METRICS = {
+    'runs_total': (
+        'counter', 'Runs of the uploader by command and exit code.'),
+    'last_run_timestamp_seconds': (
+        'gauge', 'When the last run of a command ended.'),
+    'last_run_duration_seconds': (
+        'gauge', 'How long the last run of a command took.'),
+    'files_total': (
+        'counter', 'Files processed by destination and result.'),
+    'uploaded_bytes_total': (
+        'counter', 'Bytes of the files uploaded by destination.'),
+    'sparse_bytes_total': (
+        'counter', 'Bytes of the files uploaded that are holes.'),
+    'phase_duration_seconds': (
+        'histogram', 'Duration of the phases of the uploads.'),
+    'throughput_bytes_per_second': (
+        'gauge', 'Throughput of the last transfer by destination.'),
+}
+METRICS_BUCKETS = (0.1, 1, 5, 15, 60, 300, 900, 3600)
+STATSD_NAME = re.compile(r'[^A-Za-z0-9_-]+')
+METRICS_LE = re.compile(r'le="([^"]*)"')
+# }
+
+# {Watch
+# inotify(7) events and flags
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 02000000
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_BUFFER_SIZE = 64 * 1024
+# A file is uploaded once it has been left alone for that many seconds
+DEFAULT_WATCH_SETTLE = 5
+# How long an idle SSH master connection is kept open while watching
+WATCH_SSH_PERSIST = 600
+# }
+
+# {Host selection
+# The ranking of the hosts of the local ISO domains
+HOST_CACHE_FILE = os.path.join(config.DEFAULT_STATE_DIR, 'hosts.json')
+DEFAULT_HOST_CACHE_TTL = 3600
+# Random data sent to each candidate host to measure its throughput
+HOST_PROBE_SIZE = 4 * 1024 * 1024
+HOST_PROBE_TIMEOUT = 30
+# Hosts are ranked by the time they would take to receive that much
+HOST_RANK_SIZE = 1024 * 1024 * 1024
+# }
+
+# {SSH ciphers
+# The candidates of --ssh-cipher=auto, tried on each file server
+SSH_CIPHERS = [
+    'aes128-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com',
+    'aes128-ctr',
+]
+CIPHER_CACHE_FILE = os.path.join(config.DEFAULT_STATE_DIR, 'ciphers.json')
+# Random data sent through each cipher to measure its throughput
+CIPHER_PROBE_SIZE = 16 * 1024 * 1024
+# }
+
+# {Throughput history
+DEFAULT_HISTORY_FILE = os.path.join(
+    config.DEFAULT_STATE_DIR,
+    'throughput.json'
+)
+# The weight of the last transfer in the average throughput
+HISTORY_WEIGHT = 0.3
+# Shorter transfers say more about latency than throughput
+HISTORY_MIN_SECONDS = 1
+# }
+
 # {Logging system
 STREAM_LOG_FORMAT = '%(levelname)s: %(message)s'
 FILE_LOG_FORMAT = (
@@ -63,6 +507,11 @@ FILE_LOG_FORMAT = (
     ' %(message)s'
 )
 FILE_LOG_DSTMP = '%Y-%m-%d %H:%M:%S'
+# Records waiting for the log file writer, beyond which debug and info
+# records are dropped and warnings wait
+LOG_QUEUE_SIZE = 10000
+# How much of the output of a command goes into a debug record
+LOG_CAPTURE_SIZE = 4096
 DEFAULT_LOG_FILE = os.path.join(
     config.DEFAULT_LOG_DIR,
     '{prefix}-{timestamp}.log'.format(
@@ -78,1209 +527,5963 @@ class NotAnError(logging.Filter):
         return entry.levelno < logging.ERROR
 
 
+class QueuedHandler(logging.Handler):
+    """
+    Puts the records on a bounded queue that a background thread writes
+    to handler, so that a slow log volume never blocks the threads that
+    log.  When the queue is full, records below WARNING are dropped, and
+    counted in the log once the queue is drained, while more important
+    ones wait for room.
+    """
+
+    def __init__(self, handler, size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self, handler.level)
+        self.handler = handler
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            # Render the message now, its arguments may change later
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self.handler.formatter.formatException(
+                    record.exc_info
+                ) if self.handler.formatter else None
+                record.exc_info = None
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def write(self):
+        reported = 0
+        while True:
+            record = self.queue.get()
+            if self.dropped != reported and (
+                record is None or self.queue.empty()
+            ):
+                self.handler.handle(logging.makeLogRecord({
+                    'name': 'root',
+                    'levelno': logging.WARNING,
+                    'levelname': logging.getLevelName(logging.WARNING),
+                    'msg': '%d log records dropped, the log is too slow' % (
+                        self.dropped - reported
+                    ),
+                }))
+                reported = self.dropped
+            if record is None:
+                return
+            self.handler.handle(record)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
 def multilog(logger, msg):
     for line in str(msg).splitlines():
         logger(line)
+
+
+def clip(text, size=LOG_CAPTURE_SIZE):
+    """
+    Returns text, cut to size bytes for a log record.
+    """
+    if len(text) <= size:
+        return text
+    return '%s... (%d more bytes)' % (text[:size], len(text) - size)
 # }
 
 
-def get_from_prompt(msg, default=None, prompter=raw_input):
-    try:
-        return prompter(msg)
-    except EOFError:
-        print
-        return default
+def split_list(value):
+    """
+    Splits a comma separated option value.
+    """
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
 
 
-class ExitCodes():
+def sparse_block_size(fd):
     """
-    A simple psudo-enumeration class to hold the current and future exit codes
+    Returns the size of the blocks holes are made of in the file open as
+    fd, from the block size of its filesystem.
     """
-    NOERR = 0
-    CRITICAL = 1
-    LIST_ISO_ERR = 2
-    UPLOAD_ERR = 3
-    CLEANUP_ERR = 4
-    exit_code = NOERR
+    sizes = [
+        size for size in (
+            os.fstat(fd).st_blksize,
+            os.fstatvfs(fd).f_frsize,
+        ) if size > 0
+    ]
+    return max(
+        SPARSE_MIN_BLOCK_SIZE,
+        min(sizes + [SPARSE_MAX_BLOCK_SIZE])
+    )
 
 
-class Commands():
+def zero_ranges(buf, size, block_size, base=0):
     """
-    A simple psudo-enumeration class to facilitate command checking.
+    Yields the (start, end) ranges of the first size bytes of buf that
+    only hold zeros and cover whole blocks of block_size bytes, aligned
+    on the offset base of buf in its file.  A range reaching size may
+    end with a partial block.  The zeros are found by str.find and a
+    regular expression, which scan in C rather than block by block.
     """
-    LIST = 'list'
-    UPLOAD = 'upload'
-    # DELETE = 'delete'
-    ARY = [LIST, UPLOAD]
+    zero = '\0' * block_size
+    pos = 0
+    while pos < size:
+        start = buf.find(zero, pos, size)
+        if start < 0:
+            return
+        end = ZERO_RUN.match(buf, start, size).end()
+        first = start + (-(base + start) % block_size)
+        last = end if end == size else end - (base + end) % block_size
+        if last > first:
+            yield (first, last)
+        pos = end
 
 
-class NEISODomain(RuntimeError):
-    """"
-    This exception is raised when the user inputs a not existing ISO domain
+def write_sparse(fdst, buf, size, block_size=SPARSE_MAX_BLOCK_SIZE):
     """
-    pass
+    Writes the first size bytes of buf to fdst, seeking over the
+    blocks of block_size bytes that only hold zeros instead of writing
+    them, so that only the blocks holding data get allocated.
+    """
+    pos = 0
+    for start, end in zero_ranges(buf, size, block_size, fdst.tell()):
+        if start > pos:
+            fdst.write(buffer(buf, pos, start - pos))
+        fdst.seek(end - start, os.SEEK_CUR)
+        pos = end
+    if size > pos:
+        fdst.write(buffer(buf, pos, size - pos))
 
 
-class Caller(object):
+def retention_prefix(name):
     """
-    Utility class for forking programs.
+    Returns the part of name before its first digit, which groups the
+    versions of the same image for the --keep-newest retention rule.
     """
+    for index, char in enumerate(name):
+        if char.isdigit():
+            return name[:index]
+    return name
 
-    def __init__(self, configuration):
-        self.configuration = configuration
 
-    def prep(self, cmd):
-        _cmd = cmd % self.configuration
-        logging.debug(_cmd)
-        return shlex.split(_cmd)
+def sha256_stream(src):
+    """
+    Returns the SHA256 hex digest of what is left to read of the file
+    object src.
+    """
+    digest = hashlib.sha256()
+    while True:
+        block = src.read(HASH_BLOCK_SIZE)
+        if not block:
+            break
+        digest.update(block)
+    return digest.hexdigest()
 
-    def call(self, cmds):
-        """
-        Uses the configuration to fork a subprocess and run cmds
-        """
-        _cmds = self.prep(cmds)
-        logging.debug("_cmds(%s)" % _cmds)
-        proc = subprocess.Popen(
-            _cmds,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = proc.communicate()
-        returncode = proc.returncode
-        logging.debug("returncode(%s)" % returncode)
-        logging.debug("STDOUT(%s)" % stdout)
-        logging.debug("STDERR(%s)" % stderr)
 
-        if returncode == 0:
-            return (stdout, returncode)
-        else:
-            raise Exception(stderr)
+def sha256_file(path):
+    """
+    Returns the SHA256 hex digest of the file at path.
+    """
+    with open(path, 'rb') as src:
+        return sha256_stream(src)
 
 
-class Configuration(dict):
+def tar_stream(files):
     """
-    This class is a dictionary subclass that knows how to read and
-    handle our configuration. Resolution order is defaults ->
-    configuration file -> command line options.
+    Yields the tar archive of files, flattened to their base names, as
+    the files are read.
     """
+    import tarfile
+    for path in files:
+        st = os.stat(path)
+        info = tarfile.TarInfo(os.path.basename(path))
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = int(PERMS_MASK, 8)
+        yield info.tobuf(tarfile.GNU_FORMAT)
+        left = st.st_size
+        with open(path, 'rb') as src:
+            while left:
+                block = src.read(min(left, BULK_CHUNK_SIZE))
+                if not block:
+                    raise Exception(
+                        _('%s shrank while it was sent') % path
+                    )
+                left -= len(block)
+                yield block
+        yield '\0' * (-st.st_size % tarfile.BLOCKSIZE)
+    yield '\0' * (2 * tarfile.BLOCKSIZE)
 
-    class SkipException(Exception):
-        "This exception is raised when the user aborts a prompt"
-        pass
 
-    def __init__(self,
-                 parser=None):
-        self.command = None
-        self.parser = parser
-        self.options = None
-        self.args = None
-        self.files = []
+def sidecar_digest(path):
+    """
+    Looks for the expected SHA256 digest of the file at path in a
+    <path>.sha256 file, then in a SHA256SUMS file of its directory, in
+    either the sha256sum ("digest  name") or the BSD ("SHA256 (name) =
+    digest") format.
+    Returns: (digest, checksum file), or (None, None) if there is none.
+    """
+    name = os.path.basename(path)
+    candidates = [(path + SHA256_SUFFIX, None)]
+    for sums in SHA256_SUMS_FILES:
+        candidates.append((os.path.join(os.path.dirname(path), sums), name))
+    for sums, wanted in candidates:
+        if not os.path.isfile(sums):
+            continue
+        with open(sums) as lines:
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 4 and fields[0] == 'SHA256' and \
+                        fields[2] == '=':
+                    digest, listed = fields[3], fields[1][1:-1]
+                elif len(fields) == 2:
+                    digest, listed = fields[0], fields[1].lstrip('*')
+                elif len(fields) == 1 and wanted is None:
+                    digest, listed = fields[0], None
+                else:
+                    continue
+                if len(digest) != 64:
+                    continue
+                if wanted is None or os.path.basename(listed) == wanted:
+                    return (digest.lower(), sums)
+    return (None, None)
 
-        # Immediately, initialize the logger to the INFO log level and our
-        # logging format which is <LEVEL>: <MSG> and not the default of
-        # <LEVEL>:<UID: <MSG>
-        self.__initLogger(logging.INFO)
 
-        if not parser:
-            raise Exception("Configuration requires a parser")
+def ignore_interrupts():
+    # ^C is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        self.options, self.args = self.parser.parse_args()
 
-        if os.geteuid() != 0:
-            raise Exception("This tool requires root permissions to run.")
+def iso_date(field):
+    """
+    Returns the ISO9660 date and time field (YYYYMMDDHHMMSScc) as
+    YYYY-MM-DDTHH:MM:SS, or None if it is not set.
+    """
+    if not field[:14].isdigit() or not field[:14].strip('0'):
+        return None
+    return '%s-%s-%sT%s:%s:%s' % (
+        field[0:4], field[4:6], field[6:8],
+        field[8:10], field[10:12], field[12:14],
+    )
 
-        # At this point we know enough about the command line options
-        # to test for verbose and if it is set we should re-initialize
-        # the logger to DEBUG.  This will have the effect of printing
-        # stack traces if there are any exceptions in this class.
-        if getattr(self.options, "verbose"):
-            self.__initLogger(logging.DEBUG)
 
-        self.load_config_file()
+def udf_tag(image, sector):
+    """
+    Returns the identifier of the UDF descriptor tag at sector of image,
+    or None if there is no valid tag there.
+    """
+    offset = sector * ISO_SECTOR_SIZE
+    if sector < 0 or offset + 16 > len(image):
+        return None
+    tag = image[offset:offset + 16]
+    checksum = sum(ord(c) for c in tag[:4] + tag[5:]) & 0xff
+    if checksum != ord(tag[4]):
+        return None
+    return struct.unpack('<H', tag[:2])[0]
 
-        if self.options:
-            # Need to parse again to override configuration file options
-            self.options, self.args = self.parser.parse_args(
-                values=self.options
+
+def udf_volume(image, file_size):
+    """
+    Reads the UDF anchor and primary volume descriptors of image.
+    Returns: (label, creation date)
+    """
+    last = file_size // ISO_SECTOR_SIZE - 1
+    if udf_tag(image, UDF_ANCHOR_SECTOR) != UDF_ANCHOR:
+        raise Exception(_('the UDF anchor volume descriptor is missing'))
+    # UDF records the anchor at sector 256 and at least at one of the
+    # last sector and 256 sectors before it.
+    if UDF_ANCHOR not in (
+        udf_tag(image, last),
+        udf_tag(image, last - UDF_ANCHOR_SECTOR),
+    ):
+        raise Exception(_('the UDF volume does not end with the file'))
+    offset = UDF_ANCHOR_SECTOR * ISO_SECTOR_SIZE
+    length, location = struct.unpack('<II', image[offset + 16:offset + 24])
+    label = created = None
+    for sector in range(location, location + length // ISO_SECTOR_SIZE):
+        tag = udf_tag(image, sector)
+        if tag == UDF_PRIMARY_VOLUME:
+            offset = sector * ISO_SECTOR_SIZE
+            ident = image[offset + 24:offset + 56]
+            used = ord(ident[-1])
+            if ident[0] == '\x08':
+                label = ident[1:used].decode('latin-1')
+            elif ident[0] == '\x10':
+                label = ident[1:used].decode('utf-16-be')
+            year, month, day, hour, minute, second = struct.unpack(
+                '<hBBBBB',
+                image[offset + 378:offset + 385]
             )
-            self.from_options(self.options, self.parser)
-            # Need to parse out options from the option groups.
-            self.from_option_groups(self.options, self.parser)
+            if year:
+                created = '%04d-%02d-%02dT%02d:%02d:%02d' % (
+                    year, month, day, hour, minute, second
+                )
+            break
+        if tag in (None, UDF_TERMINATING):
+            break
+    return (label, created)
 
-        if self.args:
-            self.from_args(self.args)
 
-        # Finally, all options from the command line and possibly
-        # a configuration file have been processed.  We need to
-        # re-initialize the logger if
-        # the user has supplied either --quiet processing or
-        # supplied a --log-file.
-        # This will ensure that any further log messages
-        # throughout the lifecycle
-        # of this program go to the log handlers that the
-        # user has specified.
-        if self.options.log_file or self.options.quiet:
-            level = logging.INFO
-            if self.options.verbose:
-                level = logging.DEBUG
-            self.__initLogger(level, self.options.quiet, self.options.log_file)
+def read_iso_metadata(filename):
+    """
+    Reads the ISO9660 volume descriptors, or the UDF ones for a UDF only
+    image, of filename through a memory map, only touching the few
+    sectors they are in.
+    Returns: a dictionary with the format, label, creation date, boot
+    catalog presence, volume size and file size of the image.
+    Raises: an Exception telling why filename is not a complete image.
+    """
+    file_size = os.path.getsize(filename)
+    first = ISO_FIRST_DESCRIPTOR * ISO_SECTOR_SIZE
+    if file_size < first + ISO_SECTOR_SIZE:
+        raise Exception(_('too small to be an ISO9660 or UDF image'))
+    with open(filename, 'rb') as src:
+        image = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        metadata = {
+            'format': None,
+            'label': None,
+            'created': None,
+            'bootable': False,
+            'volume_size': None,
+            'file_size': file_size,
+        }
+        udf = False
+        for n in range(ISO_MAX_DESCRIPTORS):
+            offset = first + n * ISO_SECTOR_SIZE
+            descriptor = image[offset:offset + ISO_SECTOR_SIZE]
+            if len(descriptor) < ISO_SECTOR_SIZE or \
+                    descriptor[1:6] not in ISO_DESCRIPTOR_IDS:
+                break
+            if descriptor[1:6] in ('NSR02', 'NSR03'):
+                udf = True
+            if descriptor[1:6] != 'CD001':
+                continue
+            kind = ord(descriptor[0])
+            if kind == 255:
+                continue
+            elif kind == 0:
+                if descriptor[7:39].rstrip('\0') == ISO_BOOT_SYSTEM:
+                    metadata['bootable'] = True
+            elif kind == 1 and metadata['format'] is None:
+                metadata['format'] = 'ISO9660'
+                metadata['label'] = descriptor[40:72].strip() or None
+                metadata['created'] = iso_date(descriptor[813:829])
+                blocks, = struct.unpack('<I', descriptor[80:84])
+                block_size, = struct.unpack('<H', descriptor[128:130])
+                metadata['volume_size'] = blocks * block_size
+        if udf:
+            if metadata['format'] is None:
+                metadata['format'] = 'UDF'
+                metadata['label'], metadata['created'] = udf_volume(
+                    image,
+                    file_size
+                )
+            else:
+                metadata['format'] = 'ISO9660/UDF'
+    finally:
+        image.close()
+    if metadata['format'] is None:
+        raise Exception(_('not an ISO9660 or UDF image'))
+    if metadata['volume_size'] > file_size:
+        raise Exception(
+            _(
+                'truncated, the volume is {volume} bytes but the file '
+                'is {size} bytes'
+            ).format(volume=metadata['volume_size'], size=file_size)
+        )
+    return metadata
 
-    def __missing__(self, key):
-        return None
 
-    def load_config_file(self):
-        """Loads the user-supplied config file or the system default.
-           If the user supplies a bad filename we will stop."""
+def select_for_deletion(inventory, patterns, keep_newest=0, older_than=0,
+                        now=None):
+    """
+    Selects the files of inventory, a dictionary of (size, mtime) by
+    name, matching any of the glob patterns.  The keep_newest most
+    recent matches of each retention_prefix are kept, and so are the
+    ones modified less than older_than days ago.
+    Returns: the sorted list of the names of the files to delete.
+    """
+    matched = [
+        name for name in inventory
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+    ]
+    if keep_newest:
+        groups = {}
+        for name in matched:
+            groups.setdefault(retention_prefix(name), []).append(name)
+        matched = []
+        for names in groups.values():
+            names.sort(key=lambda name: inventory[name][1], reverse=True)
+            matched.extend(names[keep_newest:])
+    if older_than:
+        limit = (now or time.time()) - older_than * 24 * 3600
+        matched = [name for name in matched if inventory[name][1] < limit]
+    return sorted(matched)
 
-        conf_file = DEFAULT_CONFIGURATION_FILE
 
-        if self.options and getattr(self.options, "conf_file"):
-            conf_file = self.options.conf_file
-            if (
-                not os.path.exists(conf_file) and
-                not os.path.exists("%s.d" % conf_file)
-            ):
-                raise Exception(
-                    (
-                        "The specified configuration file "
-                        "does not exist.  File=(%s)"
-                    ) % self.options.conf_file
-                )
+def run_parallel(func, items, workers=1):
+    """
+    Calls func on each of items from up to workers threads.
+    Returns: the list of the results, in the order of items.
+    """
+    results = [None] * len(items)
+    if workers <= 1 or len(items) <= 1:
+        for index, item in enumerate(items):
+            results[index] = func(item)
+        return results
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
 
-        self.from_file(conf_file)
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = func(item)
 
-    def from_option_groups(self, options, parser):
-        for optGrp in parser.option_groups:
-            for optGrpOpts in optGrp.option_list:
-                opt_value = getattr(options, optGrpOpts.dest)
-                if opt_value is not None:
-                    self[optGrpOpts.dest] = opt_value
+    threads = [
+        threading.Thread(target=worker)
+        for n in range(min(workers, len(items)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
 
-    def from_options(self, options, parser):
-        for option in parser.option_list:
-            if option.dest:
-                opt_value = getattr(options, option.dest)
-                if opt_value is not None:
-                    self[option.dest] = opt_value
 
-    def from_file(self, configFile):
-        import ConfigParser
-        import glob
+class UploadScheduler(object):
+    """
+    Orders the files of a batch according to a policy, and to priority
+    patterns matched first, and keeps track of the free space of each
+    destination: the space of the files being uploaded is reserved so
+    that parallel uploads never overcommit a domain, and the files that
+    can't fit anymore are deferred.
+    """
 
-        configs = []
-        configDir = '%s.d' % configFile
-        if os.path.exists(configFile):
-            configs.append(configFile)
-        configs += sorted(
-            glob.glob(
-                os.path.join(configDir, "*.conf")
+    def __init__(self, files, policy='given', priorities=(), sizes=None):
+        if policy not in SCHEDULE_POLICIES:
+            raise Exception(
+                _("%s is not a valid schedule.  Valid ones are %s.")
+                % (policy, ', '.join(SCHEDULE_POLICIES))
             )
-        )
+        if sizes is None:
+            sizes = dict((file, os.path.getsize(file)) for file in files)
+        self.sizes = sizes
 
-        cp = ConfigParser.ConfigParser()
-        cp.read(configs)
+        def rank(file):
+            for n, pattern in enumerate(priorities):
+                if fnmatch.fnmatch(os.path.basename(file), pattern):
+                    return n
+            return len(priorities)
 
-        # backward compatibility with existing setup
-        if cp.has_option('ISOUploader', 'rhevm'):
-            if not cp.has_option('ISOUploader', 'engine'):
-                cp.set(
-                    'ISOUploader',
-                    'engine',
-                    cp.get('ISOUploader', 'rhevm')
+        size = {
+            'given': lambda file: 0,
+            'smallest': lambda file: self.sizes[file],
+            'best-fit': lambda file: -self.sizes[file],
+        }[policy]
+        self.files = sorted(files, key=lambda file: (rank(file), size(file)))
+        self.free = {}
+        self.exempt = {}
+        self.reserved = {}
+        self.deferred = {}
+        self.lock = threading.Lock()
+
+    def add_destination(self, name, free, exempt=()):
+        """
+        Sets the free space of the destination name, in which the files
+        of exempt do not need any.
+        """
+        self.free[name] = free
+        self.exempt[name] = set(exempt)
+        self.deferred[name] = []
+
+    def reserve(self, name, file):
+        """
+        Reserves the space of file in the destination name.
+        Returns: False if it doesn't fit, in which case it is deferred.
+        """
+        with self.lock:
+            if name not in self.free or file in self.exempt[name]:
+                return True
+            if self.free[name] <= self.sizes[file]:
+                self.deferred[name].append(file)
+                return False
+            self.free[name] -= self.sizes[file]
+            self.reserved[(name, file)] = self.sizes[file]
+            return True
+
+    def release(self, name, file, used):
+        """
+        Gives the space reserved for file in the destination name back,
+        unless it was used.
+        """
+        with self.lock:
+            size = self.reserved.pop((name, file), 0)
+            if not used and name in self.free:
+                self.free[name] += size
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of the runs of the uploader.  They
+    are written, cumulated with the ones of the previous runs, to a
+    Prometheus textfile (for the textfile collector of node_exporter),
+    and/or pushed to a StatsD server as they change.
+    """
+
+    def __init__(self, textfile=None, statsd=None):
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        # What changed since the last flush, by sample: increments of
+        # the counters and histograms, values of the gauges
+        self.increments = collections.defaultdict(float)
+        self.values = {}
+        self.statsd = None
+        if statsd:
+            host, sep, port = statsd.rpartition(':')
+            try:
+                self.statsd = (host or 'localhost', int(port))
+            except ValueError:
+                raise Exception(
+                    _("%s is not a valid StatsD address") % statsd
                 )
-            cp.remove_option('ISOUploader', 'rhevm')
-        if cp.has_option('ISOUploader', 'engine-ca'):
-            if not cp.has_option('ISOUploader', 'cert-file'):
-                cp.set(
-                    'ISOUploader',
-                    'cert-file',
-                    cp.get('ISOUploader', 'engine-ca')
+            import socket
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @staticmethod
+    def sample(name, labels):
+        """
+        Returns the Prometheus name of the sample of name with labels.
+        """
+        if not labels:
+            return '%s_%s' % (METRICS_PREFIX, name)
+        return '%s_%s{%s}' % (
+            METRICS_PREFIX,
+            name,
+            ','.join(
+                '%s="%s"' % (
+                    key,
+                    str(value).replace('\\', '\\\\').replace(
+                        '"', '\\"'
+                    ).replace('\n', '\\n')
                 )
-            cp.remove_option('ISOUploader', 'engine-ca')
+                for key, value in sorted(labels.items())
+            )
+        )
 
-        # we want the items from the ISOUploader section only
-        try:
-            opts = [
-                "--%s=%s" % (k, v)
-                for k, v in cp.items("ISOUploader")
+    def push(self, name, value, kind, labels):
+        if self.statsd is None:
+            return
+        import socket
+        path = '.'.join(
+            [METRICS_PREFIX, name] + [
+                STATSD_NAME.sub('_', str(label))
+                for key, label in sorted(labels.items())
             ]
-            (new_options, args) = self.parser.parse_args(
-                args=opts,
-                values=self.options
+        )
+        try:
+            self.socket.sendto(
+                '%s:%s|%s' % (path, value, kind),
+                self.statsd
             )
-            self.from_option_groups(new_options, self.parser)
-            self.from_options(new_options, self.parser)
-        except ConfigParser.NoSectionError:
-            pass
+        except socket.error as e:
+            logging.debug('unable to send %s to StatsD: %s', path, e)
 
-    def from_args(self, args):
-        self.command = args[0]
-        if self.command not in Commands.ARY:
-            raise Exception(
-                _(
-                    "%s is not a valid command.  Valid commands "
-                    "are '%s' or '%s'."
-                ) % (
-                    self.command,
-                    Commands.LIST,
-                    Commands.UPLOAD
-                )
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.increments[self.sample(name, labels)] += value
+        self.push(name, value, 'c', labels)
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.values[self.sample(name, labels)] = value
+        self.push(name, value, 'g', labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Adds value to the histogram name.
+        """
+        with self.lock:
+            # Every bucket is written, even the empty ones
+            for bucket in METRICS_BUCKETS + ('+Inf', ):
+                self.increments[
+                    self.sample(name + '_bucket', dict(labels, le=bucket))
+                ] += int(bucket == '+Inf' or value <= bucket)
+            self.increments[self.sample(name + '_sum', labels)] += value
+            self.increments[self.sample(name + '_count', labels)] += 1
+        self.push(name, int(value * 1000), 'ms', labels)
+
+    @contextlib.contextmanager
+    def phase(self, phase, destination='', size=None):
+        """
+        Times the phase of an upload to destination, which moves size
+        bytes if it is a transfer.  Failed phases are not timed.
+        """
+        started = time.time()
+        yield
+        self.timed(phase, destination, time.time() - started, size)
+
+    def timed(self, phase, destination, elapsed, size=None):
+        self.observe(
+            'phase_duration_seconds',
+            elapsed,
+            phase=phase,
+            destination=destination
+        )
+        if size:
+            self.gauge(
+                'throughput_bytes_per_second',
+                int(size / max(elapsed, 0.001)),
+                destination=destination
             )
 
-        if self.command == Commands.UPLOAD:
-            if len(args) <= 1:
-                raise Exception(_("Files must be supplied for %s commands" %
-                                  (Commands.UPLOAD)))
-            for file in args[1:]:
-                self.files.append(file)
+    def flush(self):
+        """
+        Adds what changed since the last flush to the textfile, which is
+        replaced atomically.  Concurrent runs are serialized by a lock
+        on a file next to it.
+        """
+        if not self.textfile:
+            return
+        with self.lock:
+            increments, self.increments = (
+                self.increments,
+                collections.defaultdict(float)
+            )
+            values, self.values = self.values, {}
+        try:
+            with open(self.textfile + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                samples = {}
+                if os.path.exists(self.textfile):
+                    with open(self.textfile) as previous:
+                        for line in previous:
+                            if line.startswith('#') or not line.strip():
+                                continue
+                            sample, value = line.rsplit(' ', 1)
+                            samples[sample] = float(value)
+                for sample, value in increments.items():
+                    samples[sample] = samples.get(sample, 0) + value
+                samples.update(values)
+                self.write(samples)
+        except Exception as e:
+            logging.warning(
+                _('Unable to write the metrics to %s: %s'),
+                self.textfile,
+                e
+            )
 
-    def prompt(self, key, msg):
-        if key not in self:
-            self._prompt(raw_input, key, msg)
+    @staticmethod
+    def order(sample):
+        """
+        Sorts the buckets of a histogram by their upper bound.
+        """
+        match = METRICS_LE.search(sample)
+        return (
+            METRICS_LE.sub('', sample),
+            float(match.group(1)) if match else 0
+        )
 
-    def getpass(self, key, msg):
-        if key not in self:
-            self._prompt(getpass.getpass, key, msg)
+    def write(self, samples):
+        families = collections.defaultdict(list)
+        for sample in samples:
+            name = sample.split('{', 1)[0][len(METRICS_PREFIX) + 1:]
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                    name = name[:-len(suffix)]
+            families[name].append(sample)
+        temp = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(self.textfile)),
+            prefix='.%s.' % os.path.basename(self.textfile),
+            delete=False
+        )
+        try:
+            for name in sorted(families):
+                if name in METRICS:
+                    kind, help = METRICS[name]
+                    temp.write('# HELP %s_%s %s\n' % (
+                        METRICS_PREFIX, name, help
+                    ))
+                    temp.write('# TYPE %s_%s %s\n' % (
+                        METRICS_PREFIX, name, kind
+                    ))
+                for sample in sorted(families[name], key=self.order):
+                    value = samples[sample]
+                    temp.write('%s %s\n' % (
+                        sample,
+                        '%d' % value if value == int(value) else repr(value)
+                    ))
+            temp.close()
+            os.chmod(temp.name, 0644)
+            os.rename(temp.name, self.textfile)
+        except Exception:
+            temp.close()
+            os.unlink(temp.name)
+            raise
 
-    # This doesn't ask for CTRL+C to abort because KeyboardInterrupts don't
-    # seem to behave the same way every time. Take a look at the link:
-    # http://stackoverflow.com/questions/4606942/
-    #   why-cant-i-handle-a-keyboardinterrupt-in-python
-    def _prompt(self, prompt_function, key, msg=None):
-        value = get_from_prompt(
-            msg="Please provide the %s (CTRL+D to abort): " % msg,
-            prompter=prompt_function
+
+def write_json(path, data):
+    """
+    Replaces the file path with the JSON of data, atomically.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp = tempfile.NamedTemporaryFile(
+        dir=directory,
+        prefix='.%s.' % os.path.basename(path),
+        delete=False
+    )
+    with temp:
+        json.dump(
+            data,
+            temp,
+            indent=1,
+            separators=(',', ': '),
+            sort_keys=True
         )
-        if value:
-            self[key] = value
-        else:
-            raise self.SkipException
+    os.rename(temp.name, path)
 
-    def ensure(self, key, default=""):
-        if key not in self:
-            self[key] = default
 
-    def has_all(self, *keys):
-        return all(self.get(key) for key in keys)
+class ThroughputHistory(object):
+    """
+    The throughput of the uploads to each destination, in bytes on the
+    wire per second, kept across runs in a JSON file as a moving
+    average weighted towards the latest transfers.
+    """
 
-    def has_any(self, *keys):
-        return any(self.get(key) for key in keys)
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rates = {}
+        self.updated = set()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as src:
+                    self.rates = json.load(src)
+            except (IOError, ValueError) as e:
+                logging.warning(
+                    _('Ignoring the throughput history %s: %s'),
+                    path,
+                    e
+                )
 
-    def __ensure_path_to_file(self, file_):
-        dir_ = os.path.dirname(file_)
-        if not os.path.exists(dir_):
-            logging.info("%s does not exists. It will be created." % dir_)
-            os.makedirs(dir_, 0755)
+    def rate(self, name):
+        """
+        Returns the average throughput to the destination name, or None
+        if nothing was measured yet.
+        """
+        entry = self.rates.get(name)
+        return entry['rate'] if entry else None
 
-    def __log_to_file(self, file_, level):
+    def record(self, name, wire_bytes, elapsed):
+        if elapsed < HISTORY_MIN_SECONDS or wire_bytes <= 0:
+            return
+        rate = wire_bytes / elapsed
+        with self.lock:
+            entry = self.rates.get(name)
+            if entry:
+                rate = HISTORY_WEIGHT * rate + \
+                    (1 - HISTORY_WEIGHT) * entry['rate']
+            self.rates[name] = {
+                'rate': rate,
+                'transfers': (entry or {}).get('transfers', 0) + 1,
+                'updated': int(time.time()),
+            }
+            self.updated.add(name)
+
+    def save(self):
+        """
+        Writes the destinations updated by this run to the history file,
+        keeping the others as they are in the file now.
+        """
+        if not self.path or not self.updated:
+            return
         try:
-            self.__ensure_path_to_file(file_)
-            hdlr = logging.FileHandler(filename=file_, mode='w')
-            fmt = logging.Formatter(FILE_LOG_FORMAT, FILE_LOG_DSTMP)
-            hdlr.setFormatter(fmt)
-            logging.root.addHandler(hdlr)
-            logging.root.setLevel(level)
-        except Exception, e:
-            logging.error("Could not configure file logging: %s" % e)
+            rates = {}
+            if os.path.exists(self.path):
+                with open(self.path) as src:
+                    rates = json.load(src)
+            with self.lock:
+                for name in self.updated:
+                    rates[name] = self.rates[name]
+                self.updated = set()
+            write_json(self.path, rates)
+        except Exception as e:
+            logging.warning(
+                _('Unable to save the throughput history to %s: %s'),
+                self.path,
+                e
+            )
 
-    def __log_to_stream(self, level):
-        fmt = logging.Formatter(STREAM_LOG_FORMAT)
-        # Errors should always be there, on stderr
-        h_err = logging.StreamHandler(sys.stderr)
-        h_err.setLevel(logging.ERROR)
-        h_err.setFormatter(fmt)
-        logging.root.addHandler(h_err)
-        # Other logs should go to stdout
-        sh = logging.StreamHandler(sys.stdout)
-        sh.setLevel(level)
-        sh.setFormatter(fmt)
-        sh.addFilter(NotAnError())
-        logging.root.addHandler(sh)
 
-    def __initLogger(self, logLevel=logging.INFO, quiet=None, logFile=None):
+class RankingCache(object):
+    """
+    Rankings of candidates by key, best first, as probed by the last
+    run: the hosts of each local ISO domain, or the SSH ciphers of each
+    file server.  A ranking is trusted for ttl seconds, as long as the
+    candidates are the same.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.rankings = {}
+        if path and ttl > 0 and os.path.exists(path):
+            try:
+                with open(path) as src:
+                    self.rankings = json.load(src)
+            except (IOError, ValueError) as e:
+                logging.warning(
+                    _('Ignoring the cache %s: %s'),
+                    path,
+                    e
+                )
+
+    def get(self, key, candidates):
         """
-        Initialize the logger based on information supplied from the
-        command line or configuration file.
+        Returns the cached ranking of candidates for key, or None if
+        there is none or it is stale.
         """
-        # If you call basicConfig more than once without removing handlers
-        # it is effectively a noop. In this program it is possible to call
-        # __initLogger more than once as we learn information about what
-        # options the user has supplied in either the config file or
-        # command line; hence, we will need to load and unload the handlers
-        # to ensure consistently fomatted output.
-        log = logging.getLogger()
-        for h in list(log.handlers):
-            log.removeHandler(h)
+        entry = self.rankings.get(key)
+        if entry is None or \
+                time.time() - entry['updated'] > self.ttl or \
+                entry['candidates'] != sorted(candidates):
+            return None
+        return entry.get('ranking')
 
-        if quiet:
-            if logFile:
-                # Case: Quiet and log file supplied.  Log to only file
-                self.__log_to_file(logFile, logLevel)
-            else:
-                # If the user elected quiet mode *and* did not supply
-                # a file.  We will be *mostly* quiet but not completely.
-                # If there is an exception/error/critical we will print
-                # to stdout/stderr.
-                logging.basicConfig(
-                    level=logging.ERROR,
-                    format=STREAM_LOG_FORMAT
-                )
-        else:
-            if logFile:
-                # Case: Not quiet and log file supplied.
-                # Log to both file and stdout/stderr
-                self.__log_to_file(logFile, logLevel)
-                self.__log_to_stream(logLevel)
-            else:
-                # Case: Not quiet and no log file supplied.
-                # Log to only stdout/stderr
-                self.__log_to_stream(logLevel)
+    def put(self, key, candidates, ranking):
+        """
+        Caches ranking, the usable ones of candidates best first, for
+        key.
+        """
+        if not self.path or self.ttl <= 0:
+            return
+        self.rankings[key] = {
+            'candidates': sorted(candidates),
+            'ranking': ranking,
+            'updated': int(time.time()),
+        }
+        self.save()
+
+    def demote(self, key, candidate):
+        """
+        Moves candidate to the end of the cached ranking for key.
+        """
+        ranking = (self.rankings.get(key) or {}).get('ranking')
+        if not self.path or not ranking or candidate not in ranking:
+            return
+        ranking.remove(candidate)
+        ranking.append(candidate)
+        self.save()
 
+    def save(self):
+        try:
+            write_json(self.path, self.rankings)
+        except Exception as e:
+            logging.warning(
+                _('Unable to save the cache %s: %s'),
+                self.path,
+                e
+            )
 
-class ISOUploader(object):
 
-    def __init__(self, conf):
-        self.api = None
-        self.configuration = conf
-        self.caller = Caller(self.configuration)
-        if self.configuration.command == Commands.LIST:
-            self.list_all_ISO_storage_domains()
-        elif self.configuration.command == Commands.UPLOAD:
-            self.upload_to_storage_domain()
-        else:
-            raise Exception(_("A valid command was not specified."))
+def format_size(size):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'bytes':
+        return '%d %s' % (size, unit)
+    return '%.1f %s' % (size, unit)
 
-    def _initialize_api(self):
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % divmod(seconds, 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+
+
+class Inotify(object):
+    """
+    Watches directories for files written or moved into them through
+    inotify(7), called through ctypes.
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = self.get_errno()
+            raise OSError(err, 'inotify_init1: %s' % os.strerror(err))
+        # watch descriptor -> directory
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add(self, dir):
+        wd = self.libc.inotify_add_watch(
+            self.fd,
+            dir,
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF
+        )
+        if wd < 0:
+            err = self.get_errno()
+            raise OSError(err, os.strerror(err), dir)
+        self.watches[wd] = dir
+
+    def read(self):
         """
-        Make a RESTful request to the supplied oVirt Engine method.
+        Reads the pending events.
+        Returns: the list of (directory, name, mask) of the events, the
+        directory being None for a queue overflow.
         """
-        if not self.configuration:
-            raise Exception("No configuration.")
+        data = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            events.append((self.watches.get(wd), name, mask))
+        return events
 
-        with_kerberos = bool(self.configuration.get("kerberos"))
+    def close(self):
+        os.close(self.fd)
 
-        if self.api is None:
-            # The API has not been initialized yet.
-            try:
-                self.configuration.prompt(
-                    "engine",
-                    msg=_("hostname of oVirt Engine")
-                )
-                if not with_kerberos:
-                    self.configuration.prompt(
-                        "user",
-                        msg=_("REST API username for oVirt Engine")
-                    )
-                    self.configuration.getpass(
-                        "passwd",
-                        msg=(
-                            _(
-                                "REST API password for the %s oVirt "
-                                "Engine user"
-                            ) % self.configuration.get("user")
-                        )
-                    )
-            except Configuration.SkipException:
-                raise Exception(
-                    "Insufficient information provided to communicate with "
-                    "the oVirt Engine REST API."
-                )
 
-            url = "https://{engine}/ovirt-engine/api".format(
-                engine=self.configuration.get("engine"),
-            )
+def get_from_prompt(msg, default=None, prompter=raw_input):
+    try:
+        return prompter(msg)
+    except EOFError:
+        print
+        return default
 
-            try:
-                self.api = ovirtsdk4.Connection(
-                    url=url,
-                    username=self.configuration.get("user"),
-                    password=self.configuration.get("passwd"),
+
+class ExitCodes():
+    """
+    A simple psudo-enumeration class to hold the current and future exit codes
+    """
+    NOERR = 0
+    CRITICAL = 1
+    LIST_ISO_ERR = 2
+    UPLOAD_ERR = 3
+    CLEANUP_ERR = 4
+    exit_code = NOERR
+
+
+class Commands():
+    """
+    A simple psudo-enumeration class to facilitate command checking.
+    """
+    LIST = 'list'
+    UPLOAD = 'upload'
+    SYNC = 'sync'
+    DELETE = 'delete'
+    WATCH = 'watch'
+    ARY = [LIST, UPLOAD, SYNC, DELETE, WATCH]
+
+
+class NEISODomain(RuntimeError):
+    """"
+    This exception is raised when the user inputs a not existing ISO domain
+    """
+    pass
+
+
+class TransientError(RuntimeError):
+    """
+    This exception is raised when a command failed in a way that is
+    worth retrying: the SSH connection failed or the transfer stalled.
+    """
+    pass
+
+
+class CommandError(RuntimeError):
+    """
+    This exception is raised when a command fails.  It carries the
+    command, its exit status, the tail of its stderr (which is also its
+    message) and how long it ran.
+    """
+
+    def __init__(self, cmd, returncode, stderr, elapsed):
+        super(CommandError, self).__init__(stderr)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+
+class CommandConnectionError(CommandError, TransientError):
+    """
+    This exception is raised when ssh or scp could not reach the server.
+    """
+    pass
+
+
+class CommandStalled(CommandError, TransientError):
+    """
+    This exception is raised when a transfer is killed for making no
+    progress, see StallWatchdog.
+    """
+    pass
+
+
+class CommandTimeout(CommandError, TransientError):
+    """
+    This exception is raised when a command is killed for running longer
+    than its timeout.
+    """
+    pass
+
+
+def command_error(cmd, returncode, stderr, elapsed):
+    """
+    Returns the CommandError matching how cmd failed.
+    """
+    scp = os.path.basename(cmd.split()[0]) == os.path.basename(SCP)
+    if returncode == SSH_CONNECTION_ERROR or (
+        scp and
+        returncode == SCP_ERROR and
+        SCP_CONNECTION_ERROR.search(stderr)
+    ):
+        return CommandConnectionError(cmd, returncode, stderr, elapsed)
+    return CommandError(cmd, returncode, stderr, elapsed)
+
+
+class ImageTransferError(RuntimeError):
+    """
+    This exception is raised when the server of an image transfer
+    refuses a request.  It carries the method, the HTTP status (None if
+    there was no answer) and the body of the answer.
+    """
+
+    def __init__(self, method, status, body):
+        super(ImageTransferError, self).__init__(
+            '%s %s: %s' % (method, status, body.strip())
+        )
+        self.method = method
+        self.status = status
+        self.body = body
+
+
+class ImageTransferConnectionError(ImageTransferError, TransientError):
+    """
+    This exception is raised when the server of an image transfer could
+    not be reached, dropped the connection or failed (5xx).
+    """
+    pass
+
+
+def is_transient(e):
+    """
+    Tells whether the exception e is worth retrying.
+    """
+    if isinstance(e, TransientError):
+        return True
+    return (
+        isinstance(e, EnvironmentError) and
+        e.errno in TRANSIENT_ERRNOS
+    )
+
+
+class Destination(object):
+    """
+    An ISO storage domain or NFS export files are uploaded to.
+    """
+
+    def __init__(
+            self,
+            name,
+            transport,
+            address,
+            path,
+            remote_path='',
+            id=None,
+            domain_type=None,
+    ):
+        self.name = name
+        self.transport = transport
+        self.address = address
+        self.path = path
+        self.remote_path = remote_path
+        self.id = id
+        self.domain_type = domain_type
+        # The formatted SSH user, for SSH destinations
+        self.user = ''
+        # The local mount point, for NFS destinations
+        self.mount_point = None
+        # The other hosts of a local domain, best first, to fail over to
+        self.hosts = []
+
+
+def free_space(dir):
+    dir_stat = os.statvfs(dir)
+    return dir_stat.f_bavail * dir_stat.f_frsize
+
+
+def list_files(dir):
+    """
+    Returns the (size, mtime) of the regular files of dir by name,
+    leaving out the hidden ones (the temporary files of the uploads).
+    """
+    inventory = {}
+    for name in os.listdir(dir):
+        if name.startswith('.'):
+            continue
+        st = os.stat(os.path.join(dir, name))
+        if stat.S_ISREG(st.st_mode):
+            inventory[name] = (st.st_size, st.st_mtime)
+    return inventory
+
+
+def remove_files(dir, names):
+    """
+    Removes the given files of dir.
+    Returns: the dictionary of the error messages by file name, None
+    for the removed files.
+    """
+    results = {}
+    for name in names:
+        try:
+            os.remove(os.path.join(dir, name))
+            results[name] = None
+        except OSError as e:
+            results[name] = e.strerror
+    return results
+
+
+class NFSWorker(object):
+    """
+    A child process that drops to the UID and GID of the vdsm user once
+    and makes the file operations on the mounted NFS exports for the
+    uploader, which stays root and never switches its own identity.
+    The files the worker opens are passed back as file descriptors.  An
+    NFS client writes with the credentials of the opener, so the
+    uploader reads and writes them directly, from as many threads as it
+    likes.
+    """
+
+    # The operations the worker can be asked to make
+    operations = {
+        'exists': os.path.exists,
+        'free_space': free_space,
+        'rename': os.rename,
+        'remove': os.remove,
+        'list_files': list_files,
+        'remove_files': remove_files,
+    }
+
+    # The os.open flags of the modes files are opened in
+    modes = {
+        'rb': os.O_RDONLY,
+        'wb': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        'r+b': os.O_RDWR,
+    }
+
+    def __init__(self, uid, gid):
+        self.lock = threading.Lock()
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=self.serve,
+            args=(child, uid, gid)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def serve(self, conn, uid, gid):
+        from multiprocessing.reduction import send_handle
+        ignore_interrupts()
+        self.conn.close()
+        if os.getuid() == 0:
+            os.setgroups([])
+            os.setgid(gid)
+            os.setuid(uid)
+        os.umask(0137)  # Set to 640
+        while True:
+            try:
+                op, args = conn.recv()
+            except EOFError:
+                return
+            try:
+                if op == 'open':
+                    fd = os.open(args[0], self.modes[args[1]], 0666)
+                    try:
+                        conn.send((None, None))
+                        send_handle(conn, fd, None)
+                    finally:
+                        os.close(fd)
+                    continue
+                result = self.operations[op](*args)
+            except Exception as e:
+                conn.send((e, None))
+            else:
+                conn.send((None, result))
+
+    def request(self, op, *args):
+        """
+        Has the worker make op, and waits for its result.
+        Raises: the exception raised by op in the worker.
+        """
+        try:
+            self.conn.send((op, args))
+            error, result = self.conn.recv()
+            if error is None and op == 'open':
+                from multiprocessing.reduction import recv_handle
+                result = recv_handle(self.conn)
+        except (EOFError, IOError) as e:
+            raise Exception(
+                _("The NFS worker process exited (%s)") % (
+                    str(e) or self.process.exitcode
+                )
+            )
+        if error is not None:
+            raise error
+        return result
+
+    def call(self, op, *args):
+        with self.lock:
+            return self.request(op, *args)
+
+    def open(self, path, mode='rb'):
+        """
+        Opens path as the vdsm user.
+        Returns: the file object.
+        """
+        with self.lock:
+            fd = self.request('open', path, mode)
+        return os.fdopen(fd, mode)
+
+    def close(self):
+        self.conn.close()
+        self.process.join()
+
+
+class FileSink(object):
+    """
+    Fan-out sink writing to a file on a mounted NFS export.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.block_size = sparse_block_size(self.file.fileno())
+
+    def write(self, buf):
+        write_sparse(self.file, buf, len(buf), self.block_size)
+
+    def close(self):
+        try:
+            # Make sure the file ends where it should, even if padded out.
+            self.file.truncate()
+        finally:
+            self.file.close()
+
+    def abort(self):
+        # A write blocked on the NFS server can't be interrupted, the
+        # soft mount will eventually fail it.
+        pass
+
+
+class SSHSink(object):
+    """
+    Fan-out sink writing to the stdin of an SSH command, a Job started
+    with input=subprocess.PIPE.  The Job is waited for once, whether the
+    sink is closed or aborted.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.output = None
+        self.lock = threading.Lock()
+        self.waited = False
+
+    def write(self, buf):
+        try:
+            self.job.stdin.write(buf)
+        except IOError:
+            # The command died, how it failed tells why
+            self.wait()
+            raise
+
+    def wait(self):
+        with self.lock:
+            if self.waited:
+                return
+            self.waited = True
+            try:
+                self.job.stdin.close()
+            except IOError:
+                pass
+            self.output = self.job.wait()[0]
+
+    def close(self):
+        self.wait()
+
+    def abort(self):
+        self.job.kill()
+        try:
+            self.wait()
+        except Exception:
+            pass
+
+
+class ImageTransferClient(object):
+    """
+    Writes to the image of an image transfer through the HTTP API of its
+    imageio server.  Each thread using the client gets its own keep-alive
+    connection, reused by all its requests.
+    """
+
+    def __init__(self, url, ca_file=None, insecure=False):
+        import urlparse
+        import ssl
+        self.url = urlparse.urlsplit(url)
+        self.context = None
+        if self.url.scheme == 'https':
+            if insecure:
+                self.context = ssl._create_unverified_context()
+            else:
+                self.context = ssl.create_default_context(cafile=ca_file)
+        self.features = ()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import httplib
+            if self.context is not None:
+                conn = httplib.HTTPSConnection(
+                    self.url.hostname,
+                    self.url.port,
+                    context=self.context
+                )
+            else:
+                conn = httplib.HTTPConnection(
+                    self.url.hostname,
+                    self.url.port
+                )
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def reset(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+            with self.lock:
+                self.connections.remove(conn)
+
+    def request(self, method, body=None, headers=None, query=None):
+        """
+        Sends a request on the connection of the calling thread, which
+        is opened again the next time if the request fails.
+        Returns: the body of the answer.
+        Raises: an ImageTransferError if the request failed.
+        """
+        import httplib
+        import socket
+        path = self.url.path
+        if query:
+            path += '?' + query
+        try:
+            conn = self.connection()
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            self.reset()
+            raise ImageTransferConnectionError(method, None, str(e))
+        if response.getheader('connection', '').lower() == 'close':
+            self.reset()
+        if response.status >= 500:
+            raise ImageTransferConnectionError(method, response.status, data)
+        if response.status >= 400:
+            raise ImageTransferError(method, response.status, data)
+        return data
+
+    def options(self):
+        """
+        Asks the server which operations it supports.  Old proxies do
+        not answer OPTIONS and only get data.
+        """
+        try:
+            answer = json.loads(self.request('OPTIONS') or '{}')
+        except ImageTransferConnectionError:
+            raise
+        except (ImageTransferError, ValueError) as e:
+            logging.debug('OPTIONS not supported: %s', e)
+            answer = {}
+        self.features = tuple(answer.get('features', ()))
+        logging.debug('image transfer features: %s', self.features)
+
+    def put(self, offset, data):
+        """
+        Writes data at offset, leaving the flush to the end.
+        """
+        self.request(
+            'PUT',
+            data,
+            {
+                'Content-Range': 'bytes %d-%d/*' % (
+                    offset,
+                    offset + len(data) - 1
+                ),
+                'Content-Length': str(len(data)),
+            },
+            'flush=n' if 'flush' in self.features else None
+        )
+
+    def patch(self, **op):
+        self.request(
+            'PATCH',
+            json.dumps(op),
+            {'Content-Type': 'application/json'}
+        )
+
+    def write(self, buf, offset):
+        """
+        Writes buf at offset, the runs of zeros of at least
+        HTTP_ZERO_MIN_SIZE bytes as zero requests when the server supports
+        them, so that they are neither sent nor allocated.
+        """
+        pos = 0
+        if 'zero' in self.features:
+            for start, end in zero_ranges(
+                    buf,
+                    len(buf),
+                    HTTP_ZERO_MIN_SIZE,
+                    offset
+            ):
+                if start > pos:
+                    self.put(offset + pos, buffer(buf, pos, start - pos))
+                self.patch(
+                    op='zero',
+                    offset=offset + start,
+                    size=end - start,
+                    flush=False
+                )
+                pos = end
+        if len(buf) > pos:
+            self.put(offset + pos, buffer(buf, pos))
+
+    def flush(self):
+        if 'flush' in self.features:
+            self.patch(op='flush')
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+
+class FanOutStream(threading.Thread):
+    """
+    Drains the bounded queue of chunks of a fan-out destination into
+    its sink.  An empty chunk ends the stream.
+    """
+
+    def __init__(self, dest, dest_file, temp_dest_file, sink):
+        super(FanOutStream, self).__init__()
+        self.daemon = True
+        self.dest = dest
+        self.dest_file = dest_file
+        self.temp_dest_file = temp_dest_file
+        self.sink = sink
+        self.queue = Queue.Queue(FANOUT_BUFFERS)
+        self.error = None
+        self.detached = False
+        self.cancelled = False
+        # Since when the stream holds the others back, see tee()
+        self.behind_since = None
+
+    def stopped(self):
+        """
+        Tells whether the stream takes no more data: its sink failed, or
+        it was detached or cancelled.
+        """
+        return self.error is not None or self.detached or self.cancelled
+
+    def run(self):
+        # The queue is drained up to the end of the stream even once
+        # stopped, so that queueing the end never blocks
+        while True:
+            buf = self.queue.get()
+            if not self.stopped():
+                try:
+                    if buf:
+                        self.sink.write(buf)
+                    else:
+                        self.sink.close()
+                except Exception as e:
+                    self.error = e
+                    self.sink.abort()
+            if not buf:
+                return
+
+    def put(self, buf, timeout=None):
+        """
+        Queues buf, waiting up to timeout seconds for room in the queue,
+        or not at all if None.
+        Returns: whether buf was queued.
+        """
+        try:
+            if timeout is None:
+                self.queue.put_nowait(buf)
+            else:
+                self.queue.put(buf, timeout=timeout)
+        except Queue.Full:
+            return False
+        return True
+
+    def cancel(self):
+        """
+        Stops the stream, whose chunks are dropped instead of written.
+        """
+        self.cancelled = True
+
+    def join(self):
+        """
+        Ends the stream, and waits for its sink to be closed.  The sink
+        of a detached or cancelled stream is aborted instead, and waited
+        for only FANOUT_STALL_TIMEOUT.
+        """
+        abandoned = self.detached or self.cancelled
+        if abandoned:
+            self.sink.abort()
+            # Make room for the end of the stream
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+        self.queue.put('')
+        if abandoned:
+            super(FanOutStream, self).join(FANOUT_STALL_TIMEOUT)
+        else:
+            super(FanOutStream, self).join()
+
+
+class DigestThread(threading.Thread):
+    """
+    Computes the SHA256 digest of length bytes of a file from offset
+    (up to its end if length is None) in the background.
+    """
+
+    def __init__(self, file, offset=0, length=None):
+        super(DigestThread, self).__init__()
+        self.daemon = True
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.digest = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            digest = hashlib.sha256()
+            left = self.length
+            with open(self.file, 'rb') as src:
+                src.seek(self.offset)
+                while left is None or left > 0:
+                    size = HASH_BLOCK_SIZE
+                    if left is not None:
+                        size = min(size, left)
+                        left -= size
+                    block = src.read(size)
+                    if not block:
+                        break
+                    digest.update(block)
+            self.digest = digest.hexdigest()
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.digest
+
+
+class StallWatchdog(threading.Thread):
+    """
+    Kills procs when their I/O, as accounted in /proc/<pid>/io, stays
+    under min_rate bytes per second for timeout seconds.  This is what
+    ends a transfer whose SSH connection or NFS server hangs.
+    """
+
+    def __init__(self, procs, timeout, min_rate=0):
+        super(StallWatchdog, self).__init__()
+        self.daemon = True
+        self.procs = procs
+        self.timeout = timeout
+        self.min_rate = min_rate
+        self.stalled = False
+        self.done = threading.Event()
+        # pid -> bytes read and written, kept once the process is gone
+        self.seen = {}
+        self.start()
+
+    def io_bytes(self):
+        for proc in self.procs:
+            try:
+                with open('/proc/%d/io' % proc.pid) as io:
+                    total = 0
+                    for line in io:
+                        key, value = line.split(':')
+                        if key in ('rchar', 'wchar'):
+                            total += int(value)
+                self.seen[proc.pid] = total
+            except (IOError, ValueError):
+                pass
+        return sum(self.seen.values())
+
+    def run(self):
+        mark_time = time.time()
+        mark_bytes = self.io_bytes()
+        while not self.done.wait(STALL_POLL_INTERVAL):
+            now = time.time()
+            if now - mark_time < self.timeout:
+                continue
+            moved = self.io_bytes() - mark_bytes
+            if moved < max(1, self.min_rate * (now - mark_time)):
+                logging.debug(
+                    'stalled: %s bytes in %.0f seconds, killing %s',
+                    moved,
+                    now - mark_time,
+                    [proc.pid for proc in self.procs]
+                )
+                self.stalled = True
+                for proc in self.procs:
+                    try:
+                        proc.kill()
+                    except OSError:
+                        pass
+                return
+            mark_time = now
+            mark_bytes += moved
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+class TailBuffer(object):
+    """
+    Ring buffer keeping the last size bytes written to it.
+    """
+
+    def __init__(self, size=OUTPUT_TAIL_SIZE):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        return ''.join(self.chunks)[-self.size:]
+
+
+class Job(object):
+    """
+    A command, or a pipeline of commands, started by Caller.start and
+    running in the background.  The stdout of the last command goes to a
+    temporary file and the stderr of every command is logged as it comes
+    and kept in a TailBuffer, so memory use does not depend on how much
+    the commands print.  input, if given, is a string or an iterable of
+    strings fed to the first command by a thread, or subprocess.PIPE to
+    write to the stdin of the first command, the stdin attribute, and
+    close it before waiting for the Job.  A Job is killed when
+    it runs for more than timeout seconds, or when it stalls if watch is
+    given a function starting a StallWatchdog.  done is called once the
+    Job is over.
+    """
+
+    def __init__(self, argvs, input=None, watch=None, timeout=0,
+                 done=None):
+        self.cmd = ' | '.join(' '.join(argv) for argv in argvs)
+        self.started = time.time()
+        self.elapsed = None
+        self.procs = []
+        self.tails = []
+        self.threads = []
+        self.timed_out = False
+        self.error = None
+        self.timeout = timeout
+        self.watchdog = None
+        self.timer = None
+        self.done = done
+        self.stdin = None
+        prev = None
+        # done is called exactly once, here if the Job can't be started
+        try:
+            self.stdout = tempfile.TemporaryFile()
+            for n, argv in enumerate(argvs):
+                if prev is not None:
+                    stdin = prev.stdout
+                elif input is not None:
+                    stdin = subprocess.PIPE
+                else:
+                    stdin = None
+                proc = subprocess.Popen(
+                    argv,
+                    stdin=stdin,
+                    stdout=(
+                        self.stdout if n == len(argvs) - 1
+                        else subprocess.PIPE
+                    ),
+                    stderr=subprocess.PIPE,
+                    # Don't let other commands hold our pipes open
+                    close_fds=True
+                )
+                if prev is not None:
+                    # Only the next process has to hold the read end
+                    prev.stdout.close()
+                self.procs.append(proc)
+                prev = proc
+                tail = TailBuffer()
+                self.tails.append(tail)
+                self.background(self.drain, proc.pid, proc.stderr, tail)
+        except Exception:
+            self.kill()
+            self.finish()
+            raise
+        if input is subprocess.PIPE:
+            self.stdin = self.procs[0].stdin
+        elif input is not None:
+            self.background(self.feed, self.procs[0].stdin, input)
+        if watch is not None:
+            self.watchdog = watch(self.procs)
+        if timeout:
+            self.timer = threading.Timer(timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def background(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def drain(self, pid, pipe, tail):
+        for line in iter(lambda: pipe.readline(OUTPUT_TAIL_SIZE), ''):
+            tail.write(line)
+            logging.debug("STDERR[%s](%s)", pid, clip(line.rstrip()))
+        pipe.close()
+
+    def feed(self, pipe, input):
+        try:
+            if isinstance(input, basestring):
+                input = [input]
+            for chunk in input:
+                pipe.write(chunk)
+        except IOError as e:
+            # The command died, its stderr tells why
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                pipe.close()
+            except IOError:
+                pass
+
+    def kill(self):
+        for proc in self.procs:
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+
+    def expire(self):
+        logging.debug('%s timed out after %s seconds', self.cmd, self.timeout)
+        self.timed_out = True
+        self.kill()
+
+    def finish(self):
+        if self.elapsed is not None:
+            return
+        self.elapsed = time.time() - self.started
+        if self.done is not None:
+            self.done()
+
+    def wait(self):
+        """
+        Waits for the job to end.
+        Returns: (stdout, 0)
+        Raises: the CommandError telling why the job failed.
+        """
+        try:
+            for proc in self.procs:
+                proc.wait()
+            for thread in self.threads:
+                thread.join()
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            if self.watchdog is not None:
+                self.watchdog.stop()
+            self.finish()
+        self.stdout.seek(0)
+        stdout = self.stdout.read()
+        self.stdout.close()
+        failed = None
+        for proc, tail in zip(self.procs, self.tails):
+            logging.debug(
+                "returncode[%s](%s) after %.1fs",
+                proc.pid,
+                proc.returncode,
+                self.elapsed
+            )
+            if proc.returncode != 0 and failed is None:
+                failed = (proc.returncode, tail.getvalue())
+        logging.debug("STDOUT(%s)", clip(stdout))
+        if self.watchdog is not None and self.watchdog.stalled:
+            if self.watchdog.min_rate:
+                message = _(
+                    'stalled, less than %s KiB/s for %s seconds'
+                ) % (self.watchdog.min_rate / 1024, self.watchdog.timeout)
+            else:
+                message = _(
+                    'stalled, no progress for %s seconds'
+                ) % self.watchdog.timeout
+            raise CommandStalled(
+                self.cmd,
+                failed and failed[0],
+                message,
+                self.elapsed
+            )
+        if self.timed_out:
+            raise CommandTimeout(
+                self.cmd,
+                failed and failed[0],
+                _('timed out after %s seconds') % self.timeout,
+                self.elapsed
+            )
+        if self.error is not None:
+            raise self.error
+        if failed is not None:
+            raise command_error(self.cmd, failed[0], failed[1], self.elapsed)
+        return (stdout, 0)
+
+
+class PooledDigest(object):
+    """
+    The SHA256 digest of a file hashed by a BatchHasher, with the
+    interface of DigestThread.
+    """
+
+    def __init__(self, job):
+        self.job = job
+
+    def result(self):
+        # A timeout keeps the wait interruptible
+        while not self.job.ready():
+            self.job.wait(1)
+        return self.job.get()
+
+
+class BatchHasher(object):
+    """
+    Hashes the files of an upload batch in a pool of processes sized to
+    the available cores, so that several files are hashed at the same
+    time while the first ones are already being uploaded.  Files are
+    hashed in the order they are submitted, each by a single process:
+    the digests are compared with sha256sum files and with what the
+    file server computes, which are plain SHA256 digests, so a file
+    cannot be split into chunks hashed separately.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = int(processes or 0) or multiprocessing.cpu_count()
+        self.pool = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, files):
+        with self.lock:
+            for file in files:
+                if file in self.jobs:
+                    continue
+                if self.pool is None:
+                    logging.debug(
+                        'hashing with %s processes',
+                        self.processes
+                    )
+                    self.pool = multiprocessing.Pool(
+                        self.processes,
+                        ignore_interrupts
+                    )
+                self.jobs[file] = self.pool.apply_async(
+                    sha256_file,
+                    (file,)
+                )
+
+    def digest(self, file):
+        """
+        Returns: the PooledDigest of file, submitting it if needed.
+        """
+        self.submit([file])
+        return PooledDigest(self.jobs[file])
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+            self.jobs = {}
+
+
+class Caller(object):
+    """
+    Utility class for forking programs.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.slots = None
+        self.max_commands = None
+        # Held while reserving several slots at once
+        self.reserving = threading.Lock()
+
+    def prep(self, cmd):
+        _cmd = cmd % self.configuration
+        logging.debug('%s', clip(_cmd))
+        return shlex.split(_cmd)
+
+    def retries(self):
+        return int(self.configuration.get('retries') or 0)
+
+    def backoff(self, attempt):
+        """
+        Returns how long to wait before retrying after attempt failed:
+        exponential backoff with jitter, so that uploads that failed
+        together do not retry together.
+        """
+        delay = float(self.configuration.get('retry_delay') or 0)
+        return min(delay * 2 ** attempt, RETRY_MAX_DELAY) * \
+            random.uniform(0.5, 1.5)
+
+    def retry(self, func, what, transient=is_transient):
+        """
+        Calls func until it succeeds, retrying the failures transient
+        tells are worth it up to the configured number of retries.
+        Returns: what func returns.
+        """
+        retries = self.retries()
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                if attempt >= retries or not transient(e):
+                    raise
+                delay = self.backoff(attempt)
+                attempt += 1
+                logging.warning(
+                    _('%s failed (%s), retrying in %.1f seconds '
+                      '(%d of %d)'),
+                    what,
+                    str(e).strip(),
+                    delay,
+                    attempt,
+                    retries
+                )
+                time.sleep(delay)
+
+    def watch(self, procs):
+        """
+        Starts a StallWatchdog on procs, unless disabled.
+        """
+        timeout = int(self.configuration.get('stall_timeout') or 0)
+        if not timeout:
+            return None
+        min_rate = float(self.configuration.get('min_rate') or 0) * 1024
+        return StallWatchdog(procs, timeout, min_rate)
+
+    def limit(self):
+        """
+        Returns the semaphore bounding how many commands run at once.
+        """
+        with Caller.lock:
+            if self.slots is None:
+                self.max_commands = int(
+                    self.configuration.get('max_commands') or
+                    DEFAULT_MAX_COMMANDS
+                )
+                self.slots = threading.BoundedSemaphore(self.max_commands)
+        return self.slots
+
+    def reserve(self, count):
+        """
+        Takes up to count slots at once, for commands that must run
+        together: taken one by one, two such groups could each hold a
+        part of the slots and wait for the others forever.  Each
+        reserved slot is given back by a Job started with reserved set.
+        Returns: how many slots were taken, at most max_commands.
+        """
+        slots = self.limit()
+        count = min(count, self.max_commands)
+        with self.reserving:
+            for i in range(count):
+                slots.acquire()
+        return count
+
+    def start(self, cmds, input=None, watch=False, timeout=0,
+              reserved=False):
+        """
+        Uses the configuration to start cmds, a command or a list of
+        commands connected by pipes, once fewer than max_commands
+        commands are running, or on a slot taken by reserve if reserved
+        is set.
+        Returns: the running Job.
+        """
+        if isinstance(cmds, basestring):
+            cmds = [cmds]
+        slots = self.limit()
+        argvs = []
+        try:
+            for cmd in cmds:
+                _cmds = self.prep(cmd)
+                argvs.append(_cmds)
+        except Exception:
+            if reserved:
+                slots.release()
+            raise
+        if not reserved:
+            slots.acquire()
+        # The Job releases the slot, even if it fails to start
+        return Job(
+            argvs,
+            input=input,
+            watch=self.watch if watch else None,
+            timeout=timeout,
+            done=slots.release
+        )
+
+    def call(self, cmds, input=None, watch=False, transient=is_transient,
+             timeout=None):
+        """
+        Uses the configuration to fork a subprocess and run cmds.
+        input, if given, is either a string or an iterable of strings
+        that is fed to the stdin of the subprocess.  With watch, the
+        subprocess is killed if it stalls, otherwise after timeout
+        seconds (command_timeout if None, never if 0).  Unless its input
+        is streamed or it is watched, in which case the caller knows best
+        how to resume, a command failing in a way transient accepts is
+        retried.
+        """
+        if timeout is None:
+            timeout = 0 if watch else int(
+                self.configuration.get('command_timeout') or 0
+            )
+
+        def run():
+            return self.start(cmds, input, watch, timeout).wait()
+
+        if watch or not (input is None or isinstance(input, basestring)):
+            return run()
+        return self.retry(run, os.path.basename(cmds.split()[0]), transient)
+
+    def pipeline(self, *cmds):
+        """
+        Uses the configuration to fork one subprocess per command in cmds,
+        connecting the stdout of each one to the stdin of the next.
+        The pipeline is killed if it stalls.
+        """
+        return self.start(list(cmds), watch=True).wait()
+
+
+class Compression(object):
+    """
+    Chooses the compression level used to stream a file over SSH.
+    The compressibility of a file is estimated by compressing a few
+    samples of it, and the throughput of each link is learnt from the
+    transfers already made to it.  Compression is turned off when the
+    estimated transfer time is not better than sending the file raw.
+    """
+
+    def __init__(self, caller, name=DEFAULT_COMPRESSOR, level='auto'):
+        if name not in COMPRESSORS:
+            raise Exception(
+                _("%s is not a supported compressor.  Valid compressors "
+                  "are %s.") % (name, ', '.join(sorted(COMPRESSORS)))
+            )
+        self.caller = caller
+        self.name = name
+        (
+            self.binary,
+            self.compress_args,
+            self.decompress_args,
+            self.levels,
+            self.default_level,
+        ) = COMPRESSORS[name]
+        if level in (None, '', 'auto'):
+            self.level = None
+        else:
+            try:
+                self.level = int(level)
+            except ValueError:
+                raise Exception(
+                    _("%s is not a valid compression level") % level
+                )
+        # address -> bytes per second on the wire
+        self.link_rates = {}
+
+    def compress_command(self, level):
+        return '%s %s' % (self.binary, self.compress_args % level)
+
+    def decompress_command(self):
+        return '%s %s' % (self.binary, self.decompress_args)
+
+    def sample(self, filename, level):
+        """
+        Compresses a few chunks spread over filename.
+        Returns:
+          (ratio, compressor bytes per second)
+        """
+        file_size = os.path.getsize(filename)
+        count = min(
+            COMPRESS_SAMPLES,
+            max(1, file_size // COMPRESS_SAMPLE_SIZE)
+        )
+        step = file_size // count
+        chunks = []
+        with open(filename, 'rb') as src:
+            for i in range(count):
+                src.seek(i * step)
+                chunks.append(src.read(COMPRESS_SAMPLE_SIZE))
+        data = ''.join(chunks)
+        if not data:
+            return (1.0, 0)
+        job = self.caller.start(self.compress_command(level), input=data)
+        stdout = job.wait()[0]
+        # Timed from the start of the compressor, not from getting a slot
+        elapsed = max(job.elapsed, 1e-6)
+        ratio = float(len(stdout)) / len(data)
+        speed = len(data) / elapsed
+        logging.debug(
+            "%s level %s on %s: ratio(%.3f) speed(%.1f MB/s)",
+            self.name, level, filename, ratio, speed / 1024 / 1024
+        )
+        return (ratio, speed)
+
+    def choose_level(self, address, filename):
+        """
+        Returns the level filename should be compressed with on the way
+        to address, or None if it should be sent uncompressed.
+        The second element of the returned tuple is the expected
+        compressed/raw size ratio.
+        """
+        levels = self.levels if self.level is None else (self.level, )
+        link = self.link_rates.get(address)
+        best = None
+        for level in levels:
+            ratio, speed = self.sample(filename, level)
+            if ratio > COMPRESS_MAX_RATIO:
+                # Higher levels won't make this data compressible
+                break
+            if link is None:
+                # Nothing learnt about the link yet, go with the default
+                if self.level is not None or level >= self.default_level:
+                    return (level, ratio)
+                best = (level, ratio)
+                continue
+            # Seconds per raw byte, whichever of compressor and link is
+            # the bottleneck
+            cost = max(1.0 / speed, ratio / link)
+            if cost >= 1.0 / link:
+                # The compressor can't keep up with the link
+                break
+            if best is None or cost < best[2]:
+                best = (level, ratio, cost)
+        if best is None:
+            logging.debug(
+                "compression is not worth it for %s to %s",
+                filename, address
+            )
+            return (None, 1.0)
+        return best[:2]
+
+    def record(self, address, wire_bytes, elapsed):
+        if elapsed > 0 and wire_bytes > 0:
+            self.link_rates[address] = wire_bytes / elapsed
+            logging.debug(
+                "link to %s: %.1f MB/s",
+                address, self.link_rates[address] / 1024 / 1024
+            )
+
+
+class Configuration(dict):
+    """
+    This class is a dictionary subclass that knows how to read and
+    handle our configuration. Resolution order is defaults ->
+    configuration file -> command line options.
+    """
+
+    class SkipException(Exception):
+        "This exception is raised when the user aborts a prompt"
+        pass
+
+    def __init__(self,
+                 parser=None):
+        self.command = None
+        self.parser = parser
+        self.options = None
+        self.args = None
+        self.files = []
+
+        # Immediately, initialize the logger to the INFO log level and our
+        # logging format which is <LEVEL>: <MSG> and not the default of
+        # <LEVEL>:<UID: <MSG>
+        self.__initLogger(logging.INFO)
+
+        if not parser:
+            raise Exception("Configuration requires a parser")
+
+        # Parse the command line only once, into an empty Values so it
+        # holds just the options the user actually supplied; they are
+        # laid over the defaults now and over the configuration file
+        # once it has been read.
+        cmdline, self.args = self.parser.parse_args(values=Values())
+        self.options = self.parser.get_default_values()
+        self.__override(self.options, cmdline)
+
+        if os.geteuid() != 0:
+            raise Exception("This tool requires root permissions to run.")
+
+        # At this point we know enough about the command line options
+        # to test for verbose and if it is set we should re-initialize
+        # the logger to DEBUG.  This will have the effect of printing
+        # stack traces if there are any exceptions in this class.
+        if getattr(self.options, "verbose"):
+            self.__initLogger(logging.DEBUG)
+
+        self.load_config_file()
+
+        # Command line options override configuration file options
+        self.__override(self.options, cmdline)
+        self.from_options(self.options, self.parser)
+        # Need to parse out options from the option groups.
+        self.from_option_groups(self.options, self.parser)
+
+        if self.args:
+            self.from_args(self.args)
+
+        # Finally, all options from the command line and possibly
+        # a configuration file have been processed.  We need to
+        # re-initialize the logger if
+        # the user has supplied either --quiet processing or
+        # supplied a --log-file.
+        # This will ensure that any further log messages
+        # throughout the lifecycle
+        # of this program go to the log handlers that the
+        # user has specified.
+        if self.options.log_file or self.options.quiet:
+            level = logging.INFO
+            if self.options.verbose:
+                level = logging.DEBUG
+            self.__initLogger(level, self.options.quiet, self.options.log_file)
+
+    def __missing__(self, key):
+        return None
+
+    def __override(self, options, overrides):
+        for dest, value in vars(overrides).items():
+            setattr(options, dest, value)
+
+    def load_config_file(self):
+        """Loads the user-supplied config file or the system default.
+           If the user supplies a bad filename we will stop."""
+
+        conf_file = DEFAULT_CONFIGURATION_FILE
+
+        if self.options and getattr(self.options, "conf_file"):
+            conf_file = self.options.conf_file
+            if (
+                not os.path.exists(conf_file) and
+                not os.path.exists("%s.d" % conf_file)
+            ):
+                raise Exception(
+                    (
+                        "The specified configuration file "
+                        "does not exist.  File=(%s)"
+                    ) % self.options.conf_file
+                )
+
+        self.from_file(conf_file)
+
+    def from_option_groups(self, options, parser):
+        for optGrp in parser.option_groups:
+            for optGrpOpts in optGrp.option_list:
+                opt_value = getattr(options, optGrpOpts.dest)
+                if opt_value is not None:
+                    self[optGrpOpts.dest] = opt_value
+
+    def from_options(self, options, parser):
+        for option in parser.option_list:
+            if option.dest:
+                opt_value = getattr(options, option.dest)
+                if opt_value is not None:
+                    self[option.dest] = opt_value
+
+    def from_file(self, configFile):
+        import ConfigParser
+        import glob
+
+        configs = []
+        configDir = '%s.d' % configFile
+        if os.path.exists(configFile):
+            configs.append(configFile)
+        configs += sorted(
+            glob.glob(
+                os.path.join(configDir, "*.conf")
+            )
+        )
+
+        cp = ConfigParser.ConfigParser()
+        cp.read(configs)
+
+        # backward compatibility with existing setup
+        if cp.has_option('ISOUploader', 'rhevm'):
+            if not cp.has_option('ISOUploader', 'engine'):
+                cp.set(
+                    'ISOUploader',
+                    'engine',
+                    cp.get('ISOUploader', 'rhevm')
+                )
+            cp.remove_option('ISOUploader', 'rhevm')
+        if cp.has_option('ISOUploader', 'engine-ca'):
+            if not cp.has_option('ISOUploader', 'cert-file'):
+                cp.set(
+                    'ISOUploader',
+                    'cert-file',
+                    cp.get('ISOUploader', 'engine-ca')
+                )
+            cp.remove_option('ISOUploader', 'engine-ca')
+
+        # we want the items from the ISOUploader section only
+        try:
+            opts = [
+                "--%s=%s" % (k, v)
+                for k, v in cp.items("ISOUploader")
+            ]
+            self.parser.parse_args(
+                args=opts,
+                values=self.options
+            )
+        except ConfigParser.NoSectionError:
+            pass
+
+    def from_args(self, args):
+        self.command = args[0]
+        if self.command not in Commands.ARY:
+            raise Exception(
+                _(
+                    "%s is not a valid command.  Valid commands "
+                    "are '%s'."
+                ) % (
+                    self.command,
+                    "', '".join(Commands.ARY)
+                )
+            )
+
+        if self.command in (
+                Commands.UPLOAD,
+                Commands.SYNC,
+                Commands.DELETE,
+                Commands.WATCH,
+        ):
+            if len(args) <= 1:
+                raise Exception(_("Files must be supplied for %s commands" %
+                                  (self.command)))
+            for file in args[1:]:
+                self.files.append(file)
+
+    def prompt(self, key, msg):
+        if key not in self:
+            self._prompt(raw_input, key, msg)
+
+    def getpass(self, key, msg):
+        if key not in self:
+            self._prompt(getpass.getpass, key, msg)
+
+    # This doesn't ask for CTRL+C to abort because KeyboardInterrupts don't
+    # seem to behave the same way every time. Take a look at the link:
+    # http://stackoverflow.com/questions/4606942/
+    #   why-cant-i-handle-a-keyboardinterrupt-in-python
+    def _prompt(self, prompt_function, key, msg=None):
+        value = get_from_prompt(
+            msg="Please provide the %s (CTRL+D to abort): " % msg,
+            prompter=prompt_function
+        )
+        if value:
+            self[key] = value
+        else:
+            raise self.SkipException
+
+    def ensure(self, key, default=""):
+        if key not in self:
+            self[key] = default
+
+    def has_all(self, *keys):
+        return all(self.get(key) for key in keys)
+
+    def has_any(self, *keys):
+        return any(self.get(key) for key in keys)
+
+    def __ensure_path_to_file(self, file_):
+        dir_ = os.path.dirname(file_)
+        if not os.path.exists(dir_):
+            logging.info("%s does not exists. It will be created." % dir_)
+            os.makedirs(dir_, 0755)
+
+    def __log_to_file(self, file_, level):
+        try:
+            self.__ensure_path_to_file(file_)
+            hdlr = logging.FileHandler(filename=file_, mode='w')
+            fmt = logging.Formatter(FILE_LOG_FORMAT, FILE_LOG_DSTMP)
+            hdlr.setFormatter(fmt)
+            # The file may be on a slow volume, it is written in the
+            # background.  The console keeps its order with what is
+            # printed, as the progress bar.
+            logging.root.addHandler(QueuedHandler(hdlr))
+            logging.root.setLevel(level)
+        except Exception, e:
+            logging.error("Could not configure file logging: %s" % e)
+
+    def __log_to_stream(self, level):
+        fmt = logging.Formatter(STREAM_LOG_FORMAT)
+        # Errors should always be there, on stderr
+        h_err = logging.StreamHandler(sys.stderr)
+        h_err.setLevel(logging.ERROR)
+        h_err.setFormatter(fmt)
+        logging.root.addHandler(h_err)
+        # Other logs should go to stdout
+        sh = logging.StreamHandler(sys.stdout)
+        sh.setLevel(level)
+        sh.setFormatter(fmt)
+        sh.addFilter(NotAnError())
+        logging.root.addHandler(sh)
+
+    def __initLogger(self, logLevel=logging.INFO, quiet=None, logFile=None):
+        """
+        Initialize the logger based on information supplied from the
+        command line or configuration file.
+        """
+        # If you call basicConfig more than once without removing handlers
+        # it is effectively a noop. In this program it is possible to call
+        # __initLogger more than once as we learn information about what
+        # options the user has supplied in either the config file or
+        # command line; hence, we will need to load and unload the handlers
+        # to ensure consistently fomatted output.
+        log = logging.getLogger()
+        for h in list(log.handlers):
+            log.removeHandler(h)
+            if isinstance(h, QueuedHandler):
+                h.close()
+
+        if quiet:
+            if logFile:
+                # Case: Quiet and log file supplied.  Log to only file
+                self.__log_to_file(logFile, logLevel)
+            else:
+                # If the user elected quiet mode *and* did not supply
+                # a file.  We will be *mostly* quiet but not completely.
+                # If there is an exception/error/critical we will print
+                # to stdout/stderr.
+                logging.basicConfig(
+                    level=logging.ERROR,
+                    format=STREAM_LOG_FORMAT
+                )
+        else:
+            if logFile:
+                # Case: Not quiet and log file supplied.
+                # Log to both file and stdout/stderr
+                self.__log_to_file(logFile, logLevel)
+                self.__log_to_stream(logLevel)
+            else:
+                # Case: Not quiet and no log file supplied.
+                # Log to only stdout/stderr
+                self.__log_to_stream(logLevel)
+
+
+class ISOUploader(object):
+
+    catalog_lock = threading.Lock()
+
+    def __init__(self, conf):
+        self.api = None
+        # The connection to the engine is not thread safe
+        self.api_lock = threading.RLock()
+        self.configuration = conf
+        self.caller = Caller(self.configuration)
+        self.compression = None
+        if self.configuration.get('compress'):
+            self.compression = Compression(
+                self.caller,
+                self.configuration.get('compressor') or DEFAULT_COMPRESSOR,
+                self.configuration.get('compress_level'),
+            )
+        # address -> whether the remote decompressor is available
+        self._remote_compressor = {}
+        # file name -> metadata of the validated images
+        self._metadata = {}
+        self.hasher = BatchHasher(conf.get('hash_processes'))
+        # Makes the file operations on the NFS mounts, as the vdsm user
+        self.nfs = None
+        # Where the sockets of the shared SSH connections are, if any
+        self.control_dir = None
+        # Serializes the fail-overs of the local domains
+        self.hosts_lock = threading.Lock()
+        # The SSH cipher of each file server, with --ssh-cipher=auto
+        self._ciphers = {}
+        self.cipher_lock = threading.Lock()
+        self.metrics = Metrics(conf.get('metrics_file'), conf.get('statsd'))
+        self.history = ThroughputHistory(conf.get('history_file'))
+        # (address, file name) -> compressed/raw size ratio on the wire
+        self._ratios = {}
+        started = time.time()
+        exit_code = ExitCodes.CRITICAL
+        try:
+            if self.configuration.command == Commands.LIST:
+                self.list_all_ISO_storage_domains()
+            elif self.configuration.command == Commands.UPLOAD:
+                self.upload_to_storage_domain()
+            elif self.configuration.command == Commands.SYNC:
+                self.sync_storage_domain()
+            elif self.configuration.command == Commands.DELETE:
+                self.delete_from_storage_domain()
+            elif self.configuration.command == Commands.WATCH:
+                self.watch_directories()
+            else:
+                raise Exception(_("A valid command was not specified."))
+            exit_code = ExitCodes.exit_code
+        except SystemExit as e:
+            exit_code = e.code
+            raise
+        finally:
+            self.report_run(time.time() - started, exit_code)
+
+    def report_run(self, elapsed, exit_code):
+        command = self.configuration.command
+        self.metrics.count(
+            'runs_total',
+            command=command,
+            exit_code=exit_code
+        )
+        self.metrics.gauge(
+            'last_run_timestamp_seconds',
+            int(time.time()),
+            command=command
+        )
+        self.metrics.gauge(
+            'last_run_duration_seconds',
+            elapsed,
+            command=command
+        )
+        self.metrics.flush()
+        self.history.save()
+
+    @contextlib.contextmanager
+    def transfer(self, dest, filename, record=True):
+        """
+        Times the transfer of filename to dest.
+        """
+        started = time.time()
+        yield
+        self.transferred(dest, filename, time.time() - started, record)
+
+    def transferred(self, dest, filename, elapsed, record=True, sent=None):
+        """
+        Accounts for filename transferred to dest in elapsed seconds, in
+        the metrics and, if record is set, in the throughput history.
+        sent is the number of bytes put on the wire, estimated by
+        wire_bytes when unknown.
+        """
+        self.metrics.timed(
+            'transfer',
+            dest.name,
+            elapsed,
+            os.path.getsize(filename)
+        )
+        if record:
+            if sent is None:
+                sent = self.wire_bytes(dest, filename)
+            self.history.record(dest.name, sent, elapsed)
+
+    def wire_bytes(self, dest, filename):
+        """
+        Estimates how many bytes uploading filename to dest puts on the
+        wire: NFS copies and image transfers skip the holes of sparse
+        files, SSH transfers send them, compressed when --compress finds
+        it worth it.
+        """
+        st = os.stat(filename)
+        if dest.transport != 'ssh':
+            return min(st.st_size, st.st_blocks * 512)
+        key = (dest.address, filename)
+        if key not in self._ratios:
+            ratio = 1.0
+            if self.compression and \
+                    self.remote_compressor_ssh(dest.user, dest.address):
+                ratio = self.compression.choose_level(
+                    dest.address,
+                    filename
+                )[1]
+            self._ratios[key] = ratio
+        return int(st.st_size * self._ratios[key])
+
+    def _initialize_api(self):
+        """
+        Make a RESTful request to the supplied oVirt Engine method.
+        """
+        with self.api_lock:
+            return self._connect_api()
+
+    def _connect_api(self):
+        if not self.configuration:
+            raise Exception("No configuration.")
+
+        # The SDK and its pycurl/libxml stack are only loaded by the
+        # commands that actually talk to the engine.
+        import ovirtsdk4
+
+        with_kerberos = bool(self.configuration.get("kerberos"))
+
+        if self.api is None:
+            # The API has not been initialized yet.
+            try:
+                self.configuration.prompt(
+                    "engine",
+                    msg=_("hostname of oVirt Engine")
+                )
+                if not with_kerberos:
+                    self.configuration.prompt(
+                        "user",
+                        msg=_("REST API username for oVirt Engine")
+                    )
+                    self.configuration.getpass(
+                        "passwd",
+                        msg=(
+                            _(
+                                "REST API password for the %s oVirt "
+                                "Engine user"
+                            ) % self.configuration.get("user")
+                        )
+                    )
+            except Configuration.SkipException:
+                raise Exception(
+                    "Insufficient information provided to communicate with "
+                    "the oVirt Engine REST API."
+                )
+
+            url = "https://{engine}/ovirt-engine/api".format(
+                engine=self.configuration.get("engine"),
+            )
+
+            try:
+                self.api = ovirtsdk4.Connection(
+                    url=url,
+                    username=self.configuration.get("user"),
+                    password=self.configuration.get("passwd"),
                     ca_file=self.configuration.get("cert_file"),
                     insecure=bool(self.configuration.get("insecure")),
                     kerberos=with_kerberos,
                 )
-                svc = self.api.system_service().get()
-                pi = svc.product_info
-                if pi is not None:
-                    vrm = '%s.%s.%s' % (
-                        pi.version.major,
-                        pi.version.minor,
-                        pi.version.revision,
+                svc = self.api.system_service().get()
+                pi = svc.product_info
+                if pi is not None:
+                    vrm = '%s.%s.%s' % (
+                        pi.version.major,
+                        pi.version.minor,
+                        pi.version.revision,
+                    )
+                    logging.debug(
+                        "API Vendor(%s)\tAPI Version(%s)",
+                        pi.vendor,
+                        vrm
+                    )
+                else:
+                    logging.error(
+                        _("Unable to connect to REST API at {url}").format(
+                            url=url,
+                        )
+                    )
+                    return False
+            except ovirtsdk4.Error as e:
+                # this is the only exception raised by SDK :(
+                logging.error(
+                    _(
+                        "Unable to connect to REST API at {url} due to SDK "
+                        "error\nMessage: {e}"
+                    ).format(
+                        url=url,
+                        e=e,
+                    ),
+                )
+                return False
+            except Exception as e:
+                logging.error(
+                    _(
+                        "Unable to connect to REST API at {url}\n"
+                        "Message: {e}"
+                    ).format(
+                        url=url,
+                        e=e,
+                    )
+                )
+                return False
+        return True
+
+    def list_all_ISO_storage_domains(self):
+        """
+        List only the ISO storage domains in sorted format.
+        """
+        def get_name(ary):
+            return ary[0]
+
+        if not self._initialize_api():
+            sys.exit(ExitCodes.CRITICAL)
+
+        svc = self.api.system_service()
+        domainAry = svc.storage_domains_service().list()
+        if domainAry is not None:
+            isoAry = []
+            for domain in domainAry:
+                if domain.type.value == 'iso':
+                    status = domain.external_status
+                    if status is not None:
+                        isoAry.append(
+                            [
+                                domain.name,
+                                status.value
+                            ]
+                        )
+                    else:
+                        logging.debug(
+                            "the storage domain didn't "
+                            "have a status element."
+                        )
+            if len(isoAry) > 0:
+                isoAry.sort(key=get_name)
+                fmt = "%-25s | %s"
+                print fmt % (
+                    _("ISO Storage Domain Name"),
+                    _("ISO Domain Status")
+                )
+                print "\n".join(
+                    fmt % (name, status)
+                    for name, status in isoAry
+                )
+            else:
+                ExitCodes.exit_code = ExitCodes.LIST_ISO_ERR
+                logging.error(_("There are no ISO storage domains."))
+        else:
+            ExitCodes.exit_code = ExitCodes.LIST_ISO_ERR
+            logging.error(
+                _("There are no storage domains available.")
+            )
+
+    def get_host_and_path_from_ISO_domain(self, isodomain):
+        """
+        Given a valid ISO storage domain, this method will return its
+        UUID, storage type, the hostnames/IPs serving it and its path.
+        There are several hosts only for local domains, best first.
+        Returns:
+          (id, type, hosts, path)
+        """
+        if not self._initialize_api():
+            sys.exit(ExitCodes.CRITICAL)
+        svc = self.api.system_service()
+        sd = None
+        for domain in svc.storage_domains_service().list():
+            if domain.name == isodomain:
+                sd = domain
+        if sd is not None:
+            if sd.type.value != 'iso':
+                raise Exception(
+                    _("The %s storage domain supplied is not of type ISO") %
+                    isodomain
+                )
+            sd_uuid = sd.id
+            storage = sd.storage
+            if storage is not None:
+                domain_type = storage.type.value
+                if domain_type == 'localfs':
+                    hosts = svc.hosts_service().list(
+                        search="storage=%s" % isodomain
+                    )
+                    addresses = self.rank_hosts(
+                        isodomain,
+                        [host.address for host in hosts if host.address]
+                    )
+                else:
+                    addresses = [storage.address] if storage.address else []
+                path = storage.path
+                if not addresses:
+                    raise Exception(
+                        _(
+                            "An host was not found for "
+                            "the %s local ISO domain."
+                        ) % isodomain
+                    )
+            else:
+                raise Exception(
+                    _(
+                        "A storage element was not found for "
+                        "the %s ISO domain."
+                    ) % isodomain
+                )
+            logging.debug(
+                'id=%s address=%s path=%s' % (
+                    sd_uuid,
+                    ','.join(addresses),
+                    path
+                )
+            )
+            return (sd_uuid, domain_type, addresses, path)
+        else:
+            raise NEISODomain(
+                _("An ISO storage domain with a name of %s was not found.") %
+                isodomain
+            )
+
+    def ranking_cache(self, path):
+        try:
+            ttl = int(
+                self.configuration.get('host_cache_ttl') or
+                DEFAULT_HOST_CACHE_TTL
+            )
+        except ValueError:
+            raise Exception(
+                _("%s is not a valid number of seconds") %
+                self.configuration.get('host_cache_ttl')
+            )
+        return RankingCache(path, ttl)
+
+    def rank_hosts(self, domain, hosts):
+        """
+        Ranks the hosts serving the local ISO domain, best first.  Over
+        SSH, the hosts are probed in parallel, unless a password has to
+        be typed for each, and ranked by the time they would take to
+        receive HOST_RANK_SIZE bytes given their connection latency and
+        throughput; the unreachable ones are left out.  The ranking is
+        cached for --host-cache-ttl seconds.
+        Returns: the hosts, best first.
+        """
+        ssh_user = self.configuration.get('ssh_user')
+        if len(hosts) <= 1 or not ssh_user:
+            return hosts
+        cache = self.ranking_cache(HOST_CACHE_FILE)
+        ranking = cache.get(domain, hosts)
+        if ranking is not None:
+            logging.debug('cached ranking of %s: %s', domain, ranking)
+            return ranking
+        user = self.format_ssh_user(ssh_user)
+        workers = len(hosts) if self.configuration.get('key_file') else 1
+        probes = run_parallel(
+            lambda host: self.probe_host(user, host),
+            hosts,
+            workers
+        )
+        ranked = sorted(
+            (probe, host) for probe, host in zip(probes, hosts)
+            if probe is not None
+        )
+        if not ranked:
+            raise Exception(
+                _("None of the hosts of the %s local ISO domain (%s) "
+                  "can be reached") % (domain, ', '.join(hosts))
+            )
+        ranking = [host for probe, host in ranked]
+        logging.info(
+            _('Uploading to %s through %s'),
+            domain,
+            ranking[0]
+        )
+        cache.put(domain, hosts, ranking)
+        return ranking
+
+    def probe_host(self, user, address):
+        """
+        Measures the latency of an SSH connection to address, and the
+        throughput of a short transfer to it.
+        Returns: the estimated time to send HOST_RANK_SIZE bytes to
+        address, or None if it can't be reached.
+        """
+        try:
+            start = time.time()
+            self.send_probe(user, address, '')
+            latency = time.time() - start
+            start = time.time()
+            self.send_probe(user, address, os.urandom(HOST_PROBE_SIZE))
+            elapsed = time.time() - start
+        except Exception, e:
+            logging.warning(_('Unable to probe %s: %s'), address, e)
+            return None
+        # The second connection paid the latency too
+        rate = HOST_PROBE_SIZE / max(elapsed - latency, 1e-3)
+        logging.debug(
+            'probe of %s: latency(%.3fs) throughput(%.1f MB/s)',
+            address,
+            latency,
+            rate / (1024 * 1024)
+        )
+        return latency + HOST_RANK_SIZE / rate
+
+    def send_probe(self, user, address, data, cipher=None):
+        cmd = self.format_ssh_command()
+        if cipher:
+            cmd += '-c %s ' % cipher
+        cmd += '%s%s "%s > /dev/null"' % (user, address, CAT)
+        self.caller.call(
+            cmd,
+            input=data,
+            transient=lambda e: False,
+            timeout=HOST_PROBE_TIMEOUT
+        )
+
+    def reachable(self, user, address):
+        try:
+            self.send_probe(user, address, '')
+            return True
+        except Exception, e:
+            logging.debug('%s is unreachable: %s', address, e)
+            return False
+
+    def fail_over(self, dest, address, e):
+        """
+        Makes dest use the next host of its local domain instead of
+        address, which failed with e, and moves address to the end of
+        the cached ranking.
+        Returns: False if there is no other host to fail over to.
+        """
+        with self.hosts_lock:
+            if dest.address != address:
+                # Another upload failed over already
+                return True
+            if not dest.hosts:
+                return False
+            dest.address = dest.hosts.pop(0)
+            logging.warning(
+                _('%s failed on %s (%s), failing over to %s'),
+                dest.name,
+                address,
+                str(e).strip(),
+                dest.address
+            )
+            self.ranking_cache(HOST_CACHE_FILE).demote(dest.name, address)
+        return True
+
+    def get_data_domain(self, name):
+        """
+        Given the name of a data storage domain, returns its UUID and
+        storage type in a 2 tuple.
+        """
+        if not self._initialize_api():
+            sys.exit(ExitCodes.CRITICAL)
+        svc = self.api.system_service()
+        for domain in svc.storage_domains_service().list():
+            if domain.name != name:
+                continue
+            if domain.type.value != 'data':
+                raise Exception(
+                    _(
+                        "The %s storage domain supplied is not of type "
+                        "data, which image transfers require"
+                    ) % name
+                )
+            logging.debug(
+                'id=%s type=%s', domain.id, domain.storage.type.value
+            )
+            return (domain.id, domain.storage.type.value)
+        raise NEISODomain(
+            _("A data storage domain with a name of %s was not found.") %
+            name
+        )
+
+    def format_ssh_user(self, ssh_user):
+        if ssh_user and not ssh_user.endswith("@"):
+            return "%s@" % ssh_user
+        else:
+            return ssh_user or ""
+
+    def format_ssh_command(self, cmd=SSH, address=None):
+        """
+        Returns the ssh, or scp, command line with the options given,
+        for a command to address.  Probes leave address out, so that
+        they get a connection, and a cipher, of their own.
+        """
+        cmd = "%s " % cmd
+        port_flag = "-p" if cmd.startswith(SSH) else "-P"
+        if "ssh_port" in self.configuration:
+            cmd += port_flag + " %(ssh_port)s " % self.configuration
+        if "key_file" in self.configuration:
+            cmd += "-i %(key_file)s " % self.configuration
+        # Fail, and be retried, rather than hang on a dead connection
+        cmd += "-o ServerAliveInterval=%d -o ServerAliveCountMax=%d " % (
+            SSH_ALIVE_INTERVAL,
+            SSH_ALIVE_COUNT
+        )
+        if self.control_dir and address:
+            # Share one connection per server between the commands
+            cmd += "-o ControlMaster=auto -o ControlPath=%s " % (
+                os.path.join(self.control_dir, '%C')
+            )
+            cmd += "-o ControlPersist=%d " % WATCH_SSH_PERSIST
+        cipher = self.ssh_cipher(address)
+        if cipher:
+            cmd += "-c %s " % cipher
+        return cmd
+
+    def ssh_cipher(self, address):
+        """
+        Returns the cipher of the SSH connections to address, None for
+        the default one.  With --ssh-cipher=auto, the candidate ciphers
+        are ranked once per file server by their throughput, and the
+        ranking is cached for --host-cache-ttl seconds.
+        """
+        cipher = self.configuration.get('ssh_cipher')
+        if cipher != 'auto':
+            return cipher or None
+        if not address:
+            return None
+        with self.cipher_lock:
+            if address not in self._ciphers:
+                self._ciphers[address] = self.rank_ciphers(address)
+            return self._ciphers[address]
+
+    def rank_ciphers(self, address):
+        """
+        Sends CIPHER_PROBE_SIZE bytes to address through each of
+        SSH_CIPHERS, which measures the encryption on this host and the
+        decryption on the file server together.
+        Returns: the fastest cipher, or None if none of them works.
+        """
+        cache = self.ranking_cache(CIPHER_CACHE_FILE)
+        ranking = cache.get(address, SSH_CIPHERS)
+        if ranking is None:
+            user = self.format_ssh_user(self.configuration.get('ssh_user'))
+            data = os.urandom(CIPHER_PROBE_SIZE)
+            rates = []
+            for cipher in SSH_CIPHERS:
+                try:
+                    start = time.time()
+                    self.send_probe(user, address, data, cipher)
+                    elapsed = max(time.time() - start, 1e-3)
+                except Exception, e:
+                    logging.debug(
+                        'cipher %s to %s failed: %s', cipher, address, e
+                    )
+                    continue
+                logging.debug(
+                    'cipher %s to %s: %.1f MB/s',
+                    cipher,
+                    address,
+                    CIPHER_PROBE_SIZE / elapsed / (1024 * 1024)
+                )
+                rates.append((elapsed, cipher))
+            ranking = [rate[1] for rate in sorted(rates)]
+            cache.put(address, SSH_CIPHERS, ranking)
+        if not ranking:
+            logging.warning(
+                _('None of the SSH ciphers %s works with %s, using the '
+                  'default one'),
+                ', '.join(SSH_CIPHERS),
+                address
+            )
+            return None
+        logging.info(_('Using the %s SSH cipher for %s'), ranking[0], address)
+        return ranking[0]
+
+    def send_file_ssh(self, user, address, file, dest_file):
+        """
+        Transfers file to dest_file on the SSH server, either through
+        scp or, when requested and worth it, compressed on the wire and/or
+        striped over several concurrent SSH channels.  With --verify the
+        data is hashed on both ends while it is transferred.
+        """
+        level = None
+        ratio = 1.0
+        verify = bool(self.configuration.get('verify'))
+        if self.compression and self.remote_compressor_ssh(user, address):
+            level, ratio = self.compression.choose_level(address, file)
+        self._ratios[(address, file)] = ratio
+        file_size = os.path.getsize(file)
+        stripes = self.stripe_count(file_size)
+        start = time.time()
+        if stripes > 1:
+            self.send_striped_ssh(
+                user,
+                address,
+                file,
+                dest_file,
+                file_size,
+                stripes,
+                level,
+                verify
+            )
+        else:
+            self.send_whole_ssh(
+                user,
+                address,
+                file,
+                dest_file,
+                file_size,
+                level,
+                verify
+            )
+        if self.compression:
+            self.compression.record(
+                address,
+                file_size * ratio,
+                time.time() - start
+            )
+        if self.drop_cache(file):
+            with open(file, 'rb') as src:
+                drop_page_cache(src.fileno())
+
+    def send_whole_ssh(
+            self,
+            user,
+            address,
+            file,
+            dest_file,
+            file_size,
+            level=None,
+            verify=False,
+    ):
+        """
+        Sends file to dest_file on the SSH server in a single stream,
+        through scp when it is neither compressed nor verified.  A
+        transfer that fails in a transient way is retried, resuming after
+        the data that already reached the server, or from the start with
+        verify since the digest covers the whole file.
+        """
+        attempts = [0]
+
+        def send():
+            offset = 0
+            if attempts[0] and not verify:
+                offset = min(
+                    self.remote_size_ssh(user, address, dest_file),
+                    file_size
+                )
+                logging.info(
+                    _('Resuming the upload of %s at %s of %s bytes'),
+                    file,
+                    offset,
+                    file_size
+                )
+            attempts[0] += 1
+            if offset:
+                cmds = self.transfer_commands(
+                    user,
+                    address,
+                    file,
+                    dest_file,
+                    level,
+                    offset,
+                    file_size - offset
+                )
+                self.caller.pipeline(*cmds)
+            elif level is None and not verify:
+                cmd = self.format_ssh_command(SCP, address=address)
+                cmd += ' %s %s%s:%s' % (file, user, address, dest_file)
+                logging.debug('SCP command is (%s)' % cmd)
+                self.caller.call(cmd, watch=True)
+            else:
+                cmds = self.transfer_commands(
+                    user,
+                    address,
+                    file,
+                    dest_file,
+                    level,
+                    verify=verify
+                )
+                local = self.local_digest(file) if verify else None
+                stdout = self.caller.pipeline(*cmds)[0]
+                if verify:
+                    self.verify_digest(local.result(), stdout, dest_file)
+
+        self.caller.retry(send, _('upload of %s') % file)
+
+    def remote_size_ssh(self, user, address, file):
+        """
+        Returns the size of file on the SSH server, 0 if it is missing.
+        """
+        cmd = self.format_ssh_command(address=address)
+        cmd += ' %s%s "%s -e %s && %s -c %%%%s %s || echo 0"' % (
+            user,
+            address,
+            TEST,
+            file,
+            STAT,
+            file
+        )
+        logging.debug('Size command is (%s)', cmd)
+        return long(self.caller.call(cmd)[0].split()[-1])
+
+    def transfer_commands(
+            self,
+            user,
+            address,
+            file,
+            dest_file,
+            level=None,
+            offset=0,
+            length=None,
+            verify=False,
+    ):
+        """
+        Returns the commands of the pipeline sending length bytes of file
+        from offset to the same offset of dest_file on the SSH server, or
+        the whole file if length is None.  level is the compression level,
+        if any.  With verify, the receiving end prints the SHA256 digest
+        of what it wrote.
+        """
+        whole = length is None
+        if whole:
+            cmds = ['%s %s' % (
+                CAT if level is None
+                else self.compression.compress_command(level),
+                file
+            )]
+        else:
+            cmds = [(
+                '%s if=%s bs=%s iflag=skip_bytes,count_bytes '
+                'skip=%s count=%s status=none'
+            ) % (DD, file, STRIPE_BLOCK_SIZE, offset, length)]
+            if level is not None:
+                cmds.append(self.compression.compress_command(level))
+        if verify:
+            write = self.format_remote_python(
+                REMOTE_RECEIVE_SCRIPT,
+                dest_file,
+                offset,
+                'create' if whole else 'patch'
+            )
+        elif whole:
+            write = '%s > %s' % (CAT, dest_file)
+        else:
+            write = (
+                '%s of=%s bs=%s oflag=seek_bytes conv=notrunc '
+                'seek=%s status=none'
+            ) % (DD, dest_file, STRIPE_BLOCK_SIZE, offset)
+        if level is not None:
+            if whole and not verify:
+                write = '%s > %s' % (
+                    self.compression.decompress_command(),
+                    dest_file
+                )
+            else:
+                write = '%s | %s' % (
+                    self.compression.decompress_command(),
+                    write
+                )
+        cmd = self.format_ssh_command(address=address)
+        cmd += ' %s%s "%s"' % (user, address, write)
+        logging.debug('Transfer command is (%s)', cmd)
+        cmds.append(cmd)
+        return cmds
+
+    def local_digest(self, file):
+        """
+        Returns: the digest of file from the batch hasher if it was
+        submitted there, or a DigestThread computing it.
+        """
+        if self.hasher.jobs.get(file) is not None:
+            return self.hasher.digest(file)
+        return DigestThread(file)
+
+    def verify_digest(self, digest, output, dest_file):
+        """
+        Compares the local hex digest with the one printed by the
+        receiving end in output.
+        """
+        remote = output.split()[-1] if output and output.strip() else ''
+        if remote != digest:
+            raise Exception(
+                _(
+                    'verification of {file} failed: local digest {local}, '
+                    'remote digest {remote}'
+                ).format(
+                    file=dest_file,
+                    local=digest,
+                    remote=remote or '-',
+                )
+            )
+        logging.debug('%s verified, sha256 %s', dest_file, digest)
+
+    def format_remote_python(self, script, *args):
+        """
+        Returns the command running the python script with args, to be
+        embedded in a double quoted SSH command.  The script is base64
+        encoded so it does not need any quoting.
+        """
+        return (
+            """%s -c 'import base64; """
+            """exec(base64.b64decode(\\"%s\\"))' %s"""
+        ) % (
+            PYTHON,
+            base64.b64encode(script),
+            ' '.join(str(arg) for arg in args)
+        )
+
+    def format_ssh_python(self, user, address, script, *args):
+        """
+        Returns the command running the python script with args on the
+        SSH server.
+        """
+        cmd = self.format_ssh_command(address=address)
+        cmd += ' %s%s "%s" ' % (
+            user,
+            address,
+            self.format_remote_python(script, *args)
+        )
+        return cmd
+
+    def block_hashes(self, file, block_size=DELTA_BLOCK_SIZE):
+        """
+        Returns the list of the SHA1 hex digests of the blocks of file.
+        """
+        hashes = []
+        with open(file, 'rb') as src:
+            while True:
+                block = src.read(block_size)
+                if not block:
+                    break
+                hashes.append(hashlib.sha1(block).hexdigest())
+        return hashes
+
+    def _delta_stream(self, file, blocks, block_size=DELTA_BLOCK_SIZE):
+        """
+        Yields the (offset, length) headers and the data of the runs of
+        consecutive blocks of file, as read by REMOTE_PATCH_SCRIPT.
+        """
+        runs = []
+        for block in blocks:
+            if runs and runs[-1][1] == block:
+                runs[-1][1] = block + 1
+            else:
+                runs.append([block, block + 1])
+        with open(file, 'rb') as src:
+            file_size = os.fstat(src.fileno()).st_size
+            for first, last in runs:
+                offset = first * block_size
+                length = min((last - first) * block_size, file_size - offset)
+                if length <= 0:
+                    continue
+                yield DELTA_HEADER.pack(offset, length)
+                # A run can span most of the file: stream it by block
+                src.seek(offset)
+                while length:
+                    data = src.read(min(length, block_size))
+                    if not data:
+                        raise Exception(
+                            _('%s shrank while it was sent') % file
+                        )
+                    length -= len(data)
+                    yield data
+
+    def send_delta_ssh(self, user, address, file, dest_file, temp_dest_file):
+        """
+        Compares the blocks of file with the ones of the existing
+        dest_file on the SSH server, copies dest_file to temp_dest_file
+        on the server and only sends the blocks that changed into it.
+        Falls back to a full transfer if dest_file can't be hashed.
+        """
+        file_size = os.path.getsize(file)
+        cmd = self.format_ssh_python(
+            user,
+            address,
+            REMOTE_BLOCK_HASH_SCRIPT,
+            DELTA_BLOCK_SIZE,
+            dest_file
+        )
+        logging.debug('Block hash command is (%s)', cmd)
+        try:
+            # Hashing a large file takes as long as it takes
+            remote = self.caller.call(cmd, timeout=0)[0].split()
+        except Exception as e:
+            logging.warning(
+                _('Unable to compare %s with %s, sending it in full: %s'),
+                file,
+                dest_file,
+                str(e).strip()
+            )
+            return self.send_file_ssh(user, address, file, temp_dest_file)
+        local = self.block_hashes(file)
+        changed = [
+            i for i, digest in enumerate(local)
+            if i >= len(remote) or remote[i] != digest
+        ]
+        logging.info(
+            _('%s: %s of %s blocks changed'),
+            file,
+            len(changed),
+            len(local)
+        )
+        cmd = self.format_ssh_command(address=address)
+        cmd += ' %s%s "%s --sparse=always -f %s %s"' % (
+            user,
+            address,
+            CP,
+            dest_file,
+            temp_dest_file
+        )
+        logging.debug('Copy command is (%s)', cmd)
+        self.caller.call(cmd, timeout=0)
+        verify = bool(self.configuration.get('verify'))
+        cmd = self.format_ssh_python(
+            user,
+            address,
+            REMOTE_PATCH_SCRIPT,
+            file_size,
+            temp_dest_file
+        )
+        logging.debug('Patch command is (%s)', cmd)
+        local = self.local_digest(file) if verify else None
+        # Patching is idempotent, a failed patch is simply sent again
+        self.caller.retry(
+            lambda: self.caller.call(
+                cmd,
+                input=self._delta_stream(file, changed),
+                watch=True
+            ),
+            _('upload of %s') % file
+        )
+        if verify:
+            # The patched copy is hashed by a command of its own, which
+            # is not watched for stalls: it does no local I/O meanwhile.
+            cmd = self.format_ssh_python(
+                user,
+                address,
+                REMOTE_DIGEST_SCRIPT,
+                os.path.dirname(temp_dest_file)
+            )
+            logging.debug('Digest command is (%s)', cmd)
+            stdout = self.caller.call(
+                cmd,
+                input=os.path.basename(temp_dest_file),
+                timeout=0
+            )[0]
+            self.verify_digest(
+                local.result(),
+                stdout.split(' ', 1)[0],
+                temp_dest_file
+            )
+
+    def stripe_count(self, file_size):
+        """
+        Returns the number of SSH channels file_size bytes should be
+        striped over.  Stripes are never smaller than STRIPE_MIN_SIZE.
+        """
+        try:
+            stripes = int(self.configuration.get('ssh_stripes') or 1)
+        except ValueError:
+            raise Exception(
+                _("%s is not a valid stripe count") %
+                self.configuration.get('ssh_stripes')
+            )
+        return max(1, min(stripes, file_size // STRIPE_MIN_SIZE))
+
+    def send_striped_ssh(
+            self,
+            user,
+            address,
+            file,
+            dest_file,
+            file_size,
+            stripes,
+            level=None,
+            verify=False,
+    ):
+        """
+        Preallocates dest_file on the SSH server and fills it with
+        stripes concurrent SSH channels, each one writing its own offset
+        range.  A failed stripe is sent again up to stripe_retries times,
+        after a backoff delay.
+        With verify, each stripe is hashed on both ends.
+        """
+        # A temporary file left by a failed run must not leak into this
+        # one: the stripes are written in place and skip nothing.
+        cmd = self.format_ssh_command(address=address)
+        cmd += ' %s%s "%s -s 0 %s && (%s -l %s %s || %s -s %s %s)"' % (
+            user,
+            address,
+            TRUNCATE,
+            dest_file,
+            FALLOCATE,
+            file_size,
+            dest_file,
+            TRUNCATE,
+            file_size,
+            dest_file
+        )
+        logging.debug('Preallocate command is (%s)', cmd)
+        self.caller.call(cmd)
+
+        retries = int(self.configuration.get('stripe_retries') or 0)
+        stripe_size = -(-file_size // stripes)
+        errors = {}
+
+        def send_stripe(offset, length):
+            cmds = self.transfer_commands(
+                user,
+                address,
+                file,
+                dest_file,
+                level,
+                offset,
+                length,
+                verify
+            )
+            local = DigestThread(file, offset, length) if verify else None
+            for attempt in range(retries + 1):
+                try:
+                    stdout = self.caller.pipeline(*cmds)[0]
+                    if verify:
+                        self.verify_digest(
+                            local.result(),
+                            stdout,
+                            '%s@%s' % (dest_file, offset)
+                        )
+                    errors.pop(offset, None)
+                    return
+                except Exception as e:
+                    errors[offset] = e
+                    logging.debug(
+                        'stripe at %s of %s failed (attempt %s): %s',
+                        offset, file, attempt + 1, e
+                    )
+                    if attempt < retries:
+                        time.sleep(self.caller.backoff(attempt))
+
+        threads = []
+        for offset in range(0, file_size, stripe_size):
+            thread = threading.Thread(
+                target=send_stripe,
+                args=(offset, min(stripe_size, file_size - offset))
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise Exception(
+                "%s of %s stripes failed, last error: %s" % (
+                    len(errors),
+                    len(threads),
+                    str(errors.values()[-1]).strip()
+                )
+            )
+
+    def remote_compressor_ssh(self, user, address):
+        """
+        Checks once per address if the decompressor is available on the
+        SSH server.
+        """
+        if address not in self._remote_compressor:
+            available = self.exists_ssh(
+                user,
+                address,
+                self.compression.binary,
+            )
+            if not available:
+                logging.warning(
+                    _(
+                        '%s is not available on %s, files will be '
+                        'transferred uncompressed'
+                    ),
+                    self.compression.binary,
+                    address
+                )
+            self._remote_compressor[address] = available
+        return self._remote_compressor[address]
+
+    def format_nfs_command(self, address, export, dir):
+        cmd = '%s %s %s:%s %s' % (MOUNT, NFS_MOUNT_OPTS, address, export, dir)
+        logging.debug('NFS mount command (%s)' % cmd)
+        return cmd
+
+    def exists_nfs(self, file):
+        """
+        Check for file existence.  The file will be tested by the NFS
+        worker, as the vdsm user, which is important for NFS.
+        """
+        try:
+            return self.nfs.call('exists', file)
+        except Exception:
+            raise Exception("unable to test the existence of %s" % file)
+
+    def exists_ssh(self, user, address, file):
+        """
+        Given a ssh user, ssh server, and full path to a file on the
+        SSH server this command will test to see if it exists on the
+        target file server and return true if it does.  False otherwise.
+        """
+
+        cmd = self.format_ssh_command(address=address)
+        cmd += ' %s%s "%s -e %s"' % (user, address, TEST, file)
+        logging.debug(cmd)
+        returncode = 1
+        try:
+            stdout, returncode = self.caller.call(cmd)
+        except:
+            pass
+
+        if returncode == 0:
+            logging.debug("exists returning true")
+            return True
+        else:
+            logging.debug("exists returning false")
+            return False
+
+    def space_test_ssh(self, user, address, dir, file):
+        """
+        Function to test if the given file will fit on the given
+        remote directory.  This function will return the available
+        space in bytes of dir and the size of file.
+        """
+        dir_size = None
+        returncode = 1
+        cmd = self.format_ssh_command(address=address)
+        cmd += (
+            """ %s%s "%s -c 'import os; dir_stat = os.statvfs(\\"%s\\"); """
+            """print (dir_stat.f_bavail * dir_stat.f_frsize)'" """
+        ) % (user, address, PYTHON, dir)
+        logging.debug('Mount point size test command is (%s)' % cmd)
+        try:
+            dir_size, returncode = self.caller.call(cmd)
+        except Exception:
+            pass
+
+        if returncode == 0 and dir_size is not None:
+            # This simply means that the SSH command was successful.
+            dir_size = dir_size.strip()
+            file_size = os.path.getsize(file)
+            logging.debug(
+                "Size of %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
+                file, file_size, file_size / 1024, (file_size / 1024) / 1024
+            )
+            logging.debug(
+                "Available space in %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
+                dir, dir_size, float(dir_size) / 1024,
+                (float(dir_size) / 1024) / 1024
+            )
+            return (dir_size, file_size)
+        else:
+            raise Exception("unable to test the available space on %s" % dir)
+
+    def space_test_nfs(self, dir, file):
+        """
+        Checks to see if there is enough space in dir for file.
+        This function will return the available
+        space in bytes of dir and the size of file.
+        """
+        try:
+            dir_size = self.nfs.call('free_space', dir)
+        except Exception:
+            raise Exception(
+                "unable to test the available space on %s" % dir
+            )
+
+        file_size = os.path.getsize(file)
+        logging.debug(
+            "Size of %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
+            file, file_size, file_size / 1024, (file_size / 1024) / 1024
+        )
+        logging.debug(
+            "Available space in %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
+            dir, dir_size, dir_size / 1024, (dir_size / 1024) / 1024
+        )
+        return (dir_size, file_size)
+
+    def copyfileobj_sparse_progress(
+            self,
+            fsrc,
+            fdst,
+            length=16*1024,
+            make_sparse=True,
+            bar_length=40,
+            quiet=True,
+            buffers=0,
+            buffer_size=PIPELINE_BUFFER_SIZE,
+            drop_cache=False,
+            resume=None,
+    ):
+        """
+        copy data from file-like object fsrc to file-like object fdst
+        like shutils.copyfileobj does but supporting also
+        sparse file. It can print also a progress bar.
+        If buffers is set, reading and writing are overlapped through
+        a ring of that many reusable buffers of buffer_size bytes.
+        If drop_cache is set, the copied ranges of both files are dropped
+        from the page cache as the copy goes.
+        Holes are made at the block size of the filesystem of fdst,
+        whatever the size of the reads.
+        If resume is set, the copy starts at resume['offset'], and fdst
+        is synced every CHECKPOINT_INTERVAL bytes, moving resume['offset']
+        to where a failed copy can be resumed from.
+        """
+        offset = resume['offset'] if resume else 0
+        fsrc.seek(0, 2)  # move the cursor to the end of the file
+        end_val = fsrc.tell()
+        fsrc.seek(offset, 0)  # move back the cursor to the start offset
+        fdst.seek(offset, 0)
+        state = {'old_ipercent': -1, 'dropped': offset}
+        block_size = sparse_block_size(fdst.fileno()) if make_sparse else 0
+
+        def uncache(i=None):
+            # Up to i, or to the end of the files
+            length = 0 if i is None else i - state['dropped']
+            fdst.flush()
+            drop_page_cache(fsrc.fileno(), state['dropped'], length)
+            drop_page_cache(fdst.fileno(), state['dropped'], length)
+            state['dropped'] = i
+
+        def progress(i):
+            if resume is not None and \
+                    i - resume['offset'] >= CHECKPOINT_INTERVAL:
+                fdst.flush()
+                os.fdatasync(fdst.fileno())
+                resume['offset'] = i
+            if drop_cache and i - state['dropped'] >= DROP_CACHE_WINDOW:
+                uncache(i)
+            percent = min(float(i) / end_val, 1.0)
+            ipercent = int(round(percent * 100))
+            if not quiet and ipercent > state['old_ipercent']:
+                state['old_ipercent'] = ipercent
+                hashes = '#' * int(round(percent * bar_length))
+                spaces = ' ' * (bar_length - len(hashes))
+                sys.stdout.write(
+                    _(
+                        "\rUploading: [{h}] {n}%".format(
+                            h=hashes + spaces,
+                            n=ipercent,
+                        )
+                    )
+                )
+                sys.stdout.flush()
+
+        if buffers:
+            self._copy_pipelined(
+                fsrc,
+                fdst,
+                block_size,
+                buffers,
+                max(buffer_size, length),
+                progress
+            )
+        else:
+            i = offset
+            while 1:
+                buf = fsrc.read(length)
+                if not buf:
+                    break
+                if block_size:
+                    write_sparse(fdst, buf, len(buf), block_size)
+                else:
+                    fdst.write(buf)
+                i += len(buf)
+                progress(i)
+        if make_sparse:
+            # Make sure the file ends where it should, even if padded out.
+            fdst.truncate()
+        if drop_cache:
+            uncache()
+        if not quiet:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+    def _copy_pipelined(
+            self,
+            fsrc,
+            fdst,
+            block_size,
+            buffers,
+            buffer_size,
+            progress,
+    ):
+        """
+        A reader thread fills free buffers from fsrc while the calling
+        thread writes the filled ones to fdst, so that the source and the
+        destination are busy at the same time.  Holes are still made
+        every block_size bytes, if set.  Memory use is bounded by buffers
+        * buffer_size.
+        """
+        free = Queue.Queue()
+        filled = Queue.Queue()
+        stop = threading.Event()
+        for n in range(buffers):
+            free.put(bytearray(buffer_size))
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    buf = free.get()
+                    n = fsrc.readinto(buf)
+                    filled.put((buf, n))
+                    if not n:
+                        return
+            except Exception as e:
+                filled.put((None, e))
+
+        i = fsrc.tell()
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                buf, n = filled.get()
+                if buf is None:
+                    raise n
+                if not n:
+                    break
+                if block_size:
+                    write_sparse(fdst, buf, n, block_size)
+                else:
+                    fdst.write(buffer(buf, 0, n))
+                free.put(buf)
+                i += n
+                progress(i)
+        finally:
+            stop.set()
+            # Wake the reader up in case it is waiting for a buffer
+            free.put(bytearray(0))
+            thread.join()
+
+    def drop_cache(self, file):
+        """
+        Tells whether the copy of file should bypass the page cache.
+        """
+        mode = self.configuration.get('drop_cache') or 'auto'
+        if mode not in DROP_CACHE_MODES:
+            raise Exception(
+                _("%s is not a valid drop-cache mode.  Valid modes are %s.")
+                % (mode, ', '.join(DROP_CACHE_MODES))
+            )
+        if mode == 'auto':
+            return os.path.getsize(file) > DROP_CACHE_THRESHOLD
+        return mode == 'yes'
+
+    def copy_file(self, src_file_name, dest_file_name):
+        """
+        Copy a file from source to dest via file handles.  The destination
+        file will be opened by the NFS worker, as the vdsm user, and
+        written to through the file descriptor it passes back.
+        This odd copy operation is important when copying files over NFS.
+        Read the NFS spec if you want to figure out *why* you need to do this.
+        Returns: True if successful and false otherwise.
+        """
+        retVal = True
+        # The NFS mount is soft: a server that doesn't answer in time
+        # shows up as EIO, after which the copy is resumed.
+        resume = {'offset': 0} if self.caller.retries() else None
+        src = None
+        try:
+            src = open(src_file_name, 'r')
+            self.caller.retry(
+                lambda: self.resume_copy(src, dest_file_name, resume),
+                _('copy of %s') % src_file_name
+            )
+        except Exception, e:
+            retVal = False
+            logging.error(_("Problem copying %s to %s.  Message: %s" %
+                          (src_file_name, dest_file_name, e)))
+        finally:
+            if src is not None:
+                src.close()
+        return retVal
+
+    def resume_copy(self, src, dest_file_name, resume=None):
+        """
+        Copies the file object src to dest_file_name, from
+        resume['offset'] if resume is set.  Whatever was written past
+        that offset by a failed attempt is discarded.
+        """
+        offset = resume['offset'] if resume else 0
+        if offset:
+            logging.info(
+                _('Resuming the copy to %s at %s bytes'),
+                dest_file_name,
+                offset
+            )
+            dest = self.nfs.open(dest_file_name, 'r+b')
+            dest.truncate(offset)
+        else:
+            dest = self.nfs.open(dest_file_name, 'wb')
+        try:
+            self.copyfileobj_sparse_progress(
+                fsrc=src,
+                fdst=dest,
+                quiet=self.configuration.options.quiet,
+                buffers=(
+                    PIPELINE_BUFFERS
+                    if self.configuration.get('pipelined_copy')
+                    else 0
+                ),
+                drop_cache=self.drop_cache(src.name),
+                resume=resume,
+            )
+        finally:
+            # Closing flushes, which can fail on a soft mount as well
+            dest.close()
+
+    def rename_file_nfs(self, src_file_name, dest_file_name):
+        """
+        Rename a file from source to dest as the vdsm user, through the
+        NFS worker.  This is can be important on an NFS mount.
+        """
+        try:
+            logging.debug(
+                'Renaming {src} to {dest}'.format(
+                    src=src_file_name,
+                    dest=dest_file_name,
+                )
+            )
+            self.nfs.call('rename', src_file_name, dest_file_name)
+            success = True
+        except Exception, e:
+            success = False
+            logging.error(
+                _(
+                    'Problem renaming {src} to {dst}. Message: {msg}'
+                ).format(
+                    src=src_file_name,
+                    dst=dest_file_name,
+                    msg=e,
+                )
+            )
+            logging.error(
+                _(
+                    'Please ensure to have permissions for renaming files '
+                    'inside {directory}'
+                ).format(
+                    directory=os.path.dirname(dest_file_name)
+                )
+            )
+            ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+        return success
+
+    def rename_file_ssh(self, user, address, src_file_name, dest_file_name):
+        """
+        This method will remove a file via SSH.
+        """
+        cmd = self.format_ssh_command(address=address)
+        cmd += """ %s%s "%s %s %s" """ % (
+            user,
+            address,
+            MV,
+            src_file_name,
+            dest_file_name
+        )
+        logging.debug('Rename file command is (%s)' % cmd)
+        try:
+            # Not retried: the mv may have been made before the
+            # connection dropped
+            stdout, returncode = self.caller.call(
+                cmd,
+                transient=lambda e: False
+            )
+        except Exception:
+            raise Exception(
+                "unable to move file from %s to %s" % (
+                    src_file_name,
+                    dest_file_name
+                )
+            )
+
+    def remove_file_nfs(self, file_name):
+        """
+        Remove a file as the vdsm user, through the NFS worker.  This is
+        can be important on an NFS mount.
+        """
+        try:
+            self.nfs.call('remove', file_name)
+        except Exception, e:
+            logging.error(_("Problem removing %s.  Message: %s" %
+                          (file_name, e)))
+
+    def remove_file_ssh(self, user, address, file):
+        """
+        This method will remove a file via SSH.
+        """
+
+        cmd = self.format_ssh_command(address=address)
+        cmd += """ %s%s "%s %s" """ % (user, address, RM, file)
+        logging.debug('Remove file command is (%s)' % cmd)
+        try:
+            stdout, returncode = self.caller.call(cmd)
+        except Exception:
+            raise Exception("unable to remove %s" % file)
+
+    def refresh_iso_domain(self, id):
+        """
+        oVirt Engine scans and caches the list of files in each ISO domain.  It
+        does this on a predefined interval.  Poking the
+        /storagedomains/<id>/files
+        RESTful method will cause it to refresh that list.
+        """
+        if not self._initialize_api():
+            sys.exit(ExitCodes.CRITICAL)
+        try:
+            svc = self.api.system_service()
+            sd = svc.storage_domains_service().service(id)
+            if sd is not None:
+                with self.api_lock:
+                    sd.files_service().list()
+        except Exception, e:
+            logging.warn(
+                _(
+                    "failed to refresh the list of files available in the "
+                    "%s ISO storage domain. Please refresh the list manually "
+                    "using the 'Refresh' button in the oVirt Webadmin "
+                    "console."
+                ),
+                self.configuration.get('iso_domain')
+            )
+            logging.debug(e)
+
+    def get_destinations(self):
+        """
+        Returns the list of Destination the files should be uploaded to,
+        from the iso-domain or nfs-server options.  Both accept a comma
+        separated list of values.
+        """
+        iso_domains = split_list(self.configuration.get('iso_domain'))
+        nfs_servers = split_list(self.configuration.get('nfs_server'))
+        ssh_user = self.configuration.get('ssh_user')
+        http = self.configuration.get('http')
+        # Did the user give us enough info to do our work?
+        if iso_domains and nfs_servers:
+            raise Exception(
+                _("iso-domain and nfs-server are mutually exclusive options")
+            )
+        if ssh_user and nfs_servers:
+            raise Exception(
+                _("ssh-user and nfs-server are mutually exclusive options")
+            )
+        if http and (ssh_user or nfs_servers):
+            raise Exception(
+                _("http is mutually exclusive with ssh-user and nfs-server")
+            )
+        if http and self.configuration.command not in (
+                Commands.UPLOAD,
+                Commands.WATCH,
+        ):
+            raise Exception(
+                _("http is only supported by the upload and watch commands")
+            )
+        destinations = []
+        if iso_domains and http:
+            for domain in iso_domains:
+                (id, domain_type) = self.get_data_domain(domain)
+                destinations.append(
+                    Destination(
+                        name=domain,
+                        transport='http',
+                        address=self.configuration.get('engine'),
+                        path=domain,
+                        id=id,
+                        domain_type=domain_type,
                     )
-                    logging.debug(
-                        "API Vendor(%s)\tAPI Version(%s)",
-                        pi.vendor,
-                        vrm
+                )
+        elif iso_domains:
+            for iso_domain in iso_domains:
+                # Discover the hostname and path from the ISO domain.
+                iso_domain_data = self.get_host_and_path_from_ISO_domain(
+                    iso_domain
+                )
+                if iso_domain_data is None:
+                    raise Exception(
+                        _('Unable to get ISO domain data')
                     )
-                else:
-                    logging.error(
-                        _("Unable to connect to REST API at {url}").format(
-                            url=url,
-                        )
+                (id, domain_type, addresses, path) = iso_domain_data
+                dest = Destination(
+                    name=iso_domain,
+                    transport='ssh' if ssh_user else 'nfs',
+                    address=addresses[0],
+                    path=path,
+                    remote_path=os.path.join(id, DEFAULT_IMAGES_DIR),
+                    id=id,
+                    domain_type=domain_type,
+                )
+                dest.hosts = addresses[1:]
+                destinations.append(dest)
+        elif nfs_servers:
+            for mnt in nfs_servers:
+                (address, sep, path) = mnt.partition(':')
+                destinations.append(
+                    Destination(
+                        name=mnt,
+                        transport='nfs',
+                        address=address,
+                        path=path,
                     )
-                    return False
-            except ovirtsdk4.Error as e:
-                # this is the only exception raised by SDK :(
-                logging.error(
-                    _(
-                        "Unable to connect to REST API at {url} due to SDK "
-                        "error\nMessage: {e}"
-                    ).format(
-                        url=url,
-                        e=e,
-                    ),
                 )
-                return False
+        else:
+            raise Exception(
+                _("either iso-domain or nfs-server must be provided")
+            )
+        for dest in destinations:
+            if dest.transport == 'ssh':
+                dest.user = self.format_ssh_user(ssh_user)
+        return destinations
+
+    def mount_nfs(self, dest):
+        """
+        Mounts the NFS export of dest on a temporary directory.
+        """
+        dest.mount_point = tempfile.mkdtemp()
+        logging.debug('local NFS mount point is %s' % dest.mount_point)
+        cmd = self.format_nfs_command(
+            dest.address,
+            dest.path,
+            dest.mount_point
+        )
+        # mount.nfs does not tell timeouts from other failures
+        self.caller.call(cmd, transient=lambda e: True)
+
+    def umount_nfs(self, dest):
+        try:
+            cmd = '%s %s %s' % (UMOUNT, NFS_UMOUNT_OPTS, dest.mount_point)
+            logging.debug(cmd)
+            self.caller.call(cmd)
+            shutil.rmtree(dest.mount_point)
+        except Exception, e:
+            ExitCodes.exit_code = ExitCodes.CLEANUP_ERR
+            logging.debug(e)
+
+    def dest_dir(self, dest):
+        if dest.transport == 'ssh':
+            return os.path.join(dest.path, dest.remote_path)
+        return os.path.join(dest.mount_point, dest.remote_path)
+
+    def target_files(self, dest, filename):
+        """
+        Returns the final and the temporary names of filename in dest.
+        """
+        dest_dir = self.dest_dir(dest)
+        return (
+            os.path.join(dest_dir, os.path.basename(filename)),
+            os.path.join(dest_dir, '.%s' % os.path.basename(filename)),
+        )
+
+    def report_exists(self, dest, filename):
+        ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+        self.metrics.count(
+            'files_total',
+            destination=dest.name,
+            result='exists'
+        )
+        logging.error(
+            _(
+                '%s exists on %s.  Either remove it or supply '
+                'the --force option to overwrite it.'
+            ),
+            filename,
+            dest.address
+        )
+
+    def report_no_space(self, dest, filename, dir_size, file_size):
+        self.metrics.count(
+            'files_total',
+            destination=dest.name,
+            result='no_space'
+        )
+        logging.error(
+            _(
+                'There is not enough space in %s '
+                '(%s bytes) for %s (%s bytes)'
+            ),
+            dest.path,
+            dir_size,
+            filename,
+            file_size
+        )
+
+    def report_failure(self, dest, filename, e):
+        ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+        self.metrics.count(
+            'files_total',
+            destination=dest.name,
+            result='failure'
+        )
+        self.metrics.flush()
+        logging.error(
+            _(
+                'Unable to copy %s to ISO storage '
+                'domain on %s.'
+            ),
+            filename,
+            dest.name
+        )
+        logging.error(
+            _('Error message is "%s"'),
+            str(e).strip()
+        )
+
+    def report_success(self, dest, filename, refresh=True):
+        if refresh and dest.id is not None and dest.transport != 'http':
+            # Force oVirt Engine to refresh the list of files
+            # in the ISO domain
+            self.refresh_iso_domain(dest.id)
+        logging.info(
+            _('{f} uploaded successfully').format(
+                f=filename,
+            )
+        )
+        self.record_catalog(dest, filename)
+        st = os.stat(filename)
+        self.metrics.count(
+            'files_total',
+            destination=dest.name,
+            result='success'
+        )
+        self.metrics.count(
+            'uploaded_bytes_total',
+            st.st_size,
+            destination=dest.name
+        )
+        self.metrics.count(
+            'sparse_bytes_total',
+            max(0, st.st_size - st.st_blocks * 512),
+            destination=dest.name
+        )
+        self.metrics.flush()
+
+    def validate_file(self, filename):
+        """
+        Checks, before any byte of it is sent, that filename is a complete
+        ISO9660 or UDF image if it is named like one, and with
+        --checksums that it matches its checksum file.  The metadata of the
+        image is logged, and kept for the catalog.
+        Returns: the metadata, or None if filename is not checked.
+        Raises: an Exception if filename is not a valid image.
+        """
+        if self.configuration.get('checksums'):
+            self.check_sidecar(filename)
+        if self.configuration.get('skip_validation') or \
+                not filename.lower().endswith(ISO_EXTENSIONS):
+            return None
+        if filename not in self._metadata:
+            try:
+                with self.metrics.phase('validate'):
+                    metadata = read_iso_metadata(filename)
             except Exception as e:
-                logging.error(
-                    _(
-                        "Unable to connect to REST API at {url}\n"
-                        "Message: {e}"
-                    ).format(
-                        url=url,
-                        e=e,
-                    )
+                raise Exception(
+                    _('{f} is rejected: {e}').format(f=filename, e=e)
                 )
-                return False
-        return True
+            if metadata['volume_size'] is not None and \
+                    metadata['volume_size'] < metadata['file_size']:
+                logging.debug(
+                    '%s has %s bytes past its volume',
+                    filename,
+                    metadata['file_size'] - metadata['volume_size']
+                )
+            logging.info(
+                _('%s: %s image, label %s, created %s, %s'),
+                filename,
+                metadata['format'],
+                metadata['label'] or '-',
+                metadata['created'] or '-',
+                _('bootable') if metadata['bootable'] else _('not bootable')
+            )
+            self._metadata[filename] = metadata
+        return self._metadata[filename]
 
-    def list_all_ISO_storage_domains(self):
+    def check_sidecar(self, filename):
         """
-        List only the ISO storage domains in sorted format.
+        Compares the digest of filename with the one of its .sha256 or
+        SHA256SUMS file, if it has one.
+        Raises: an Exception if they differ.
         """
-        def get_name(ary):
-            return ary[0]
+        expected, sums = sidecar_digest(filename)
+        if expected is None:
+            logging.debug('%s has no checksum file', filename)
+            return
+        digest = self.hasher.digest(filename).result()
+        if digest != expected:
+            raise Exception(
+                _(
+                    '{f} is rejected: its SHA256 digest {digest} does not '
+                    'match {expected} from {sums}'
+                ).format(
+                    f=filename,
+                    digest=digest,
+                    expected=expected,
+                    sums=sums
+                )
+            )
+        logging.debug('%s matches %s', filename, sums)
 
-        if not self._initialize_api():
-            sys.exit(ExitCodes.CRITICAL)
+    def record_catalog(self, dest, filename):
+        """
+        Appends the metadata of the uploaded filename as a JSON line to
+        the catalog file, if one is configured.
+        """
+        catalog = self.configuration.get('catalog')
+        if not catalog:
+            return
+        entry = {
+            'file': os.path.basename(filename),
+            'source': os.path.abspath(filename),
+            'destination': dest.name,
+            'uploaded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        entry.update(
+            self._metadata.get(filename) or
+            {'file_size': os.path.getsize(filename)}
+        )
+        line = json.dumps(entry, sort_keys=True)
+        with ISOUploader.catalog_lock:
+            with open(catalog, 'a') as out:
+                out.write(line + '\n')
 
-        svc = self.api.system_service()
-        domainAry = svc.storage_domains_service().list()
-        if domainAry is not None:
-            isoAry = []
-            for domain in domainAry:
-                if domain.type.value == 'iso':
-                    status = domain.external_status
-                    if status is not None:
-                        isoAry.append(
-                            [
-                                domain.name,
-                                status.value
-                            ]
-                        )
-                    else:
-                        logging.debug(
-                            "the storage domain didn't "
-                            "have a status element."
-                        )
-            if len(isoAry) > 0:
-                isoAry.sort(key=get_name)
-                fmt = "%-25s | %s"
-                print fmt % (
-                    _("ISO Storage Domain Name"),
-                    _("ISO Domain Status")
+    def prepare_ssh(self, dest, filename):
+        """
+        Checks that filename can be uploaded to dest over SSH, removing
+        the existing file when forced.
+        Returns:
+          (dest_file, temp_dest_file, delta), or None if filename must
+          not be uploaded.
+        """
+        logging.debug('file (%s)' % filename)
+        self.validate_file(filename)
+        dest_file, temp_dest_file = self.target_files(dest, filename)
+        retVal = self.exists_ssh(dest.user, dest.address, dest_file)
+        if retVal and not self.configuration.get('force'):
+            self.report_exists(dest, filename)
+            return None
+        # A delta upload patches a copy of the
+        # existing file, which is replaced on rename.
+        delta = retVal and bool(self.configuration.get('delta'))
+        if retVal and not delta:
+            self.remove_file_ssh(dest.user, dest.address, dest_file)
+        (dir_size, file_size) = self.space_test_ssh(
+            dest.user,
+            dest.address,
+            dest.path,
+            filename
+        )
+        if long(dir_size) <= long(file_size):
+            self.report_no_space(dest, filename, dir_size, file_size)
+            return None
+        return (dest_file, temp_dest_file, delta)
+
+    def finalize_ssh(self, dest, temp_dest_file, dest_file):
+        """
+        Sets the ownership and the permissions of the uploaded
+        temp_dest_file and renames it to dest_file.
+        """
+        if dest.user == 'root@':
+            cmd = self.format_ssh_command(address=dest.address)
+            cmd += ' %s%s "%s %s:%s %s"' % (
+                dest.user,
+                dest.address,
+                CHOWN,
+                NUMERIC_VDSM_ID,
+                NUMERIC_VDSM_ID,
+                temp_dest_file
+            )
+            logging.debug('CHOWN command is (%s)', cmd)
+            self.caller.call(cmd)
+        # chmod the file to 640.  Do this for every
+        # user (i.e. root and otherwise)
+        cmd = self.format_ssh_command(address=dest.address)
+        cmd += ' %s%s "%s %s %s"' % (
+            dest.user,
+            dest.address,
+            CHMOD,
+            PERMS_MASK,
+            temp_dest_file
+        )
+        logging.debug('CHMOD command is (%s)', cmd)
+        self.caller.call(cmd)
+        self.rename_file_ssh(
+            dest.user,
+            dest.address,
+            temp_dest_file,
+            dest_file
+        )
+
+    def bulk_files(self, files):
+        """
+        Returns the ones of files small enough to be uploaded together to
+        the SSH destinations, with --bulk-max-size.  Verified and delta
+        uploads are made file by file.
+        """
+        try:
+            max_size = int(self.configuration.get('bulk_max_size') or 0)
+        except ValueError:
+            raise Exception(
+                _("%s is not a valid size") %
+                self.configuration.get('bulk_max_size')
+            )
+        if max_size <= 0 or \
+                self.configuration.get('verify') or \
+                self.configuration.get('delta'):
+            return []
+        small = [
+            file for file in files
+            if os.path.getsize(file) <= max_size * 1024 * 1024
+        ]
+        return small if len(small) > 1 else []
+
+    def upload_bulk_ssh(self, dest, files, scheduler):
+        """
+        Uploads files to dest in a single tar stream over one SSH
+        connection.  The file server unpacks them into temporary files,
+        sets their ownership and permissions, and renames them into
+        place once the whole stream is received.
+        Returns: whether each of files was uploaded, by file.
+        """
+        results = dict((file, False) for file in files)
+        batch = []
+        for file in files:
+            if not scheduler.reserve(dest.name, file):
+                continue
+            try:
+                self.validate_file(file)
+                batch.append(file)
+            except Exception, e:
+                scheduler.release(dest.name, file, False)
+                self.report_failure(dest, file, e)
+        if not batch:
+            return results
+        logging.info(
+            _('Uploading %d files to %s in a single stream'),
+            len(batch),
+            dest.name
+        )
+        cmd = self.format_ssh_python(
+            dest.user,
+            dest.address,
+            REMOTE_BULK_SCRIPT,
+            self.dest_dir(dest),
+            1 if self.configuration.get('force') else 0,
+            NUMERIC_VDSM_ID if dest.user == 'root@' else -1,
+            PERMS_MASK
+        )
+        start = time.time()
+        try:
+            with self.metrics.phase('transfer', dest.name):
+                stdout, returncode = self.caller.retry(
+                    lambda: self.caller.call(
+                        cmd,
+                        input=tar_stream(batch),
+                        watch=True
+                    ),
+                    os.path.basename(SSH)
                 )
-                print "\n".join(
-                    fmt % (name, status)
-                    for name, status in isoAry
+        except Exception, e:
+            for file in batch:
+                scheduler.release(dest.name, file, False)
+                self.report_failure(dest, file, e)
+            return results
+        self.history.record(
+            dest.name,
+            sum(scheduler.sizes[file] for file in batch),
+            time.time() - start
+        )
+        by_name = dict((os.path.basename(file), file) for file in batch)
+        for line in stdout.splitlines():
+            status, rest = line.split(' ', 1)
+            if status in ('nospace', 'error'):
+                detail, name = rest.split(' ', 1)
+            else:
+                name = rest
+            file = by_name.pop(name, None)
+            if file is None:
+                logging.debug('unexpected bulk status: %s', line)
+                continue
+            if status == 'ok':
+                results[file] = True
+                self.report_success(dest, file, refresh=False)
+            elif status == 'exists':
+                self.report_exists(dest, file)
+            elif status == 'nospace':
+                self.report_no_space(
+                    dest,
+                    file,
+                    detail,
+                    scheduler.sizes[file]
                 )
             else:
-                ExitCodes.exit_code = ExitCodes.LIST_ISO_ERR
-                logging.error(_("There are no ISO storage domains."))
-        else:
-            ExitCodes.exit_code = ExitCodes.LIST_ISO_ERR
-            logging.error(
-                _("There are no storage domains available.")
-            )
+                # The helper reports the errno, or None if there was none
+                if detail.isdigit():
+                    detail = os.strerror(int(detail))
+                self.report_failure(dest, file, detail)
+        for file in by_name.values():
+            self.report_failure(dest, file, _('not received'))
+        for file in batch:
+            scheduler.release(dest.name, file, results[file])
+        if any(results.values()) and dest.id is not None:
+            self.refresh_iso_domain(dest.id)
+        return results
+
+    def upload_file_ssh(self, dest, filename):
+        """
+        Uploads filename to dest over SSH.
+        Returns: True if successful and false otherwise.
+        """
+        logging.info(_("Start uploading %s "), filename)
+        address = dest.address
+        try:
+            with self.metrics.phase('prepare', dest.name):
+                target = self.prepare_ssh(dest, filename)
+            if target is None:
+                return False
+            dest_file, temp_dest_file, delta = target
+            # Delta uploads say nothing about the throughput of the link
+            with self.transfer(dest, filename, record=not delta):
+                if delta:
+                    self.send_delta_ssh(
+                        dest.user,
+                        dest.address,
+                        filename,
+                        dest_file,
+                        temp_dest_file
+                    )
+                else:
+                    self.send_file_ssh(
+                        dest.user,
+                        dest.address,
+                        filename,
+                        temp_dest_file
+                    )
+            with self.metrics.phase('finalize', dest.name):
+                self.finalize_ssh(dest, temp_dest_file, dest_file)
+            self.report_success(dest, filename)
+            return True
+        except Exception, e:
+            # Errors on the host itself are wrapped by the operations
+            if dest.hosts and (
+                    is_transient(e) or
+                    not self.reachable(dest.user, address)
+            ) and self.fail_over(dest, address, e):
+                return self.upload_file_ssh(dest, filename)
+            self.report_failure(dest, filename, e)
+            return False
 
-    def get_host_and_path_from_ISO_domain(self, isodomain):
+    def prepare_nfs(self, dest, filename):
         """
-        Given a valid ISO storage domain, this method will return the
-        hostname/IP, UUID, and path to the domain in a 3 tuple.
+        Checks that filename can be uploaded to the mounted dest,
+        removing the existing file when forced.
         Returns:
-          (host, id, path)
+          (dest_file, temp_dest_file), or None if filename must not be
+          uploaded.
+        """
+        self.validate_file(filename)
+        dest_file, temp_dest_file = self.target_files(dest, filename)
+        retVal = self.exists_nfs(dest_file)
+        if retVal and not self.configuration.get('force'):
+            self.report_exists(dest, filename)
+            return None
+        # Remove the file if it exists before
+        # checking space.
+        if retVal:
+            self.remove_file_nfs(dest_file)
+        (dir_size, file_size) = self.space_test_nfs(
+            self.dest_dir(dest),
+            filename
+        )
+        if dir_size <= file_size:
+            self.report_no_space(dest, filename, dir_size, file_size)
+            return None
+        return (dest_file, temp_dest_file)
+
+    def upload_file_nfs(self, dest, filename):
+        """
+        Uploads filename to the mounted dest.
+        Returns: True if successful and false otherwise.
         """
+        logging.info(_("Start uploading %s "), filename)
+        try:
+            with self.metrics.phase('prepare', dest.name):
+                target = self.prepare_nfs(dest, filename)
+            if target is None:
+                return False
+            dest_file, temp_dest_file = target
+            started = time.time()
+            if self.copy_file(filename, temp_dest_file):
+                self.transferred(dest, filename, time.time() - started)
+                with self.metrics.phase('finalize', dest.name):
+                    renamed = self.rename_file_nfs(temp_dest_file, dest_file)
+                if renamed:
+                    self.report_success(dest, filename)
+                    return True
+            self.metrics.count(
+                'files_total',
+                destination=dest.name,
+                result='failure'
+            )
+        except Exception, e:
+            self.report_failure(dest, filename, e)
+        return False
+
+    def http_connections(self):
+        try:
+            return max(1, int(
+                self.configuration.get('http_connections') or
+                DEFAULT_HTTP_CONNECTIONS
+            ))
+        except ValueError:
+            raise Exception(
+                _("%s is not a valid number of HTTP connections") %
+                self.configuration.get('http_connections')
+            )
+
+    def domain_service(self, dest):
         if not self._initialize_api():
             sys.exit(ExitCodes.CRITICAL)
-        svc = self.api.system_service()
-        sd = None
-        for domain in svc.storage_domains_service().list():
-            if domain.name == isodomain:
-                sd = domain
-        if sd is not None:
-            if sd.type.value != 'iso':
+        svc = self.api.system_service().storage_domains_service()
+        return svc.storage_domain_service(dest.id)
+
+    def domain_disks(self, dest):
+        """
+        Returns the disks of the data domain dest.
+        """
+        service = self.domain_service(dest).disks_service()
+        with self.api_lock:
+            return service.list()
+
+    def space_test_http(self, dest):
+        """
+        Returns the free space of the data domain dest, in bytes.
+        """
+        service = self.domain_service(dest)
+        with self.api_lock:
+            return long(service.get().available or 0)
+
+    def wait_for(self, check, what, timeout=TRANSFER_TIMEOUT):
+        """
+        Polls check until it returns a true value, which is returned.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.api_lock:
+                value = check()
+            if value:
+                return value
+            if time.time() > deadline:
                 raise Exception(
-                    _("The %s storage domain supplied is not of type ISO") %
-                    isodomain
-                )
-            sd_uuid = sd.id
-            storage = sd.storage
-            if storage is not None:
-                domain_type = storage.type.value
-                address = ''
-                if domain_type == 'localfs':
-                    hosts = svc.hosts_service().list(
-                        search="storage=%s" % isodomain
-                    )
-                    for host in hosts:
-                        address = host.address
-                else:
-                    address = storage.address
-                path = storage.path
-                if len(address) == 0:
-                    raise Exception(
-                        _(
-                            "An host was not found for "
-                            "the %s local ISO domain."
-                        ) % isodomain
+                    _("Timed out after %d seconds waiting for %s") % (
+                        timeout,
+                        what
                     )
-            else:
-                raise Exception(
-                    _(
-                        "A storage element was not found for "
-                        "the %s ISO domain."
-                    ) % isodomain
                 )
-            logging.debug(
-                'id=%s address=%s path=%s' % (sd_uuid, address, path)
-            )
-            return (sd_uuid, domain_type, address, path)
-        else:
-            raise NEISODomain(
-                _("An ISO storage domain with a name of %s was not found.") %
-                isodomain
-            )
-
-    def format_ssh_user(self, ssh_user):
-        if ssh_user and not ssh_user.endswith("@"):
-            return "%s@" % ssh_user
-        else:
-            return ssh_user or ""
-
-    def format_ssh_command(self, cmd=SSH):
-        cmd = "%s " % cmd
-        port_flag = "-p" if cmd.startswith(SSH) else "-P"
-        if "ssh_port" in self.configuration:
-            cmd += port_flag + " %(ssh_port)s " % self.configuration
-        if "key_file" in self.configuration:
-            cmd += "-i %(key_file)s " % self.configuration
-        return cmd
+            time.sleep(TRANSFER_POLL_INTERVAL)
 
-    def format_nfs_command(self, address, export, dir):
-        cmd = '%s %s %s:%s %s' % (MOUNT, NFS_MOUNT_OPTS, address, export, dir)
-        logging.debug('NFS mount command (%s)' % cmd)
-        return cmd
+    def prepare_http(self, dest, filename):
+        """
+        Checks that filename can be uploaded to the data domain dest.
+        Returns:
+          the list of the ids of the disks of the same name that it
+          replaces when forced, or None if filename must not be uploaded.
+        """
+        self.validate_file(filename)
+        name = os.path.basename(filename)
+        existing = [
+            disk.id for disk in self.domain_disks(dest)
+            if disk.name == name
+        ]
+        if existing and not self.configuration.get('force'):
+            self.report_exists(dest, filename)
+            return None
+        # The disks replaced are only removed once the new one is
+        # uploaded, so the space of both is needed.
+        free = self.space_test_http(dest)
+        file_size = os.path.getsize(filename)
+        if free <= file_size:
+            self.report_no_space(dest, filename, free, file_size)
+            return None
+        return existing
 
-    def exists_nfs(self, file, uid, gid):
+    def send_file_http(self, url, filename, file_size):
         """
-        Check for file existence.  The file will be tested as the
-        UID and GID provided which is important for NFS.
+        Writes filename to the image behind the transfer url, in ranges
+        of HTTP_RANGE_SIZE bytes sent concurrently over http_connections
+        keep-alive connections.  A failed range is sent again.
         """
+        client = ImageTransferClient(
+            url,
+            self.configuration.get('cert_file'),
+            bool(self.configuration.get('insecure'))
+        )
+        ranges = Queue.Queue()
+        for offset in range(0, file_size, HTTP_RANGE_SIZE):
+            ranges.put(offset)
+        errors = []
+
+        def send_range(offset):
+            end = min(offset + HTTP_RANGE_SIZE, file_size)
+            with open(filename, 'rb') as file:
+                file.seek(offset)
+                while offset < end:
+                    buf = file.read(min(HTTP_CHUNK_SIZE, end - offset))
+                    if not buf:
+                        raise Exception(
+                            _("%s was truncated during the upload") %
+                            filename
+                        )
+                    client.write(buf, offset)
+                    offset += len(buf)
+
+        def worker():
+            while not errors:
+                try:
+                    offset = ranges.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.caller.retry(
+                        lambda: send_range(offset),
+                        'range at %s of %s' % (offset, filename)
+                    )
+                except Exception as e:
+                    errors.append(e)
+
         try:
-            os.setegid(gid)
-            os.seteuid(uid)
-            return os.path.exists(file)
-        except Exception:
-            raise Exception("unable to test the available space on %s" % dir)
+            self.caller.retry(client.options, 'OPTIONS %s' % url)
+            threads = []
+            for i in range(min(self.http_connections(), ranges.qsize())):
+                thread = threading.Thread(target=worker)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            self.caller.retry(client.flush, 'flush of %s' % filename)
         finally:
-            os.seteuid(0)
-            os.setegid(0)
+            client.close()
 
-    def exists_ssh(self, user, address, file):
+    def send_image_http(self, dest, filename):
         """
-        Given a ssh user, ssh server, and full path to a file on the
-        SSH server this command will test to see if it exists on the
-        target file server and return true if it does.  False otherwise.
+        Creates a disk for filename in the data domain dest and fills it
+        through an upload image transfer.  The disk is removed if the
+        transfer fails.
         """
+        import ovirtsdk4
+        import ovirtsdk4.types as types
 
-        cmd = self.format_ssh_command()
-        cmd += ' %s%s "%s -e %s"' % (user, address, TEST, file)
-        logging.debug(cmd)
-        returncode = 1
+        svc = self.api.system_service()
+        file_size = os.path.getsize(filename)
+        disk = types.Disk(
+            name=os.path.basename(filename),
+            description=_('Uploaded by %s') % APP_NAME,
+            format=types.DiskFormat.RAW,
+            provisioned_size=file_size,
+            sparse=dest.domain_type not in BLOCK_STORAGE_TYPES,
+            storage_domains=[types.StorageDomain(id=dest.id)],
+        )
+        if hasattr(types, 'DiskContentType'):
+            # Engines from 4.3 offer the disk to the CD-ROM of VMs
+            disk.content_type = types.DiskContentType.ISO
+        with self.api_lock:
+            disk = svc.disks_service().add(disk)
+        disk_service = svc.disks_service().disk_service(disk.id)
+        transfer_service = None
         try:
-            stdout, returncode = self.caller.call(cmd)
-        except:
-            pass
+            self.wait_for(
+                lambda: disk_service.get().status == types.DiskStatus.OK,
+                _('the disk of %s') % filename
+            )
+            transfers = svc.image_transfers_service()
+            with self.api_lock:
+                transfer = transfers.add(
+                    types.ImageTransfer(
+                        disk=types.Disk(id=disk.id),
+                        direction=types.ImageTransferDirection.UPLOAD,
+                    )
+                )
+            transfer_service = transfers.image_transfer_service(transfer.id)
 
-        if returncode == 0:
-            logging.debug("exists returning true")
-            return True
-        else:
-            logging.debug("exists returning false")
-            return False
+            def started():
+                transfer = transfer_service.get()
+                if transfer.phase != types.ImageTransferPhase.INITIALIZING:
+                    return transfer
 
-    def space_test_ssh(self, user, address, dir, file):
+            transfer = self.wait_for(
+                started,
+                _('the transfer of %s') % filename
+            )
+            if transfer.phase != types.ImageTransferPhase.TRANSFERRING:
+                raise Exception(
+                    _("The transfer of %s is %s") % (
+                        filename,
+                        transfer.phase.value
+                    )
+                )
+            # The host serves the transfer directly, the proxy of the
+            # engine only when the host can't be reached.
+            urls = [
+                url for url in (transfer.transfer_url, transfer.proxy_url)
+                if url
+            ]
+            for url in urls:
+                try:
+                    logging.debug('transfer url is %s', url)
+                    self.send_file_http(url, filename, file_size)
+                    break
+                except ImageTransferConnectionError as e:
+                    if url == urls[-1]:
+                        raise
+                    logging.warning(
+                        _('Unable to upload %s to %s (%s), trying %s'),
+                        filename,
+                        url,
+                        str(e).strip(),
+                        urls[-1]
+                    )
+            with self.api_lock:
+                transfer_service.finalize()
+
+            def finished():
+                try:
+                    phase = transfer_service.get().phase
+                except ovirtsdk4.NotFoundError:
+                    # The engine forgets finished transfers
+                    return disk_service.get().status == types.DiskStatus.OK
+                if phase == types.ImageTransferPhase.FINISHED_FAILURE:
+                    raise Exception(
+                        _("The engine failed to finalize the transfer "
+                          "of %s") % filename
+                    )
+                return phase == types.ImageTransferPhase.FINISHED_SUCCESS
+
+            self.wait_for(finished, _('the transfer of %s') % filename)
+        except Exception:
+            for cleanup in (
+                    transfer_service and transfer_service.cancel,
+                    disk_service.remove
+            ):
+                try:
+                    if cleanup:
+                        with self.api_lock:
+                            cleanup()
+                except Exception as e:
+                    logging.debug('cleanup failed: %s', e)
+            raise
+
+    def upload_file_http(self, dest, filename):
         """
-        Function to test if the given file will fit on the given
-        remote directory.  This function will return the available
-        space in bytes of dir and the size of file.
+        Uploads filename to the data domain dest as an ISO disk, through
+        the image transfer API of the engine.
+        Returns: True if successful and false otherwise.
         """
-        dir_size = None
-        returncode = 1
-        cmd = self.format_ssh_command()
-        cmd += (
-            """ %s%s "%s -c 'import os; dir_stat = os.statvfs(\\"%s\\"); """
-            """print (dir_stat.f_bavail * dir_stat.f_frsize)'" """
-        ) % (user, address, PYTHON, dir)
-        logging.debug('Mount point size test command is (%s)' % cmd)
+        logging.info(_("Start uploading %s "), filename)
         try:
-            dir_size, returncode = self.caller.call(cmd)
-        except Exception:
-            pass
+            with self.metrics.phase('prepare', dest.name):
+                existing = self.prepare_http(dest, filename)
+            if existing is None:
+                return False
+            with self.transfer(dest, filename):
+                self.send_image_http(dest, filename)
+            with self.metrics.phase('finalize', dest.name):
+                disks = self.api.system_service().disks_service()
+                for id in existing:
+                    with self.api_lock:
+                        disks.disk_service(id).remove()
+            self.report_success(dest, filename)
+            return True
+        except Exception, e:
+            self.report_failure(dest, filename, e)
+            return False
 
-        if returncode == 0 and dir_size is not None:
-            # This simply means that the SSH command was successful.
-            dir_size = dir_size.strip()
-            file_size = os.path.getsize(file)
-            logging.debug(
-                "Size of %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
-                file, file_size, file_size / 1024, (file_size / 1024) / 1024
-            )
-            logging.debug(
-                "Available space in %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
-                dir, dir_size, float(dir_size) / 1024,
-                (float(dir_size) / 1024) / 1024
-            )
-            return (dir_size, file_size)
-        else:
-            raise Exception("unable to test the available space on %s" % dir)
+    def upload_file(self, dest, filename):
+        if dest.transport == 'ssh':
+            return self.upload_file_ssh(dest, filename)
+        if dest.transport == 'http':
+            return self.upload_file_http(dest, filename)
+        return self.upload_file_nfs(dest, filename)
 
-    def space_test_nfs(self, dir, file, uid, gid):
+    def open_sink(self, dest, temp_dest_file):
         """
-        Checks to see if there is enough space in dir for file.
-        This function will return the available
-        space in bytes of dir and the size of file.
+        Opens the stream filling temp_dest_file in dest for a fan-out
+        upload.  NFS sinks are opened by the NFS worker, as the vdsm user.
+        SSH sinks run on a command slot reserved by the caller.
         """
-        try:
-            os.setegid(gid)
-            os.seteuid(uid)
-            dir_stat = os.statvfs(dir)
-        except Exception:
-            raise Exception(
-                "unable to test the available space on %s" % dir
+        if dest.transport == 'ssh':
+            try:
+                if self.configuration.get('verify'):
+                    cmd = self.format_ssh_python(
+                        dest.user,
+                        dest.address,
+                        REMOTE_RECEIVE_SCRIPT,
+                        temp_dest_file,
+                        0,
+                        'create'
+                    )
+                else:
+                    cmd = self.format_ssh_command(address=dest.address)
+                    cmd += ' %s%s "%s > %s"' % (
+                        dest.user,
+                        dest.address,
+                        CAT,
+                        temp_dest_file
+                    )
+            except Exception:
+                self.caller.limit().release()
+                raise
+            logging.debug('Fan-out command is (%s)', cmd)
+            return SSHSink(
+                self.caller.start(
+                    cmd,
+                    input=subprocess.PIPE,
+                    watch=True,
+                    reserved=True
+                )
             )
-        finally:
-            os.seteuid(0)
-            os.setegid(0)
+        return FileSink(self.nfs.open(temp_dest_file, 'wb'))
 
-        dir_size = (dir_stat.f_bavail * dir_stat.f_frsize)
-        file_size = os.path.getsize(file)
-        logging.debug(
-            "Size of %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
-            file, file_size, file_size / 1024, (file_size / 1024) / 1024
-        )
-        logging.debug(
-            "Available space in %s:\t%s bytes\t%.1f 1K-blocks\t%.1f MB",
-            dir, dir_size, dir_size / 1024, (dir_size / 1024) / 1024
+    def tee(self, streams, buf, filename):
+        """
+        Queues buf to each of the fan-out streams of filename.  A stream
+        whose queue is full while another one has room holds the others
+        back, and is detached once it has done so for
+        FANOUT_STALL_TIMEOUT in a row, even if it still makes progress.
+        Streams that are all full keep up with each other and are only
+        waited for.
+        """
+        waiting = []
+        for stream in streams:
+            if stream.put(buf):
+                stream.behind_since = None
+            else:
+                waiting.append(stream)
+        while waiting:
+            now = time.time()
+            live = [s for s in streams if not s.stopped()]
+            for stream in waiting:
+                if len(waiting) == len(live):
+                    stream.behind_since = None
+                elif stream.behind_since is None:
+                    stream.behind_since = now
+                elif now - stream.behind_since >= FANOUT_STALL_TIMEOUT:
+                    stream.detached = True
+                    logging.warning(
+                        _(
+                            '%s is too slow, it will get %s '
+                            'after the other destinations'
+                        ),
+                        stream.dest.name,
+                        filename
+                    )
+            waiting = [
+                s for s in waiting
+                if not s.stopped() and not s.put(buf, FANOUT_POLL_INTERVAL)
+            ]
+
+    def fan_out(self, destinations, filename):
+        """
+        Uploads filename to all destinations, reading it only once.
+        The data is teed to a bounded queue per destination, drained by
+        one thread each.  A destination holding the others back for
+        FANOUT_STALL_TIMEOUT is detached so that it doesn't stall them,
+        and gets filename through a regular upload afterwards.
+        Returns: whether filename was uploaded, by destination name.
+        """
+        logging.info(_("Start uploading %s "), filename)
+        results = dict((dest.name, False) for dest in destinations)
+        targets = []
+        separate = []
+        for dest in destinations:
+            try:
+                if dest.transport == 'http':
+                    # Image transfers are not streams
+                    separate.append(dest)
+                    continue
+                elif dest.transport == 'ssh':
+                    target = self.prepare_ssh(dest, filename)
+                    if target is not None and target[2]:
+                        # A delta upload reads filename on its own
+                        separate.append(dest)
+                        continue
+                else:
+                    target = self.prepare_nfs(dest, filename)
+                if target is not None:
+                    targets.append((dest, target[0], target[1]))
+            except Exception, e:
+                self.report_failure(dest, filename, e)
+        # The SSH streams run together, their command slots are taken at
+        # once; those that get none are uploaded separately
+        remote = [t for t in targets if t[0].transport == 'ssh']
+        for target in remote[self.caller.reserve(len(remote)):]:
+            targets.remove(target)
+            separate.append(target[0])
+
+        streams = []
+        # Hashed as it is read, for the SSH destinations to verify against
+        digest = hashlib.sha256()
+        if targets:
+            src = open(filename, 'rb')
+            try:
+                for dest, dest_file, temp_dest_file in targets:
+                    try:
+                        stream = FanOutStream(
+                            dest,
+                            dest_file,
+                            temp_dest_file,
+                            self.open_sink(dest, temp_dest_file),
+                        )
+                    except Exception, e:
+                        self.report_failure(dest, filename, e)
+                        continue
+                    stream.start()
+                    streams.append(stream)
+                started = time.time()
+                try:
+                    while True:
+                        live = [s for s in streams if not s.stopped()]
+                        if not live:
+                            # Every destination failed or was detached
+                            break
+                        buf = src.read(FANOUT_CHUNK_SIZE)
+                        if not buf:
+                            break
+                        digest.update(buf)
+                        self.tee(live, buf, filename)
+                except BaseException:
+                    for stream in streams:
+                        stream.cancel()
+                    raise
+                finally:
+                    for stream in streams:
+                        stream.join()
+                elapsed = time.time() - started
+            finally:
+                src.close()
+
+        for stream in streams:
+            dest = stream.dest
+            if stream.detached:
+                if stream.is_alive():
+                    self.report_failure(
+                        dest,
+                        filename,
+                        _('the transfer did not stop after being detached')
+                    )
+                else:
+                    separate.append(dest)
+                continue
+            if is_transient(stream.error) and self.caller.retries():
+                logging.warning(
+                    _('%s failed on %s (%s), it will be uploaded again'),
+                    filename,
+                    dest.name,
+                    str(stream.error).strip()
+                )
+                separate.append(dest)
+                continue
+            try:
+                if stream.error is not None:
+                    raise stream.error
+                # Fan-out streams the whole file, uncompressed
+                self.transferred(
+                    dest,
+                    filename,
+                    elapsed,
+                    sent=os.path.getsize(filename)
+                )
+                if dest.transport == 'ssh':
+                    if self.configuration.get('verify'):
+                        self.verify_digest(
+                            digest.hexdigest(),
+                            stream.sink.output,
+                            stream.temp_dest_file
+                        )
+                    self.finalize_ssh(
+                        dest,
+                        stream.temp_dest_file,
+                        stream.dest_file
+                    )
+                elif not self.rename_file_nfs(
+                    stream.temp_dest_file,
+                    stream.dest_file
+                ):
+                    self.metrics.count(
+                        'files_total',
+                        destination=dest.name,
+                        result='failure'
+                    )
+                    continue
+                self.report_success(dest, filename)
+                results[dest.name] = True
+            except Exception, e:
+                self.report_failure(dest, filename, e)
+        for dest in separate:
+            results[dest.name] = self.upload_file(dest, filename)
+
+        logging.info(
+            _('%s: uploaded to %s, failed on %s'),
+            filename,
+            ', '.join(name for name, ok in results.items() if ok) or '-',
+            ', '.join(name for name, ok in results.items() if not ok) or '-',
         )
-        return (dir_size, file_size)
+        return results
 
-    def copyfileobj_sparse_progress(
-            self,
-            fsrc,
-            fdst,
-            length=16*1024,
-            make_sparse=True,
-            bar_length=40,
-            quiet=True,
-    ):
+    def with_destinations(self, func):
+        """
+        Discovers the destinations, mounts the NFS ones and calls func
+        with the list of the usable ones.  The NFS exports are unmounted
+        afterwards.  The NFS worker serves func while it runs.
+        """
+        destinations = self.get_destinations()
+        for dest in list(destinations):
+            if dest.transport == 'nfs' and dest.domain_type in ('localfs', ):
+                ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+                logging.error(
+                    _(
+                        'Upload to a local storage domain is supported only '
+                        'through SSH'
+                    ),
+                )
+                destinations.remove(dest)
+        if not destinations:
+            return
+        mounted = []
+        try:
+            if any(dest.transport == 'nfs' for dest in destinations):
+                getpwnam(NFS_USER)
+                self.nfs = NFSWorker(NUMERIC_VDSM_ID, NUMERIC_VDSM_ID)
+            for dest in list(destinations):
+                if dest.transport != 'nfs':
+                    continue
+                try:
+                    self.mount_nfs(dest)
+                    mounted.append(dest)
+                except Exception, e:
+                    ExitCodes.exit_code = ExitCodes.CRITICAL
+                    logging.error(e)
+                    destinations.remove(dest)
+                    if dest.mount_point:
+                        shutil.rmtree(dest.mount_point, ignore_errors=True)
+            if destinations:
+                func(destinations)
+        except KeyError:
+            ExitCodes.exit_code = ExitCodes.CRITICAL
+            logging.error(
+                _(
+                    "A user named %s with a UID and GID of %d must be "
+                    "defined on the system to mount the ISO storage "
+                    "domain on %s as Read/Write"
+                ),
+                NFS_USER,
+                NUMERIC_VDSM_ID,
+                self.configuration.get('iso_domain')
+            )
+        finally:
+            if self.nfs is not None:
+                self.nfs.close()
+                self.nfs = None
+            for dest in mounted:
+                self.umount_nfs(dest)
+
+    def upload_to_storage_domain(self):
         """
-        copy data from file-like object fsrc to file-like object fdst
-        like shutils.copyfileobj does but supporting also
-        sparse file. It can print also a progress bar
+        Method to upload the designated files to one or more ISO storage
+        domains.
         """
-        i = 0
-        fsrc.seek(0, 2)  # move the cursor to the end of the file
-        end_val = fsrc.tell()
-        fsrc.seek(0, 0)  # move back the cursor to the start of the file
-        old_ipercent = -1
-        while 1:
-            buf = fsrc.read(length)
-            if not buf:
-                break
-            if make_sparse and buf == '\0'*len(buf):
-                fdst.seek(len(buf), os.SEEK_CUR)
-            else:
-                fdst.write(buf)
-            i += length
-            percent = min(float(i) / end_val, 1.0)
-            ipercent = int(round(percent * 100))
-            if not quiet and ipercent > old_ipercent:
-                old_ipercent = ipercent
-                hashes = '#' * int(round(percent * bar_length))
-                spaces = ' ' * (bar_length - len(hashes))
-                sys.stdout.write(
-                    _(
-                        "\rUploading: [{h}] {n}%".format(
-                            h=hashes + spaces,
-                            n=ipercent,
-                        )
-                    )
+        def upload(destinations):
+            if self.configuration.get('plan'):
+                self.plan_upload(destinations)
+                return
+            print _("Uploading, please wait...")
+            scheduler = self.schedule(destinations, self.configuration.files)
+            if self.needs_digests():
+                self.hasher.submit(scheduler.files)
+            small = set(self.bulk_files(scheduler.files))
+            bulk = [dest for dest in destinations if dest.transport == 'ssh']
+            if small:
+                run_parallel(
+                    lambda dest: self.upload_bulk_ssh(
+                        dest,
+                        [file for file in scheduler.files if file in small],
+                        scheduler
+                    ),
+                    bulk,
+                    self.parallel_workers()
                 )
-                sys.stdout.flush()
-        if make_sparse:
-            # Make sure the file ends where it should, even if padded out.
-            fdst.truncate()
-        if not quiet:
-            sys.stdout.write('\n')
-            sys.stdout.flush()
+            else:
+                bulk = []
+
+            def send(filename):
+                targets = [
+                    dest for dest in destinations
+                    if not (filename in small and dest in bulk) and
+                    scheduler.reserve(dest.name, filename)
+                ]
+                if not targets:
+                    return
+                results = self.upload_to(targets, filename)
+                for dest in targets:
+                    scheduler.release(dest.name, filename, results[dest.name])
+
+            run_parallel(send, scheduler.files, self.parallel_workers())
+            self.report_deferred(destinations, scheduler)
+
+        try:
+            self.with_destinations(upload)
+        finally:
+            self.hasher.close()
 
-    def copy_file(self, src_file_name, dest_file_name, uid, gid):
+    def upload_to(self, destinations, filename):
         """
-        Copy a file from source to dest via file handles.  The destination
-        file will be opened and written to as the UID and GID provided.
-        This odd copy operation is important when copying files over NFS.
-        Read the NFS spec if you want to figure out *why* you need to do this.
-        Returns: True if successful and false otherwise.
+        Uploads filename to destinations, reading it only once if there
+        are several.
+        Returns: whether filename was uploaded, by destination name.
         """
-        retVal = True
-        logging.debug("euid(%s) egid(%s)" % (os.geteuid(), os.getegid()))
-        umask_save = os.umask(0137)  # Set to 640
+        if len(destinations) > 1:
+            return self.fan_out(destinations, filename)
+        return {
+            destinations[0].name: self.upload_file(destinations[0], filename)
+        }
+
+    def watch_directories(self):
+        """
+        Uploads the files written or moved into the designated
+        directories to the ISO storage domains as they land, until
+        interrupted.  The domains stay mounted, and the SSH connections
+        open, between files.
+        """
+        dirs = self.configuration.files
+        for dir in dirs:
+            if not os.path.isdir(dir):
+                raise Exception(_('%s is not a directory') % dir)
         try:
-            src = open(src_file_name, 'r')
-            os.setegid(gid)
-            os.seteuid(uid)
-            dest = open(dest_file_name, 'w')
-            self.copyfileobj_sparse_progress(
-                fsrc=src,
-                fdst=dest,
-                quiet=self.configuration.options.quiet,
+            settle = float(
+                self.configuration.get('settle') or DEFAULT_WATCH_SETTLE
             )
-        except Exception, e:
-            retVal = False
-            logging.error(_("Problem copying %s to %s.  Message: %s" %
-                          (src_file_name, dest_file_name, e)))
+        except ValueError:
+            raise Exception(
+                _("%s is not a valid number of seconds") %
+                self.configuration.get('settle')
+            )
+        patterns = split_list(self.configuration.get('watch_patterns')) or \
+            ['*']
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+
+        def watch(destinations):
+            inotify = Inotify()
+            try:
+                for dir in dirs:
+                    inotify.add(dir)
+                print _("Watching %s, press CTRL+C to stop...") % (
+                    ', '.join(dirs)
+                )
+                self.watch_loop(inotify, destinations, settle, patterns)
+            finally:
+                inotify.close()
+                if self.control_dir is not None:
+                    self.close_ssh_masters(destinations)
+
+        if not self.configuration.get('ssh_user') or \
+                self.stripe_count(STRIPE_MIN_SIZE * 2) > 1:
+            self.control_dir = None
+        else:
+            # Striped transfers need connections of their own
+            self.control_dir = tempfile.mkdtemp()
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            self.with_destinations(watch)
         finally:
-            os.umask(umask_save)
-            os.seteuid(0)
-            os.setegid(0)
-            src.close()
-            dest.close()
-        return retVal
+            self.hasher.close()
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
 
-    def rename_file_nfs(self, src_file_name, dest_file_name, uid, gid):
+    def watch_loop(self, inotify, destinations, settle, patterns):
         """
-        Rename a file from source to dest as the UID and GID provided.
-        This method will set the euid and egid to that which is provided
-        and then perform the rename.  This is can be important on an
-        NFS mount.
+        Waits for files to land in the watched directories and uploads
+        them once they settle: a file is uploaded when nothing was written
+        to it for settle seconds and its size and mtime did not change
+        meanwhile.  Files are only uploaded again if they changed.
         """
-        logging.debug("euid(%s) egid(%s)" % (os.geteuid(), os.getegid()))
-        umask_save = os.umask(0137)  # Set to 640
-        try:
-            os.setegid(gid)
-            os.seteuid(uid)
-            logging.debug(
-                'Renaming {src} to {dest}'.format(
-                    src=src_file_name,
-                    dest=dest_file_name,
+        started = time.time()
+        # path -> (when it is due, (size, mtime) when it was seen)
+        pending = {}
+        uploaded = {}
+
+        def signature(path):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            return (st.st_size, st.st_mtime)
+
+        def candidate(dir, name):
+            if name.startswith('.') or not any(
+                    fnmatch.fnmatch(name, pattern) for pattern in patterns
+            ):
+                return
+            path = os.path.join(dir, name)
+            pending[path] = (time.time() + settle, signature(path))
+
+        while inotify.watches:
+            timeout = None
+            if pending:
+                timeout = max(
+                    0,
+                    min(due for due, seen in pending.values()) - time.time()
                 )
-            )
-            os.rename(src_file_name, dest_file_name)
-            success = True
-        except Exception, e:
-            success = False
-            logging.error(
-                _(
-                    'Problem renaming {src} to {dst}. Message: {msg}'
-                ).format(
-                    src=src_file_name,
-                    dst=dest_file_name,
-                    msg=e,
+            if select.select([inotify], [], [], timeout)[0]:
+                for dir, name, mask in inotify.read():
+                    if mask & IN_Q_OVERFLOW:
+                        logging.warning(
+                            _('Too many files landed at once, rescanning')
+                        )
+                        for dir in inotify.watches.values():
+                            for name in os.listdir(dir):
+                                path = os.path.join(dir, name)
+                                sig = signature(path)
+                                if sig and sig[1] >= started and \
+                                        uploaded.get(path) != sig:
+                                    candidate(dir, name)
+                    elif mask & IN_DELETE_SELF:
+                        ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+                        logging.error(_('%s was removed'), dir)
+                    elif dir is not None and name:
+                        candidate(dir, name)
+                continue
+            now = time.time()
+            for path, (due, seen) in pending.items():
+                if due > now:
+                    continue
+                del pending[path]
+                sig = signature(path)
+                if sig is None:
+                    logging.debug('%s is gone', path)
+                    continue
+                if sig != seen:
+                    # Still being written through another descriptor
+                    pending[path] = (now + settle, sig)
+                    continue
+                if uploaded.get(path) == sig:
+                    continue
+                uploaded[path] = sig
+                if self.needs_digests():
+                    self.hasher.submit([path])
+                self.upload_to(destinations, path)
+                self.history.save()
+
+    def close_ssh_masters(self, destinations):
+        for dest in destinations:
+            if dest.transport != 'ssh':
+                continue
+            cmd = self.format_ssh_command(address=dest.address)
+            cmd += '-O exit %s%s' % (dest.user, dest.address)
+            try:
+                self.caller.call(cmd)
+            except Exception, e:
+                logging.debug('unable to stop the SSH master: %s', e)
+
+    def plan_upload(self, destinations):
+        """
+        Prints what uploading the designated files would do to each of
+        destinations, how many bytes it would put on the wire and, from
+        the throughput history, how long it would take.  Nothing is
+        uploaded or removed.
+        """
+        files = self.configuration.files
+        force = bool(self.configuration.get('force'))
+        inventories = {}
+        for dest in destinations:
+            try:
+                inventories[dest.name] = self.inventory(dest)
+            except Exception, e:
+                logging.warning(
+                    _('Unable to list the files of %s: %s'),
+                    dest.name,
+                    str(e).strip()
                 )
+        scheduler = self.schedule(destinations, files, inventories)
+        rejected = {}
+        for filename in scheduler.files:
+            try:
+                self.validate_file(filename)
+            except Exception, e:
+                rejected[filename] = str(e).strip()
+        fmt = "  %-8s %10s %10s %9s  %s"
+        estimates = []
+        for dest in destinations:
+            print _("Plan for %s (%s):") % (dest.name, dest.transport)
+            print fmt % (
+                _("action"),
+                _("size"),
+                _("on wire"),
+                _("time"),
+                _("file")
             )
-            logging.error(
-                _(
-                    'Please ensure to have permissions for renaming files '
-                    'inside {directory}'
-                ).format(
-                    directory=os.path.dirname(dest_file_name)
+            rate = self.history.rate(dest.name)
+            inventory = inventories.get(dest.name, {})
+            count = size = wire = 0
+            for filename in scheduler.files:
+                name = os.path.basename(filename)
+                file_size = os.path.getsize(filename)
+                if filename in rejected:
+                    action, note = 'reject', rejected[filename]
+                elif name in inventory and not force:
+                    action, note = 'skip', _('exists, use --force')
+                elif not scheduler.reserve(dest.name, filename):
+                    action, note = 'defer', _('not enough space')
+                else:
+                    action = 'replace' if name in inventory else 'new'
+                    note = None
+                if note is not None:
+                    print fmt % (action, format_size(file_size), '-', '-',
+                                 '%s (%s)' % (name, note))
+                    continue
+                file_wire = self.wire_bytes(dest, filename)
+                count += 1
+                size += file_size
+                wire += file_wire
+                print fmt % (
+                    action,
+                    format_size(file_size),
+                    format_size(file_wire),
+                    format_duration(file_wire / rate) if rate else '?',
+                    name
                 )
-            )
-            ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
-        finally:
-            os.seteuid(0)
-            os.setegid(0)
-            os.umask(umask_save)
-        return success
+            free = scheduler.free.get(dest.name)
+            summary = _(
+                "  %d files to transfer, %s (%s on the wire)"
+            ) % (count, format_size(size), format_size(wire))
+            if free is not None:
+                summary += _(", %s free afterwards") % format_size(free)
+            print summary
+            if rate:
+                estimates.append(wire / rate)
+                print _("  estimated %s at %s/s") % (
+                    format_duration(wire / rate),
+                    format_size(rate)
+                )
+            elif count:
+                print _(
+                    "  no throughput measured yet to %s, upload once to "
+                    "get an estimate"
+                ) % dest.name
+        if len(destinations) > 1 and estimates:
+            # The destinations are uploaded to concurrently
+            print _("Estimated total: %s") % format_duration(max(estimates))
 
-    def rename_file_ssh(self, user, address, src_file_name, dest_file_name):
+    def schedule(self, destinations, files, inventories=None):
         """
-        This method will remove a file via SSH.
+        Returns the UploadScheduler of files, knowing the free space of
+        each of destinations.  The files that will replace existing ones
+        (with --force) are credited with the space of the latter, the
+        ones that will be skipped because they exist need none.
+        inventories are the already known inventories by destination
+        name.  The files that can't be read are reported as failed, and
+        left out.
         """
-        cmd = self.format_ssh_command()
-        cmd += """ %s%s "%s %s %s" """ % (
-            user,
-            address,
-            MV,
-            src_file_name,
-            dest_file_name
+        sizes = {}
+        for file in files:
+            try:
+                sizes[file] = os.path.getsize(file)
+            except OSError, e:
+                for dest in destinations:
+                    self.report_failure(dest, file, e)
+        files = [file for file in files if file in sizes]
+        scheduler = UploadScheduler(
+            files,
+            self.configuration.get('schedule') or 'given',
+            split_list(self.configuration.get('priority')),
+            sizes
         )
-        logging.debug('Rename file command is (%s)' % cmd)
-        try:
-            stdout, returncode = self.caller.call(cmd)
-        except Exception:
-            raise Exception(
-                "unable to move file from %s to %s" % (
-                    src_file_name,
-                    dest_file_name
+        if not files:
+            return scheduler
+        replace = bool(
+            self.configuration.get('force') and
+            not self.configuration.get('delta')
+        )
+        for dest in destinations:
+            try:
+                if dest.transport == 'ssh':
+                    free = self.space_test_ssh(
+                        dest.user,
+                        dest.address,
+                        dest.path,
+                        files[0]
+                    )[0]
+                elif dest.transport == 'http':
+                    free = self.space_test_http(dest)
+                else:
+                    free = self.space_test_nfs(
+                        self.dest_dir(dest),
+                        files[0]
+                    )[0]
+                inventory = (inventories or {}).get(dest.name)
+                if inventory is None:
+                    inventory = self.inventory(dest)
+            except Exception, e:
+                logging.warning(
+                    _('Unable to schedule the uploads to %s, the space '
+                      'will be checked file by file: %s'),
+                    dest.name,
+                    str(e).strip()
                 )
+                continue
+            free = long(free)
+            exempt = []
+            for file in set(files):
+                existing = inventory.get(os.path.basename(file))
+                if existing is None:
+                    continue
+                if replace and dest.transport != 'http':
+                    # Replaced disks are removed after the upload
+                    free += existing[0]
+                elif replace:
+                    continue
+                else:
+                    exempt.append(file)
+            scheduler.add_destination(dest.name, free, exempt)
+        return scheduler
+
+    def report_deferred(self, destinations, scheduler):
+        for dest in destinations:
+            deferred = scheduler.deferred.get(dest.name)
+            if not deferred:
+                continue
+            for file in deferred:
+                self.report_no_space(
+                    dest,
+                    file,
+                    scheduler.free[dest.name],
+                    scheduler.sizes[file]
+                )
+            logging.warning(
+                _('%s: %s files deferred for lack of space: %s'),
+                dest.name,
+                len(deferred),
+                ', '.join(os.path.basename(file) for file in deferred)
             )
 
-    def remove_file_nfs(self, file_name, uid, gid):
+    def needs_digests(self):
         """
-        Remove a file as the UID and GID provided.
-        This method will set the euid and egid to that which is provided
-        and then perform the remove.  This is can be important on an
-        NFS mount.
+        Tells whether the digests of the uploaded files will be needed,
+        in which case they are all hashed ahead by the batch hasher.
         """
-        logging.debug("euid(%s) egid(%s)" % (os.geteuid(), os.getegid()))
-        try:
-            os.setegid(gid)
-            os.seteuid(uid)
-            os.remove(file_name)
-        except Exception, e:
-            logging.error(_("Problem removing %s.  Message: %s" %
-                          (file_name, e)))
-        finally:
-            os.seteuid(0)
-            os.setegid(0)
+        return bool(
+            self.configuration.get('checksums') or
+            self.configuration.get('verify')
+        )
 
-    def remove_file_ssh(self, user, address, file):
+    def local_library(self, paths):
         """
-        This method will remove a file via SSH.
+        Walks the given files and directories.
+        Returns:
+          a dictionary of the paths of the files found by their basename
         """
+        library = {}
 
-        cmd = self.format_ssh_command()
-        cmd += """ %s%s "%s %s" """ % (user, address, RM, file)
-        logging.debug('Remove file command is (%s)' % cmd)
-        try:
-            stdout, returncode = self.caller.call(cmd)
-        except Exception:
-            raise Exception("unable to remove %s" % file)
+        def add(path):
+            name = os.path.basename(path)
+            if name.startswith('.'):
+                return
+            if name in library:
+                logging.warning(
+                    _('%s has the same name as %s, skipping it'),
+                    path,
+                    library[name]
+                )
+                return
+            library[name] = path
 
-    def refresh_iso_domain(self, id):
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                    for name in sorted(files):
+                        add(os.path.join(root, name))
+            elif os.path.isfile(path):
+                add(path)
+            else:
+                ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+                logging.error(_('%s is not a file or a directory'), path)
+        return library
+
+    def inventory_ssh(self, user, address, dir):
         """
-        oVirt Engine scans and caches the list of files in each ISO domain.  It
-        does this on a predefined interval.  Poking the
-        /storagedomains/<id>/files
-        RESTful method will cause it to refresh that list.
+        Lists the files of dir on the SSH server in a single connection.
+        Returns:
+          a dictionary of (size, mtime) by file name
         """
-        if not self._initialize_api():
-            sys.exit(ExitCodes.CRITICAL)
-        try:
-            svc = self.api.system_service()
-            sd = svc.storage_domains_service().service(id)
-            if sd is not None:
-                sd.files_service().list()
-        except Exception, e:
-            logging.warn(
-                _(
-                    "failed to refresh the list of files available in the "
-                    "%s ISO storage domain. Please refresh the list manually "
-                    "using the 'Refresh' button in the oVirt Webadmin "
-                    "console."
-                ),
-                self.configuration.get('iso_domain')
-            )
-            logging.debug(e)
+        cmd = self.format_ssh_python(user, address, REMOTE_LIST_SCRIPT, dir)
+        logging.debug('Inventory command is (%s)', cmd)
+        inventory = {}
+        for line in self.caller.call(cmd)[0].splitlines():
+            size, mtime, name = line.split(' ', 2)
+            inventory[name] = (long(size), float(mtime))
+        return inventory
 
-    def upload_to_storage_domain(self):
+    def inventory_nfs(self, dir):
         """
-        Method to upload a designated file to an ISO storage domain.
+        Lists the files of dir as the vdsm user, through the NFS worker.
+        Returns:
+          a dictionary of (size, mtime) by file name
         """
-        # TODO: refactor this method
-        remote_path = ''
-        id = None
-        domain_type = None
-        # Did the user give us enough info to do our work?
-        if (
-            self.configuration.get('iso_domain') and
-            self.configuration.get('nfs_server')
-        ):
-            raise Exception(
-                _("iso-domain and nfs-server are mutually exclusive options")
+        return self.nfs.call('list_files', dir)
+
+    def inventory_http(self, dest):
+        """
+        Lists the disks of the data domain dest.
+        Returns:
+          a dictionary of (size, mtime) by disk name, the mtime being
+          unknown
+        """
+        return dict(
+            (disk.name, (long(disk.provisioned_size or 0), 0.0))
+            for disk in self.domain_disks(dest)
+        )
+
+    def inventory(self, dest):
+        if dest.transport == 'http':
+            return self.inventory_http(dest)
+        if dest.transport == 'ssh':
+            return self.inventory_ssh(
+                dest.user,
+                dest.address,
+                self.dest_dir(dest)
             )
-        if (
-            self.configuration.get('ssh_user') and
-            self.configuration.get('nfs_server')
-        ):
-            raise Exception(
-                _("ssh-user and nfs-server are mutually exclusive options")
+        return self.inventory_nfs(self.dest_dir(dest))
+
+    def remote_digests(self, dest, names):
+        """
+        Returns the SHA256 hex digests of the given files of dest by
+        their name.
+        """
+        digests = {}
+        if not names:
+            return digests
+        dest_dir = self.dest_dir(dest)
+        if dest.transport == 'ssh':
+            cmd = self.format_ssh_python(
+                dest.user,
+                dest.address,
+                REMOTE_DIGEST_SCRIPT,
+                dest_dir
             )
-        elif self.configuration.get('iso_domain'):
-            # Discover the hostname and path from the ISO domain.
-            iso_domain_data = self.get_host_and_path_from_ISO_domain(
-                self.configuration.get('iso_domain')
+            logging.debug('Digest command is (%s)', cmd)
+            stdout = self.caller.call(
+                cmd,
+                input='\n'.join(names),
+                timeout=0
+            )[0]
+            for line in stdout.splitlines():
+                digest, name = line.split(' ', 1)
+                digests[name] = digest
+        else:
+            for name in names:
+                with self.nfs.open(os.path.join(dest_dir, name)) as src:
+                    digests[name] = sha256_stream(src)
+        return digests
+
+    def remove_file(self, dest, name):
+        file = os.path.join(self.dest_dir(dest), name)
+        if dest.transport == 'ssh':
+            self.remove_file_ssh(dest.user, dest.address, file)
+        else:
+            self.remove_file_nfs(file)
+
+    def remove_files_ssh(self, user, address, dir, names):
+        """
+        Removes the given files of dir on the SSH server in a single
+        connection.
+        Returns: the dictionary of the error messages by file name, None
+        for the removed files.
+        """
+        cmd = self.format_ssh_python(user, address, REMOTE_REMOVE_SCRIPT, dir)
+        logging.debug('Remove files command is (%s)', cmd)
+        results = {}
+        stdout = self.caller.call(cmd, input='\n'.join(names))[0]
+        for line in stdout.splitlines():
+            status, rest = line.split(' ', 1)
+            if status == 'ok':
+                results[rest] = None
+            else:
+                name, sep, error = rest.partition(' ')
+                results[name] = error
+        return results
+
+    def remove_files_nfs(self, dir, names):
+        """
+        Removes the given files of dir as the vdsm user, in a single
+        request to the NFS worker.
+        Returns: the dictionary of the error messages by file name, None
+        for the removed files.
+        """
+        return self.nfs.call('remove_files', dir, names)
+
+    def delete_from_destination(self, dest, patterns):
+        """
+        Removes the files of dest matching patterns, according to the
+        retention options.
+        """
+        try:
+            keep_newest = int(self.configuration.get('keep_newest') or 0)
+            older_than = float(self.configuration.get('older_than') or 0)
+            if keep_newest < 0 or older_than < 0:
+                raise ValueError(_('negative values are not allowed'))
+        except ValueError as e:
+            raise Exception(_("Invalid retention option: %s") % e)
+        names = select_for_deletion(
+            self.inventory(dest),
+            patterns,
+            keep_newest,
+            older_than
+        )
+        if not names:
+            logging.info(_('%s: no file to delete'), dest.name)
+            return
+        if self.configuration.get('dry_run'):
+            for name in names:
+                logging.info(_('%s: would delete %s'), dest.name, name)
+            return
+        dest_dir = self.dest_dir(dest)
+        if dest.transport == 'ssh':
+            results = self.remove_files_ssh(
+                dest.user,
+                dest.address,
+                dest_dir,
+                names
             )
-            if iso_domain_data is None:
-                raise Exception(
-                    _('Unable to get ISO domain data')
-                )
-            (id, domain_type, address, path) = iso_domain_data
-            remote_path = os.path.join(id, DEFAULT_IMAGES_DIR)
-        elif self.configuration.get('nfs_server'):
-            mnt = self.configuration.get('nfs_server')
-            (address, sep, path) = mnt.partition(':')
         else:
+            results = self.remove_files_nfs(dest_dir, names)
+        removed = 0
+        for name in names:
+            if name in results and results[name] is None:
+                removed += 1
+                logging.info(_('%s: deleted %s'), dest.name, name)
+            else:
+                ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+                logging.error(
+                    _('%s: unable to delete %s: %s'),
+                    dest.name,
+                    name,
+                    results.get(name) or _('no result')
+                )
+        if removed and dest.id is not None:
+            # Force oVirt Engine to refresh the list of files
+            # in the ISO domain, once for all the removed files
+            self.refresh_iso_domain(dest.id)
+
+    def delete_from_storage_domain(self):
+        """
+        Deletes the files matching the designated names or glob patterns
+        from the ISO storage domains.
+        """
+        def delete(destinations):
+            for dest in destinations:
+                try:
+                    self.delete_from_destination(
+                        dest,
+                        self.configuration.files
+                    )
+                except Exception, e:
+                    ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+                    logging.error(
+                        _('Unable to delete files from %s: %s'),
+                        dest.name,
+                        str(e).strip()
+                    )
+
+        self.with_destinations(delete)
+
+    def sync_destination(self, dest, library):
+        """
+        Uploads the files of library that are missing or differ in dest.
+        A file differs if its size does, and either its content (with
+        --compare=hash) or its local modification time is newer than the
+        one in dest.
+        """
+        compare = self.configuration.get('compare') or 'mtime'
+        if compare not in SYNC_COMPARE_MODES:
             raise Exception(
-                _("either iso-domain or nfs-server must be provided")
+                _("%s is not a valid comparison.  Valid ones are %s.")
+                % (compare, ', '.join(SYNC_COMPARE_MODES))
             )
-        print _("Uploading, please wait...")
-        # We need to create the full path to the images directory
-        if conf.get('ssh_user'):
-            for filename in self.configuration.files:
-                logging.info(_("Start uploading %s "), filename)
+        inventory = self.inventory(dest)
+        new = []
+        changed = []
+        unchanged = []
+        same_size = []
+        for name, path in sorted(library.items()):
+            st = os.stat(path)
+            if name not in inventory:
+                new.append(name)
+            elif inventory[name][0] != st.st_size:
+                changed.append(name)
+            elif compare == 'hash':
+                same_size.append(name)
+            elif long(st.st_mtime) > long(inventory[name][1]):
+                changed.append(name)
+            else:
+                unchanged.append(name)
+        if same_size:
+            # The local files are hashed while the server hashes its own
+            self.hasher.submit([library[name] for name in same_size])
+            digests = self.remote_digests(dest, same_size)
+            for name in same_size:
+                local = self.hasher.digest(library[name]).result()
+                if digests.get(name) != local:
+                    changed.append(name)
+                else:
+                    unchanged.append(name)
+        logging.info(
+            _('%s: %s new, %s changed and %s unchanged files'),
+            dest.name,
+            len(new),
+            len(changed),
+            len(unchanged)
+        )
+
+        scheduler = self.schedule(
+            [dest],
+            [library[name] for name in new + changed],
+            {dest.name: inventory}
+        )
+        transfers = scheduler.files
+        if self.needs_digests():
+            self.hasher.submit(transfers)
+        small = []
+        if dest.transport == 'ssh':
+            small = self.bulk_files(transfers)
+        uploaded = {}
+        if small:
+            uploaded = self.upload_bulk_ssh(dest, small, scheduler)
+
+        def send(file):
+            if file in uploaded:
+                return uploaded[file]
+            if not scheduler.reserve(dest.name, file):
+                return False
+            ok = self.upload_file(dest, file)
+            scheduler.release(dest.name, file, ok)
+            return ok
+
+        results = run_parallel(send, transfers, self.parallel_workers())
+        self.report_deferred([dest], scheduler)
+        moved = sum(
+            os.path.getsize(file)
+            for file, ok in zip(transfers, results) if ok
+        )
+        skipped = sum(os.path.getsize(library[name]) for name in unchanged)
+
+        pruned = 0
+        if self.configuration.get('prune'):
+            for name in sorted(set(inventory) - set(library)):
+                logging.info(_('Removing %s from %s'), name, dest.name)
                 try:
-                    logging.debug('file (%s)' % filename)
-                    dest_dir = os.path.join(path, remote_path)
-                    dest_file = os.path.join(
-                        dest_dir,
-                        os.path.basename(filename)
-                    )
-                    user = self.format_ssh_user(self.configuration["ssh_user"])
-                    retVal = self.exists_ssh(user, address, dest_file)
-                    if conf.get('force') or not retVal:
-                        temp_dest_file = os.path.join(
-                            dest_dir,
-                            '.%s' % os.path.basename(filename)
-                        )
-                        if retVal:
-                            self.remove_file_ssh(user, address, dest_file)
-                        (dir_size, file_size) = self.space_test_ssh(
-                            user,
-                            address,
-                            path,
-                            filename
-                        )
-                        if (long(dir_size) > long(file_size)):
-                            cmd = self.format_ssh_command(SCP)
-                            cmd += ' %s %s%s:%s' % (
-                                filename,
-                                user,
-                                address,
-                                temp_dest_file
-                            )
-                            logging.debug('SCP command is (%s)' % cmd)
-                            self.caller.call(cmd)
-                            if (
-                                self.format_ssh_user(
-                                    self.configuration["ssh_user"]
-                                ) == 'root@'
-                            ):
-                                cmd = self.format_ssh_command()
-                                cmd += ' %s%s "%s %s:%s %s"' % (
-                                    user,
-                                    address,
-                                    CHOWN,
-                                    NUMERIC_VDSM_ID,
-                                    NUMERIC_VDSM_ID,
-                                    temp_dest_file
-                                )
-                                logging.debug('CHOWN command is (%s)', cmd)
-                                self.caller.call(cmd)
-                            # chmod the file to 640.  Do this for every
-                            # user (i.e. root and otherwise)
-                            cmd = self.format_ssh_command()
-                            cmd += ' %s%s "%s %s %s"' % (
-                                user,
-                                address,
-                                CHMOD,
-                                PERMS_MASK,
-                                temp_dest_file
-                            )
-                            logging.debug('CHMOD command is (%s)', cmd)
-                            self.caller.call(cmd)
-                            self.rename_file_ssh(
-                                user,
-                                address,
-                                temp_dest_file,
-                                dest_file
-                            )
-                            # Force oVirt Engine to refresh the list of files
-                            # in the ISO domain
-                            self.refresh_iso_domain(id)
-                            logging.info(
-                                _("%s uploaded successfully"), filename
-                            )
-                        else:
-                            logging.error(
-                                _(
-                                    'There is not enough space in %s '
-                                    '(%s bytes) for %s (%s bytes)'
-                                ),
-                                path,
-                                dir_size,
-                                filename,
-                                file_size
-                            )
-                    else:
-                        ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
-                        logging.error(
-                            _(
-                                '%s exists on %s.  Either remove it or supply '
-                                'the --force option to overwrite it.'
-                            ),
-                            filename,
-                            address
-                        )
+                    self.remove_file(dest, name)
+                    pruned += 1
+                except Exception, e:
+                    ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
+                    logging.error(e)
+            if pruned and dest.id is not None:
+                self.refresh_iso_domain(dest.id)
+        logging.info(
+            _(
+                '%s: %s bytes uploaded, %s bytes skipped, '
+                '%s files pruned'
+            ),
+            dest.name,
+            moved,
+            skipped,
+            pruned
+        )
+
+    def parallel_workers(self):
+        try:
+            return max(1, int(self.configuration.get('parallel') or 1))
+        except ValueError:
+            raise Exception(
+                _("%s is not a valid number of parallel uploads") %
+                self.configuration.get('parallel')
+            )
+
+    def sync_storage_domain(self):
+        """
+        Synchronizes the ISO storage domains with the designated local
+        files and directories.
+        """
+        library = self.local_library(self.configuration.files)
+        # Changed files are replaced
+        self.configuration['force'] = True
+
+        def sync(destinations):
+            print _("Synchronizing, please wait...")
+            for dest in destinations:
+                try:
+                    self.sync_destination(dest, library)
                 except Exception, e:
                     ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
                     logging.error(
-                        _(
-                            'Unable to copy %s to ISO storage '
-                            'domain on %s.'
-                        ),
-                        filename,
-                        self.configuration.get('iso_domain')
-                    )
-                    logging.error(
-                        _('Error message is "%s"'),
+                        _('Unable to synchronize %s: %s'),
+                        dest.name,
                         str(e).strip()
                     )
-        elif domain_type in ('localfs', ):
-            ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
-            logging.error(
-                _(
-                    'Upload to a local storage domain is supported only '
-                    'through SSH'
-                ),
-            )
-        else:
-            # NFS support.
-            tmpDir = tempfile.mkdtemp()
-            logging.debug('local NFS mount point is %s' % tmpDir)
-            cmd = self.format_nfs_command(address, path, tmpDir)
-            try:
-                self.caller.call(cmd)
-                getpwnam(NFS_USER)
-                for filename in self.configuration.files:
-                    logging.info(_("Start uploading %s "), filename)
-                    dest_dir = os.path.join(
-                        tmpDir,
-                        remote_path
-                    )
-                    dest_file = os.path.join(
-                        dest_dir,
-                        os.path.basename(filename)
-                    )
-                    retVal = self.exists_nfs(
-                        dest_file,
-                        NUMERIC_VDSM_ID,
-                        NUMERIC_VDSM_ID
-                    )
-                    if conf.get('force') or not retVal:
-                        try:
-                            # Remove the file if it exists before
-                            # checking space.
-                            if retVal:
-                                self.remove_file_nfs(
-                                    dest_file,
-                                    NUMERIC_VDSM_ID,
-                                    NUMERIC_VDSM_ID
-                                )
-                            (dir_size, file_size) = self.space_test_nfs(
-                                dest_dir,
-                                filename,
-                                NUMERIC_VDSM_ID,
-                                NUMERIC_VDSM_ID
-                            )
-                            if (dir_size > file_size):
-                                temp_dest_file = os.path.join(
-                                    dest_dir,
-                                    '.%s' % os.path.basename(filename)
-                                )
-                                if self.copy_file(
-                                    filename,
-                                    temp_dest_file,
-                                    NUMERIC_VDSM_ID,
-                                    NUMERIC_VDSM_ID
-                                ):
-                                    if self.rename_file_nfs(
-                                        temp_dest_file,
-                                        dest_file,
-                                        NUMERIC_VDSM_ID,
-                                        NUMERIC_VDSM_ID
-                                    ):
-                                        if id is not None:
-                                            # Force oVirt Engine to refresh
-                                            # the list
-                                            # of files in the ISO domain
-                                            self.refresh_iso_domain(id)
-                                        logging.info(
-                                            _(
-                                                '{f} uploaded successfully'
-                                            ).format(
-                                                f=filename,
-                                            )
-                                        )
-                            else:
-                                logging.error(
-                                    _(
-                                        'There is not enough space in %s '
-                                        '(%s bytes) for %s (%s bytes)'
-                                    ),
-                                    path,
-                                    dir_size,
-                                    filename,
-                                    file_size
-                                )
-                        except Exception, e:
-                            ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
-                            logging.error(
-                                _(
-                                    'Unable to copy %s to ISO storage '
-                                    'domain on %s.'
-                                ),
-                                filename,
-                                (
-                                    self.configuration.get('iso_domain')
-                                    if (
-                                        self.configuration.get('iso_domain')
-                                        is not None
-                                    )
-                                    else self.configuration.get('nfs_server')
-                                )
-                            )
-                            logging.error(
-                                _('Error message is "%s"'),
-                                str(e).strip()
-                            )
-                    else:
-                        ExitCodes.exit_code = ExitCodes.UPLOAD_ERR
-                        logging.error(
-                            _(
-                                '%s exists on %s.  Either remove it or '
-                                'supply the --force option to overwrite it.'
-                            ),
-                            filename,
-                            address
-                        )
 
-            except KeyError:
-                ExitCodes.exit_code = ExitCodes.CRITICAL
-                logging.error(
-                    _(
-                        "A user named %s with a UID and GID of %d must be "
-                        "defined on the system to mount the ISO storage "
-                        "domain on %s as Read/Write"
-                    ),
-                    NFS_USER,
-                    NUMERIC_VDSM_ID,
-                    self.configuration.get('iso_domain')
-                )
-            except Exception, e:
-                ExitCodes.exit_code = ExitCodes.CRITICAL
-                logging.error(e)
-            finally:
-                try:
-                    cmd = '%s %s %s' % (UMOUNT, NFS_UMOUNT_OPTS, tmpDir)
-                    logging.debug(cmd)
-                    self.caller.call(cmd)
-                    shutil.rmtree(tmpDir)
-                except Exception, e:
-                    ExitCodes.exit_code = ExitCodes.CLEANUP_ERR
-                    logging.debug(e)
+        try:
+            self.with_destinations(sync)
+        finally:
+            self.hasher.close()
+
 
 if __name__ == '__main__':
 
@@ -1292,14 +6495,22 @@ if __name__ == '__main__':
     usage_string = "\n".join(
         (
             "%prog [options] list ",
-            "       %prog [options] upload FILE [FILE]...[FILE]"
+            "       %prog [options] upload FILE [FILE]...[FILE]",
+            "       %prog [options] sync DIR|FILE [DIR|FILE]...[DIR|FILE]",
+            "       %prog [options] delete PATTERN [PATTERN]...[PATTERN]",
+            "       %prog [options] watch DIR [DIR]...[DIR]"
         )
     )
 
     desc = _(
         """The ISO uploader can be used to list ISO storage domains
 and upload files to storage domains.  The upload operation supports
-multiple files (separated by spaces) and wildcarding."""
+multiple files (separated by spaces) and wildcarding.  The sync operation
+only uploads the files of a local library that are missing or changed
+in the storage domains.  The delete operation removes the files matching
+names or glob patterns from the storage domains.  The watch operation
+uploads the files written or moved into directories as they land, until
+interrupted."""
     )
 
     epilog_string = """\nReturn values:
@@ -1378,6 +6589,323 @@ multiple files (separated by spaces) and wildcarding."""
         default=False
     )
 
+    parser.add_option(
+        "",
+        "--pipelined-copy",
+        dest="pipelined_copy",
+        help=_(
+            "overlap reading the source and writing to the NFS server "
+            "through a ring of %d buffers of %d MiB (default=off)"
+        ) % (PIPELINE_BUFFERS, PIPELINE_BUFFER_SIZE / 1024 / 1024),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_option(
+        "",
+        "--drop-cache",
+        dest="drop_cache",
+        help=_(
+            "drop the uploaded data from the page cache as it is copied: "
+            "yes, no, or auto to do it for files larger than %d MiB "
+            "(default=auto)"
+        ) % (DROP_CACHE_THRESHOLD / 1024 / 1024),
+        metavar="MODE",
+        default="auto"
+    )
+
+    parser.add_option(
+        "",
+        "--delta",
+        dest="delta",
+        help=_(
+            "with --force, only transfer the blocks that differ from the "
+            "file being replaced. Only used for SSH transfers "
+            "(default=off)"
+        ),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_option(
+        "",
+        "--retries",
+        dest="retries",
+        help=_(
+            "how many times a transfer or a control operation that fails "
+            "in a transient way (EIO on the soft NFS mount, SSH "
+            "connection error, stall) is retried (default=%d)"
+        ) % DEFAULT_RETRIES,
+        type="int",
+        metavar="N",
+        default=DEFAULT_RETRIES
+    )
+
+    parser.add_option(
+        "",
+        "--retry-delay",
+        dest="retry_delay",
+        help=_(
+            "the delay before the first retry, doubled for each retry "
+            "and randomized by +/-50%% (default=%d)"
+        ) % DEFAULT_RETRY_DELAY,
+        type="float",
+        metavar="SECONDS",
+        default=DEFAULT_RETRY_DELAY
+    )
+
+    parser.add_option(
+        "",
+        "--stall-timeout",
+        dest="stall_timeout",
+        help=_(
+            "abort and retry a transfer that moves less than --min-rate "
+            "for that many seconds, 0 to never abort (default=%d)"
+        ) % DEFAULT_STALL_TIMEOUT,
+        type="int",
+        metavar="SECONDS",
+        default=DEFAULT_STALL_TIMEOUT
+    )
+
+    parser.add_option(
+        "",
+        "--min-rate",
+        dest="min_rate",
+        help=_(
+            "the throughput under which a transfer is considered stalled, "
+            "in KiB/s. With 0, only a transfer that makes no progress at "
+            "all is (default=0)"
+        ),
+        type="float",
+        metavar="KIB",
+        default=0
+    )
+
+    parser.add_option(
+        "",
+        "--command-timeout",
+        dest="command_timeout",
+        help=_(
+            "kill the commands other than transfers (which are watched "
+            "for stalls instead) that run for longer than that many "
+            "seconds, 0 to never kill them (default=%d)"
+        ) % DEFAULT_COMMAND_TIMEOUT,
+        type="int",
+        metavar="SECONDS",
+        default=DEFAULT_COMMAND_TIMEOUT
+    )
+
+    parser.add_option(
+        "",
+        "--max-commands",
+        dest="max_commands",
+        help=_(
+            "how many commands (ssh, scp, pipelines, ...) may run at the "
+            "same time, across stripes and parallel uploads (default=%d)"
+        ) % DEFAULT_MAX_COMMANDS,
+        type="int",
+        metavar="N",
+        default=DEFAULT_MAX_COMMANDS
+    )
+
+    parser.add_option(
+        "",
+        "--skip-validation",
+        dest="skip_validation",
+        help=_(
+            "upload .iso files without checking that they are complete "
+            "ISO9660 or UDF images first (default=off)"
+        ),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_option(
+        "",
+        "--catalog",
+        dest="catalog",
+        help=_(
+            "append a JSON line describing each uploaded file (volume "
+            "label, creation date, bootable, sizes) to this file"
+        ),
+        metavar="FILE",
+        default=None
+    )
+
+    parser.add_option(
+        "",
+        "--schedule",
+        dest="schedule",
+        help=_(
+            "the order of the uploads: given (command line order), "
+            "smallest (smallest files first, to upload as many files as "
+            "the free space allows) or best-fit (largest files that "
+            "still fit first, to fill the space best) (default=given)"
+        ),
+        metavar="POLICY",
+        default="given"
+    )
+
+    parser.add_option(
+        "",
+        "--priority",
+        dest="priority",
+        help=_(
+            "comma separated glob patterns of file names uploaded first, "
+            "in the order of the patterns, before --schedule applies"
+        ),
+        metavar="PATTERNS",
+        default=None
+    )
+
+    parser.add_option(
+        "",
+        "--checksums",
+        dest="checksums",
+        help=_(
+            "check the files having a <file>%s or a %s file next to "
+            "them against it before uploading them (default=off)"
+        ) % (SHA256_SUFFIX, SHA256_SUMS_FILES[0]),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_option(
+        "",
+        "--hash-processes",
+        dest="hash_processes",
+        help=_(
+            "the number of processes hashing files for --checksums, "
+            "--verify and --compare=hash (default=number of CPUs)"
+        ),
+        type="int",
+        metavar="N",
+        default=None
+    )
+
+    parser.add_option(
+        "",
+        "--plan",
+        dest="plan",
+        help=_(
+            "with upload, only print what would be uploaded, replaced, "
+            "skipped, deferred for lack of space or rejected, with the "
+            "bytes on the wire and the time it would take (default=off)"
+        ),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_option(
+        "",
+        "--history-file",
+        dest="history_file",
+        help=_(
+            "the file the throughput measured by the uploads to each "
+            "destination is kept in, for --plan (default=%s)"
+        ) % DEFAULT_HISTORY_FILE,
+        metavar="PATH",
+        default=DEFAULT_HISTORY_FILE
+    )
+
+    parser.add_option(
+        "",
+        "--metrics-file",
+        dest="metrics_file",
+        help=_(
+            "a Prometheus textfile (e.g. in the textfile collector "
+            "directory of node_exporter) the metrics of the runs are "
+            "cumulated in"
+        ),
+        metavar="PATH",
+        default=None
+    )
+
+    parser.add_option(
+        "",
+        "--statsd",
+        dest="statsd",
+        help=_(
+            "the address of a StatsD server the metrics of the run are "
+            "pushed to over UDP as they change"
+        ),
+        metavar="HOST:PORT",
+        default=None
+    )
+
+    sync_group = OptionGroup(
+        parser,
+        _("Sync Configuration"),
+        _(
+            'The options in the sync configuration group control how the '
+            'sync command compares the local files with the ones of the '
+            'ISO storage domain.'
+        )
+    )
+
+    sync_group.add_option(
+        "", "--compare", dest="compare",
+        help=_(
+            'how files of the same size are compared: mtime uploads the '
+            'local files modified after the ones in the domain, hash '
+            'compares their SHA256 digests (default=mtime)'
+        ),
+        metavar="MODE",
+        default="mtime"
+    )
+
+    sync_group.add_option(
+        "", "--prune", dest="prune",
+        help=_(
+            'remove the files of the domain that are not in the local '
+            'library (default=off)'
+        ),
+        action="store_true",
+        default=False
+    )
+
+    sync_group.add_option(
+        "", "--parallel", dest="parallel",
+        help=_(
+            'the number of files uploaded at the same time, by upload '
+            'as well (default=1)'
+        ),
+        metavar="N",
+        default=1
+    )
+
+    delete_group = OptionGroup(
+        parser,
+        _("Delete Configuration"),
+        _(
+            'The options in the delete configuration group restrict which '
+            'of the files matching the patterns given to the delete '
+            'command are removed.'
+        )
+    )
+
+    delete_group.add_option(
+        "", "--dry-run", dest="dry_run",
+        help=_('only list the files that would be deleted (default=off)'),
+        action="store_true",
+        default=False
+    )
+
+    delete_group.add_option(
+        "", "--keep-newest", dest="keep_newest",
+        help=_(
+            'keep the N most recent matching files of each prefix, the '
+            'prefix being the part of the name before its first digit'
+        ),
+        metavar="N"
+    )
+
+    delete_group.add_option(
+        "", "--older-than", dest="older_than",
+        help=_('only delete files modified more than DAYS days ago'),
+        metavar="DAYS"
+    )
+
     engine_group = OptionGroup(
         parser,
         _("oVirt Engine Configuration"),
@@ -1436,7 +6964,11 @@ multiple files (separated by spaces) and wildcarding."""
 
     iso_group.add_option(
         "-i", "--iso-domain", dest="iso_domain",
-        help=_("the ISO domain to which the file(s) should be uploaded"),
+        help=_(
+            "the ISO domain to which the file(s) should be uploaded. "
+            "Several domains can be given as a comma separated list, each "
+            "file is then read once and sent to all of them concurrently"
+        ),
         metavar=_("ISODOMAIN")
     )
 
@@ -1447,7 +6979,8 @@ multiple files (separated by spaces) and wildcarding."""
             'This option is an alternative to iso-domain and should not '
             ' be combined with iso-domain.  Use this when you want to '
             'upload files to a specific NFS server '
-            '(e.g.--nfs-server=example.com:/path/to/some/dir)'
+            '(e.g.--nfs-server=example.com:/path/to/some/dir). Several '
+            'servers can be given as a comma separated list'
         ),
         metavar=_("NFSSERVER")
     )
@@ -1458,7 +6991,8 @@ multiple files (separated by spaces) and wildcarding."""
         _(
             'By default the program uses NFS to copy files to the ISO '
             'storage domain. To use SSH file transfer, instead of NFS, '
-            'provide a ssh-user.'
+            'provide a ssh-user. To upload through the engine instead, to '
+            'data domains, use --http.'
         )
     )
 
@@ -1491,9 +7025,157 @@ multiple files (separated by spaces) and wildcarding."""
         metavar="KEYFILE"
     )
 
+    ssh_group.add_option(
+        "", "--compress", dest="compress",
+        help=_(
+            'compress files on the wire for SSH file transfers. '
+            'Compression is turned off for files and links where it does '
+            'not shorten the transfer (default=off)'
+        ),
+        action="store_true",
+        default=False
+    )
+
+    ssh_group.add_option(
+        "", "--compressor", dest="compressor",
+        help=_(
+            'the compressor used by --compress, one of %s. It must be '
+            'available on both ends (default=%s)'
+        ) % (', '.join(sorted(COMPRESSORS)), DEFAULT_COMPRESSOR),
+        metavar="COMPRESSOR",
+        default=DEFAULT_COMPRESSOR
+    )
+
+    ssh_group.add_option(
+        "", "--compress-level", dest="compress_level",
+        help=_(
+            'the compression level used by --compress, or auto to pick it '
+            'from the compressibility of each file and the measured '
+            'throughput of the link (default=auto)'
+        ),
+        metavar="LEVEL",
+        default="auto"
+    )
+
+    ssh_group.add_option(
+        "", "--bulk-max-size", dest="bulk_max_size",
+        help=_(
+            'upload the files of up to MIB MiB together, in a single tar '
+            'stream over one SSH connection to each file server, instead '
+            'of file by file (default=0, off)'
+        ),
+        metavar="MIB"
+    )
+
+    ssh_group.add_option(
+        "", "--ssh-stripes", dest="ssh_stripes",
+        help=_(
+            'the number of concurrent SSH channels a single file is '
+            'striped over. Each stripe is at least %d MiB (default=1)'
+        ) % (STRIPE_MIN_SIZE / 1024 / 1024),
+        metavar="N",
+        default=1
+    )
+
+    ssh_group.add_option(
+        "", "--stripe-retries", dest="stripe_retries",
+        help=_(
+            'how many times a failed stripe is sent again (default=%d)'
+        ) % DEFAULT_STRIPE_RETRIES,
+        metavar="N",
+        default=DEFAULT_STRIPE_RETRIES
+    )
+
+    ssh_group.add_option(
+        "", "--host-cache-ttl", dest="host_cache_ttl",
+        help=_(
+            'how long the rankings of the hosts of a local ISO domain and '
+            'of the SSH ciphers of a file server, probed to pick the '
+            'fastest ones, are reused, 0 to probe them on each run '
+            '(default=%d)'
+        ) % DEFAULT_HOST_CACHE_TTL,
+        metavar="SECONDS"
+    )
+
+    ssh_group.add_option(
+        "", "--ssh-cipher", dest="ssh_cipher",
+        help=_(
+            'the cipher of the SSH connections, or auto to use the '
+            'fastest of %s for each file server (default=the one ssh '
+            'negotiates)'
+        ) % ', '.join(SSH_CIPHERS),
+        metavar="CIPHER"
+    )
+
+    ssh_group.add_option(
+        "", "--verify", dest="verify",
+        help=_(
+            'verify SSH file transfers: the receiving end hashes the data '
+            'as it writes it and its SHA256 digest is compared with the '
+            'local one before the file is renamed into place '
+            '(default=off)'
+        ),
+        action="store_true",
+        default=False
+    )
+
+    ssh_group.add_option(
+        "", "--http", dest="http",
+        help=_(
+            'upload the files as ISO disks of the data domains given by '
+            '--iso-domain, through the image transfer API of the engine. '
+            'Needs neither NFS mount rights nor SSH access to the file '
+            'server (default=off)'
+        ),
+        action="store_true",
+        default=False
+    )
+
+    ssh_group.add_option(
+        "", "--http-connections", dest="http_connections",
+        help=_(
+            'the number of concurrent HTTP connections each file is '
+            'uploaded over with --http, each one sending its own ranges '
+            '(default=%d)'
+        ) % DEFAULT_HTTP_CONNECTIONS,
+        metavar="N",
+        default=DEFAULT_HTTP_CONNECTIONS
+    )
+
     parser.add_option_group(engine_group)
     parser.add_option_group(iso_group)
+    watch_group = OptionGroup(
+        parser,
+        _("Watch Configuration"),
+        _(
+            'The options in the watch configuration group control which '
+            'of the files landing in the directories given to the watch '
+            'command are uploaded, and when.'
+        )
+    )
+
+    watch_group.add_option(
+        "", "--settle", dest="settle",
+        help=_(
+            'upload a file once it has not changed for SECONDS seconds '
+            '(default=%d)'
+        ) % DEFAULT_WATCH_SETTLE,
+        metavar="SECONDS"
+    )
+
+    watch_group.add_option(
+        "", "--watch-patterns", dest="watch_patterns",
+        help=_(
+            'comma separated glob patterns of the names of the files to '
+            'upload (default=*)'
+        ),
+        metavar="PATTERNS"
+    )
+
     parser.add_option_group(ssh_group)
+    parser.add_option_group(sync_group)
+    parser.add_option_group(delete_group)
+    parser.add_option_group(watch_group)
 
     try:
         # Define configuration so that we don't get a NameError